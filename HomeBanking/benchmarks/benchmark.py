@@ -0,0 +1,291 @@
+"""
+Performance benchmark of the API and of the DAO layer.
+
+The benchmark seeds a database with a reproducible dataset, then measures the latency percentiles and the throughput
+of the main endpoints, both through the ASGI application and by calling the DAO functions directly.
+The results are written to a JSON file which can be compared with a baseline to detect regressions.
+
+Usage (from the HomeBanking directory):
+
+    python -m benchmarks.benchmark --output results.json
+    python -m benchmarks.benchmark --output results.json --baseline baseline.json
+
+The benchmark uses a fresh SQLite file by default. When the MYSQL_* environment variables are set, the MySQL database
+they point to (e.g. the docker-compose container of the database directory) is seeded and used instead.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from typing import Callable, Dict, List
+
+from db.variables import settings
+
+REGRESSION_THRESHOLD = 0.2  # relative p95 latency increase (or throughput decrease) flagged as regression
+SEED = 42
+
+
+def percentile(samples: List[float], rank: float) -> float:
+    """
+    Returns a percentile of a list of samples (nearest-rank method)
+    :param samples: the sorted samples
+    :param rank: the percentile, between 0 and 100
+    :return: the sample at this rank
+    """
+
+    index = max(0, min(len(samples) - 1, int(round(rank / 100.0 * len(samples))) - 1))
+    return samples[index]
+
+
+def measure(operation: Callable[[int], object], iterations: int, warmup: int) -> dict:
+    """
+    Calls an operation repeatedly and summarizes its latencies
+    :param operation: the operation to measure, called with the iteration number, may return its number of rows
+    :param iterations: number of measured calls
+    :param warmup: number of calls done before the measure
+    :return: the count, the p50/p95/p99/mean latencies in milliseconds, the throughput in operations per second
+    and in rows per second for the operations returning rows
+    """
+
+    for i in range(warmup):
+        operation(-1 - i)
+    latencies = []
+    rows = 0
+    start = time.perf_counter()
+    for i in range(iterations):
+        begin = time.perf_counter()
+        result = operation(i)
+        latencies.append((time.perf_counter() - begin) * 1000.0)
+        if isinstance(result, int):
+            rows += result
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    results = {"count": iterations,
+               "p50_ms": round(percentile(latencies, 50), 4),
+               "p95_ms": round(percentile(latencies, 95), 4),
+               "p99_ms": round(percentile(latencies, 99), 4),
+               "mean_ms": round(sum(latencies) / iterations, 4),
+               "throughput_ops": round(iterations / elapsed, 2)}
+    if rows:
+        results["rows_per_s"] = round(rows / elapsed, 1)
+    return results
+
+
+def make_iban(n: int) -> str:
+    """
+    Builds the n-th valid German IBAN of the benchmark dataset
+    """
+
+    from util.iban import _checksum
+
+    bban = "%08d%010d" % (37040044, n)
+    return "DE%02d%s" % (98 - _checksum("DE00" + bban), bban)
+
+
+def seed(users: int, accounts_per_user: int) -> dict:
+    """
+    Creates the tables and inserts the benchmark dataset with bulk INSERTs (the geocoder is never called)
+    :param users: number of users
+    :param accounts_per_user: number of accounts of each user
+    :return: the IDs of the users and the account numbers
+    """
+
+    from sqlalchemy import func, insert, select
+    from db.database import Base, get_engine, get_db
+    from db.tables.user import User as UserTable
+    from db.tables.account import Account as AccountTable
+    from db.tables.ledger import BalanceCheckpoint
+    from pojo.user import GEOCODING_DONE
+    from main import app  # imports the routers, hence every table definition
+
+    Base.metadata.create_all(get_engine())
+    session = get_db()
+    try:
+        first_id = (session.execute(select(func.max(UserTable.id))).scalar() or 0) + 1
+        first_account = session.execute(select(func.count()).select_from(AccountTable)).scalar()
+        user_ids = list(range(first_id, first_id + users))
+        session.execute(insert(UserTable), [{"id": user_id, "firstname": "Bench", "lastname": "User %d" % user_id,
+                                             "address": "rue de la Loi %d, 1000 Bruxelles, Belgique" % user_id,
+                                             "geocoding_status": GEOCODING_DONE} for user_id in user_ids])
+        numbers = [make_iban(first_account + n) for n in range(users * accounts_per_user)]
+        session.execute(insert(AccountTable), [{"number": number, "balance": 1e9,
+                                                "user_id": user_ids[n // accounts_per_user]}
+                                               for n, number in enumerate(numbers)])
+        session.execute(insert(BalanceCheckpoint), [{"account_number": number, "date": datetime.utcnow(),
+                                                     "balance": 1e9} for number in numbers])
+        session.commit()
+    finally:
+        session.close()
+    return {"user_ids": user_ids, "numbers": numbers, "next_account": first_account + len(numbers)}
+
+
+def scenarios(dataset: dict) -> Dict[str, Callable[[int], object]]:
+    """
+    Builds the measured operations, through the ASGI application and through the DAO layer
+    :param dataset: the seeded dataset
+    :return: the operations indexed by name
+    """
+
+    from fastapi.testclient import TestClient
+    from main import app
+    from dao import user_dao, account_dao, transaction_dao
+    from pojo.account import Account as AccountPOJO
+    from pojo.transaction import Transaction as TransactionPOJO
+    from workers.transfer_writer import transfer_writer
+
+    client = TestClient(app)  # not started as a context manager: the background workers are not running
+    transfer_writer.start()  # except the writer of the queued transfers
+    rng = random.Random(SEED)
+    user_ids = dataset["user_ids"]
+    numbers = dataset["numbers"]
+    new_accounts = iter(range(dataset["next_account"], sys.maxsize))
+
+    def check(response):
+        if response.status_code != 200 or (isinstance(response.json(), dict) and "error" in response.json()):
+            raise RuntimeError("%s %s: %s" % (response.request.method, response.request.url, response.text))
+        return len(response.json()) if isinstance(response.json(), list) else None
+
+    def new_account():
+        return make_iban(next(new_accounts)), rng.choice(user_ids)
+
+    def asgi_create_account(i):
+        number, user_id = new_account()
+        check(client.post("/create_account/", params={"number": number, "user_id": user_id}))
+
+    def asgi_create_accounts_bulk(i):
+        body = [dict(zip(("number", "user_id"), new_account())) for n in range(100)]
+        check(client.post("/accounts/bulk", json=body))
+        return len(body)
+
+    def asgi_transfer(i):
+        from_acc, to_acc = rng.sample(numbers, 2)
+        check(client.post("/transfer/", params={"from_acc": from_acc, "to_acc": to_acc, "amount": 1}))
+
+    def asgi_transfer_queued(i):
+        from_acc, to_acc = rng.sample(numbers, 2)
+        response = client.post("/transfer/", params={"from_acc": from_acc, "to_acc": to_acc, "amount": 1,
+                                                     "queued": True})
+        if response.status_code != 202:
+            raise RuntimeError("POST /transfer/: %s" % response.text)
+
+    def dao_transfer_queued(i):
+        group = [(uuid.uuid4().hex, TransactionPOJO(**dict(zip(("from_acc", "to_acc"), rng.sample(numbers, 2)),
+                                                           amount=1)))
+                 for n in range(settings.transfer_group_size)]
+        transaction_dao.transfer_queued(group)
+        return len(group)
+
+    def dao_create_account(i):
+        number, user_id = new_account()
+        account_dao.create_account(AccountPOJO(number=number, user_id=user_id))
+
+    def dao_transfer(i):
+        from_acc, to_acc = rng.sample(numbers, 2)
+        transaction_dao.transfer(TransactionPOJO(from_acc=from_acc, to_acc=to_acc, amount=1))
+
+    return {
+        "asgi GET /users": lambda i: check(client.get("/users")),
+        "asgi GET /accounts/{user_id}": lambda i: check(client.get("/accounts/%d" % rng.choice(user_ids))),
+        "asgi GET /accounts/": lambda i: check(client.get("/accounts/")),
+        "asgi POST /create_account/": asgi_create_account,
+        "asgi POST /accounts/bulk (100)": asgi_create_accounts_bulk,
+        "asgi POST /transfer/": asgi_transfer,
+        "asgi POST /transfer/ (queued)": asgi_transfer_queued,
+        "dao get_users": lambda i: len(user_dao.get_users()),
+        "dao get_user_rows": lambda i: len(user_dao.get_user_rows()),
+        "dao get_accounts": lambda i: len(account_dao.get_accounts(rng.choice(user_ids))),
+        "dao get_accounts (all)": lambda i: len(account_dao.get_accounts(None)),
+        "dao get_account_rows (all)": lambda i: len(account_dao.get_account_rows(None)),
+        "dao create_account": dao_create_account,
+        "dao transfer": dao_transfer,
+        "dao transfer_queued (group)": dao_transfer_queued,
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> List[str]:
+    """
+    Compares benchmark results with a baseline
+    :param results: the current results
+    :param baseline: the baseline results
+    :param threshold: relative degradation tolerated
+    :return: the description of each regression
+    """
+
+    regressions = []
+    for name, current in results["results"].items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            continue
+        if current["p95_ms"] > previous["p95_ms"] * (1 + threshold):
+            regressions.append("%s: p95 %.3f ms -> %.3f ms" % (name, previous["p95_ms"], current["p95_ms"]))
+        if current["throughput_ops"] < previous["throughput_ops"] * (1 - threshold):
+            regressions.append("%s: throughput %.1f ops -> %.1f ops"
+                               % (name, previous["throughput_ops"], current["throughput_ops"]))
+    return regressions
+
+
+def run(args) -> dict:
+    """
+    Seeds the database and measures every scenario (or the ones selected)
+    :return: the results, with the dataset and environment description
+    """
+
+    dataset = seed(args.users, args.accounts_per_user)
+    results = {}
+    for name, operation in scenarios(dataset).items():
+        if args.only and not any(selected in name for selected in args.only):
+            continue
+        results[name] = measure(operation, args.iterations, args.warmup)
+        print("%-32s p50 %8.3f ms  p95 %8.3f ms  p99 %8.3f ms  %9.1f ops/s  %10s rows/s"
+              % (name, results[name]["p50_ms"], results[name]["p95_ms"], results[name]["p99_ms"],
+                 results[name]["throughput_ops"], results[name].get("rows_per_s", "-")))
+
+    from db.database import get_engine
+    return {"environment": {"python": platform.python_version(), "platform": platform.platform(),
+                            "database": get_engine().dialect.name},
+            "dataset": {"users": args.users, "accounts_per_user": args.accounts_per_user, "seed": SEED},
+            "iterations": args.iterations,
+            "results": results}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="HomeBanking API and DAO benchmark")
+    parser.add_argument("--users", type=int, default=1000, help="number of seeded users")
+    parser.add_argument("--accounts-per-user", type=int, default=2, help="number of seeded accounts per user")
+    parser.add_argument("--iterations", type=int, default=500, help="measured calls per scenario")
+    parser.add_argument("--warmup", type=int, default=20, help="calls per scenario before the measure")
+    parser.add_argument("--only", nargs="*", help="only runs the scenarios whose name contains one of these strings")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file receiving the results")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="relative degradation flagged as regression (default 0.2)")
+    args = parser.parse_args(argv)
+
+    directory = None
+    if "MYSQL_HOST" not in os.environ:
+        directory = tempfile.mkdtemp(prefix="homebanking-bench-")
+        settings.db_url = "sqlite:///" + os.path.join(directory, "bench.db")
+    settings.transfer_queue_dir = tempfile.mkdtemp(prefix="homebanking-queue-")
+
+    results = run(args)
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), args.threshold)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
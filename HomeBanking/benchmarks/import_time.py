@@ -0,0 +1,155 @@
+"""
+Import time benchmark of the application: the cold start of every new worker process.
+
+Each scenario runs in fresh interpreters with python -X importtime, which reports the time spent importing every
+module. The median total of the runs, the slowest top-level packages and the deferred modules loaded anyway
+(geocoder, IBAN library and database drivers, which must only be loaded on first use) are written to a JSON file,
+which can be compared with a baseline to detect regressions.
+
+Usage (from the HomeBanking directory):
+
+    python -m benchmarks.import_time --output import_time.json
+    python -m benchmarks.import_time --output import_time.json --baseline import_baseline.json
+
+The command exits with status 1 if a deferred module is imported, or if a scenario regresses compared to the baseline.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+from typing import Dict, List
+
+from benchmarks.benchmark import REGRESSION_THRESHOLD
+
+# modules loaded on first use only: the geocoder, the IBAN validation of the countries missing from the format
+# tables, and the database drivers (the engines are created by the application lifespan)
+DEFERRED_MODULES = ("geopy", "schwifty", "pymysql", "aiomysql", "aiosqlite")
+SCENARIOS = {
+    "import main": "import main",
+    "create_app": "import main; main.create_app()",
+}
+TOP_MODULES = 10  # slowest top-level packages reported per scenario
+
+
+def parse_importtime(output: str) -> List[dict]:
+    """
+    Parses the report of python -X importtime
+    :param output: the standard error of the interpreter
+    :return: the imported modules in import order, with their self and cumulative times in microseconds and their
+    nesting level (0 for the modules imported by the measured code itself)
+    """
+
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        indent = len(name) - len(name.lstrip())
+        modules.append({"name": name.strip(), "self_us": int(self_us), "cumulative_us": int(cumulative_us),
+                        "level": (indent - 1) // 2})
+    return modules
+
+
+def run_scenario(code: str) -> List[dict]:
+    """
+    Executes code in a fresh interpreter with -X importtime
+    :return: the imported modules (see parse_importtime)
+    """
+
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    if result.returncode != 0:
+        raise RuntimeError("%s: %s" % (code, result.stderr[-2000:]))
+    return parse_importtime(result.stderr)
+
+
+def measure(code: str, runs: int, startup_modules: set) -> dict:
+    """
+    Runs a scenario several times and summarizes its import times
+    :param code: the measured code
+    :param runs: number of interpreters started
+    :param startup_modules: the modules imported by the interpreter itself, not counted
+    :return: the median and minimum total import time in milliseconds, the number of imported modules, the slowest
+    top-level packages of the median run and the deferred modules imported
+    """
+
+    totals = []
+    reports = []
+    for i in range(runs):
+        modules = [module for module in run_scenario(code) if module["name"] not in startup_modules]
+        totals.append(sum(module["cumulative_us"] for module in modules if module["level"] == 0) / 1000.0)
+        reports.append(modules)
+    median = statistics.median_low(totals)
+    modules = reports[totals.index(median)]
+    top = sorted((module for module in modules if module["level"] == 0), key=lambda module: -module["cumulative_us"])
+    imported = {module["name"].split(".")[0] for module in modules}
+    return {"runs": runs,
+            "median_ms": round(median, 3),
+            "min_ms": round(min(totals), 3),
+            "modules": len(modules),
+            "top": {module["name"]: round(module["cumulative_us"] / 1000.0, 3) for module in top[:TOP_MODULES]},
+            "deferred_imported": sorted(imported.intersection(DEFERRED_MODULES))}
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> List[str]:
+    """
+    Compares import time results with a baseline
+    :param results: the current results
+    :param baseline: the baseline results
+    :param threshold: relative increase tolerated
+    :return: the description of each regression
+    """
+
+    regressions = []
+    for name, current in results["results"].items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is not None and current["median_ms"] > previous["median_ms"] * (1 + threshold):
+            regressions.append("%s: %.1f ms -> %.1f ms" % (name, previous["median_ms"], current["median_ms"]))
+    return regressions
+
+
+def run(runs: int) -> Dict[str, dict]:
+    """
+    Measures every scenario
+    :return: the results by scenario name
+    """
+
+    startup_modules = {module["name"] for module in run_scenario("pass")}
+    results = {}
+    for name, code in SCENARIOS.items():
+        results[name] = measure(code, runs, startup_modules)
+        print("%-16s median %8.1f ms  min %8.1f ms  %4d modules  deferred imported: %s"
+              % (name, results[name]["median_ms"], results[name]["min_ms"], results[name]["modules"],
+                 ", ".join(results[name]["deferred_imported"]) or "none"))
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="HomeBanking import time benchmark")
+    parser.add_argument("--runs", type=int, default=7, help="interpreters started per scenario")
+    parser.add_argument("--output", default="import_time.json", help="JSON file receiving the results")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="relative increase flagged as regression (default 0.2)")
+    args = parser.parse_args(argv)
+
+    results = {"environment": {"python": platform.python_version(), "platform": platform.platform()},
+               "results": run(args.runs)}
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+
+    failures = ["%s imports %s" % (name, ", ".join(result["deferred_imported"]))
+                for name, result in results["results"].items() if result["deferred_imported"]]
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            failures += compare(results, json.load(baseline), args.threshold)
+    for failure in failures:
+        print("REGRESSION " + failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
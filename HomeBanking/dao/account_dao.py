@@ -1,71 +1,333 @@
-from typing import List
-from pojo.account import Account as AccountPOJO
+from typing import List, Optional
+from sqlalchemy import case, func, insert, literal_column, select
+from pojo.account import Account as AccountPOJO, BalanceSummary, BalanceStats
 from dao.user_dao import get_user
-from db.database import get_db
+from dao.idempotency_dao import save_record
+from dao.ledger_dao import open_balance, open_balances
+from dao.transaction_dao import IN_CHUNK_SIZE
+from sqlalchemy.orm import Session
+from db.database import on_primary, use_db, use_read_db
 from db.tables.account import Account as AccountTable
+from db.tables.user import User as UserTable
 from util.messages import *
+from util.entity_cache import account_cache
+from util.cache import TTLCache
+from db.variables import settings
 from util.util import validate_account_number
+from util.iban import validate_ibans
+from util.retry import retry_transaction
 
+GROUP_BY_USER = "user"
+GROUP_BY_COUNTRY = "country"  # country code of the IBAN (first two characters of the account number)
+BALANCE_BUCKETS = (0, 100, 1000, 10000, 100000)  # bounds of the balance distribution ranges in EURO
 
-def get_accounts(user_id) -> List[AccountPOJO]:
+stats_cache = TTLCache(256, settings.stats_cache_ttl)  # balance statistics, shared by the sync and async DAOs
+
+
+def get_accounts(user_id, after: str = None, limit: int = None, session: Session = None) -> List[AccountPOJO]:
     """
-    Returns the accounts information based on a given user ID
+    Returns the accounts information based on a given user ID, optionally one page at a time
+    (keyset pagination on the account number)
     :param user_id: the user ID to whom the accounts belong.
+    :param after: only returns the accounts whose number is greater than this one
+    (number of the last account of the previous page)
+    :param limit: maximum number of accounts to return
+    :param session: the session of the caller, a new session is used if None
     :return: the list of accounts
     """
 
     accounts = []
-    session = get_db()
-    try:
-        query = session.query(AccountTable)
-        if user_id is not None:  # if user_id is not specified, it retrieves everybody's accounts
-            query = query.filter(AccountTable.user_id == user_id)
-        for account in query.all():
+    with use_read_db(session) as session:
+        for account in session.scalars(_select_accounts(user_id, after, limit)):
             accounts.append(_convert_to_pojo(account))
-    finally:
-        session.close()
     return accounts
 
 
-def create_account(account: AccountPOJO) -> int:
+def get_account_rows(user_id, after: str = None, limit: int = None, session: Session = None) -> List[dict]:
+    """
+    Returns the accounts as plain dictionaries, ready to be encoded to JSON. The accounts are read with a
+    column-only query, without building ORM entities nor pydantic models
+    :param user_id: the user ID to whom the accounts belong, None for everybody's accounts
+    :param after: only returns the accounts whose number is greater than this one
+    :param limit: maximum number of accounts to return
+    :param session: the session of the caller, a new session is used if None
+    :return: the list of accounts, with the fields of the Account model
+    """
+
+    with use_read_db(session) as session:
+        return [_row_to_dict(row) for row in session.execute(_select_accounts(user_id, after, limit, columns=True))]
+
+
+@retry_transaction
+def create_account(account: AccountPOJO, session: Session = None, idempotency_record=None) -> int:
     """
-    Creates a new account
+    Creates a new account. The owner and account number checks share the session of the insert
     :param account: information of the account to create and the owner (user) ID
+    :param session: the session of the caller, a new session is used if None
+    :param idempotency_record: record of the idempotency key of the request, inserted in the same transaction
     :raises: BankingException: the user ID is unknown or the account number to create is already used
     """
 
-    session = get_db()
-    try:
-        if validate_account_number(account.number) is False:
-            raise BankingException(INVALID_ACCOUNT_NUMBER)
+    if validate_account_number(account.number) is False:
+        raise BankingException(INVALID_ACCOUNT_NUMBER)
 
-        user = get_user(account.user_id)
+    with use_db(session) as session:
+        user = get_user(account.user_id, session)
         if user is None:
             raise BankingException(UNKNOWN_USER_ID)
 
-        a = get_account(account.number)
+        a = get_account(account.number, session)
         if a is not None:
             raise BankingException(ALREADY_USED_ACCOUNT_NUMBER)
 
         session.add(_convert_to_sql(account))
+        session.flush()  # the account row is inserted before its opening checkpoint
+        open_balance(session, account.number, account.balance)
+        if idempotency_record is not None:
+            save_record(idempotency_record, session)
         session.commit()
-    finally:
-        session.close()
+    account_cache.invalidate(account.number)  # discards the cached absence of the account
 
 
-def get_account(number: str):
+@retry_transaction
+def create_accounts(accounts: List[AccountPOJO], session: Session = None) -> List[Optional[str]]:
+    """
+    Creates a list of accounts in a single database transaction, with set-based checks: the account numbers are
+    validated up front, the owners are checked by IN queries over the distinct user IDs and the collisions by
+    IN queries over the submitted numbers. The accepted accounts and their opening checkpoints are written with
+    two bulk INSERTs.
+    A refused account does not prevent the next ones from being created
+    :param accounts: the accounts to create
+    :param session: the session of the caller, a new session is used if None
+    :return: for each account, None if it was created or the error message explaining why it was refused
     """
-    Retrieves information of a given account number
+
+    with use_db(session) as session:
+        user_ids, used_numbers = set(), set()
+        for statement in _existing_users_statements(accounts):
+            user_ids.update(session.scalars(statement))
+        for statement in _used_numbers_statements(accounts):
+            used_numbers.update(session.scalars(statement))
+
+        results, accepted = _check_accounts(accounts, user_ids, used_numbers)
+        if accepted:
+            try:
+                session.execute(insert(AccountTable), [account.dict() for account in accepted])
+                open_balances(session, {account.number: account.balance for account in accepted})
+                session.commit()
+            except Exception:
+                session.rollback()
+                raise
+    account_cache.invalidate(*[account.number for account in accepted])  # discards the cached absences
+    return results
+
+
+def get_account(number: str, session: Session = None) -> AccountPOJO:
+    """
+    Retrieves information of a given account number (read-through the account cache)
     :param number: the account number
+    :param session: the session of the caller, a new session is used if None
     :return: the account information or None if the account number does not exist
     """
 
-    session = get_db()
-    try:
-        account = session.query(AccountTable).filter(AccountTable.number == number).first()
-        return account
-    finally:
-        session.close()
+    found, account, version = account_cache.lookup(number)
+    if not found:
+        with use_db(on_primary(session)) as session:
+            account = _convert_to_pojo(session.get(AccountTable, number))
+        account_cache.store(number, version, account)
+    return account
+
+
+def get_user_summary(user_id: int, session: Session = None) -> BalanceSummary:
+    """
+    Returns the account count, total, lowest and highest balance of a user, aggregated by the database
+    :param user_id: the user ID
+    :param session: the session of the caller, a new session is used if None
+    :return: the summary
+    :raises BankingException: the user ID is unknown
+    """
+
+    with use_read_db(session) as session:
+        get_user(user_id, session)  # raises a BankingException if the user ID is unknown
+        return _row_to_summary(user_id, session.execute(_select_summary(user_id)).one())
+
+
+def get_balance_stats(group_by: str = None, after: str = None, limit: int = None,
+                      session: Session = None) -> List[BalanceStats]:
+    """
+    Returns the balance totals and distribution of the accounts, computed with a GROUP BY in the database.
+    The results are cached for settings.stats_cache_ttl seconds
+    :param group_by: GROUP_BY_USER, GROUP_BY_COUNTRY or None for the whole bank
+    :param after: only returns the groups whose key is greater than this one (key of the last group of the previous page)
+    :param limit: maximum number of groups to return
+    :param session: the session of the caller, a new session is used if None
+    :return: the statistics of each group, sorted by key
+    """
+
+    cache_key = (group_by, after, limit)
+    found, stats = stats_cache.lookup(cache_key)
+    if not found:
+        with use_read_db(session) as session:
+            rows = session.execute(_select_stats(group_by, after, limit))
+            stats = [_row_to_stats(row, group_by is not None) for row in rows]
+        _store_stats(cache_key, stats)
+    return stats
+
+
+def _existing_users_statements(accounts: List[AccountPOJO]):
+    """
+    :return: the statements selecting which owners of a list of accounts exist (one per chunk of user IDs)
+    """
+
+    user_ids = sorted({account.user_id for account in accounts})
+    return [select(UserTable.id).where(UserTable.id.in_(user_ids[i:i + IN_CHUNK_SIZE]))
+            for i in range(0, len(user_ids), IN_CHUNK_SIZE)]
+
+
+def _used_numbers_statements(accounts: List[AccountPOJO]):
+    """
+    :return: the statements selecting which numbers of a list of accounts are already used (one per chunk of numbers)
+    """
+
+    numbers = sorted({account.number for account in accounts})
+    return [select(AccountTable.number).where(AccountTable.number.in_(numbers[i:i + IN_CHUNK_SIZE]))
+            for i in range(0, len(numbers), IN_CHUNK_SIZE)]
+
+
+def _check_accounts(accounts: List[AccountPOJO], user_ids: set, used_numbers: set):
+    """
+    Checks a list of accounts to create, in order (the first occurrence of a number submitted twice is accepted)
+    :param accounts: the accounts to check
+    :param user_ids: the existing owners among the user IDs of the accounts
+    :param used_numbers: the numbers already used, updated with the accepted accounts
+    :return: the error message (or None) of each account and the list of accepted accounts
+    """
+
+    results = []
+    accepted = []
+    for account, valid in zip(accounts, validate_ibans([account.number for account in accounts])):
+        if not valid:
+            results.append(INVALID_ACCOUNT_NUMBER)
+        elif account.user_id not in user_ids:
+            results.append(UNKNOWN_USER_ID)
+        elif account.number in used_numbers:
+            results.append(ALREADY_USED_ACCOUNT_NUMBER)
+        else:
+            used_numbers.add(account.number)
+            accepted.append(account)
+            results.append(None)
+    return results, accepted
+
+
+def _select_summary(user_id: int):
+    """
+    Builds the query aggregating the accounts of a user (index range scan on the owner ID)
+    """
+
+    balance = AccountTable.total_balance
+    return select(func.count(), func.coalesce(func.sum(balance), 0.0), func.min(balance), func.max(balance)) \
+        .where(AccountTable.user_id == user_id)
+
+
+def _row_to_summary(user_id: int, row) -> BalanceSummary:
+    count, total, min_balance, max_balance = row
+    return BalanceSummary(user_id=user_id, account_count=count, total=total,
+                          min_balance=min_balance, max_balance=max_balance)
+
+
+def _bucket_labels() -> List[str]:
+    """
+    :return: the labels of the balance ranges delimited by BALANCE_BUCKETS (e.g. "<0", "0-100", ">=100000")
+    """
+
+    bounds = BALANCE_BUCKETS
+    return ["<%d" % bounds[0]] + ["%d-%d" % (low, high) for low, high in zip(bounds, bounds[1:])] + \
+        [">=%d" % bounds[-1]]
+
+
+def _select_stats(group_by: str, after: str, limit: int):
+    """
+    Builds the aggregation query of the balance statistics: one row per group with the count, total, min, max
+    and the number of accounts in each balance range (conditional sums computed in the same pass)
+    :param group_by: GROUP_BY_USER, GROUP_BY_COUNTRY or None for the whole bank
+    :param after: only selects the groups whose key is greater than this one
+    :param limit: maximum number of groups to select
+    :return: the SELECT statement
+    """
+
+    bounds = BALANCE_BUCKETS
+    balance = AccountTable.total_balance
+    ranges = [balance < bounds[0]] + [(balance >= low) & (balance < high) for low, high in zip(bounds, bounds[1:])] + \
+        [balance >= bounds[-1]]
+    buckets = [func.coalesce(func.sum(case((condition, 1), else_=0)), 0) for condition in ranges]
+    aggregates = [func.count(), func.coalesce(func.sum(balance), 0.0), func.min(balance), func.max(balance)] + buckets
+
+    if group_by is None:
+        return select(*aggregates)
+
+    # literal positions: the GROUP BY expression must be identical to the selected one for MySQL (ONLY_FULL_GROUP_BY)
+    key = AccountTable.user_id if group_by == GROUP_BY_USER else \
+        func.substr(AccountTable.number, literal_column("1"), literal_column("2"))
+    query = select(key, *aggregates).group_by(key).order_by(key)
+    if after is not None:
+        query = query.where(key > (int(after) if group_by == GROUP_BY_USER else after))
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def _row_to_stats(row, grouped: bool) -> BalanceStats:
+    """
+    Converts a row of the statistics query to a BalanceStats
+    :param row: the row, starting with the group key if grouped
+    :param grouped: true if the query is grouped
+    """
+
+    values = tuple(row)
+    key, values = (values[0], values[1:]) if grouped else (None, values)
+    count, total, min_balance, max_balance = values[:4]
+    return BalanceStats(key=key, account_count=count, total=total, min_balance=min_balance, max_balance=max_balance,
+                        buckets=dict(zip(_bucket_labels(), values[4:])))
+
+
+def _store_stats(cache_key, stats: List[BalanceStats]):
+    if settings.stats_cache_ttl > 0:
+        stats_cache.put(cache_key, stats, settings.stats_cache_ttl)
+
+
+def _select_accounts(user_id, after: str = None, limit: int = None, columns: bool = False):
+    """
+    Builds the query listing the accounts. When a page is requested, the accounts are sorted by number
+    and the page starts right after the provided number, so that every page is an index range scan
+    :param user_id: the user ID to whom the accounts belong, None for everybody's accounts
+    :param after: only selects the accounts whose number is greater than this one
+    :param limit: maximum number of accounts to select
+    :param columns: selects the columns converted by _row_to_dict instead of ORM entities
+    :return: the SELECT statement
+    """
+
+    query = select(*_ACCOUNT_COLUMNS) if columns else select(AccountTable)
+    if user_id is not None:  # if user_id is not specified, it retrieves everybody's accounts
+        query = query.where(AccountTable.user_id == user_id)
+    if after is not None or limit is not None:
+        query = query.order_by(AccountTable.number)
+    if after is not None:
+        query = query.where(AccountTable.number > after)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+_ACCOUNT_COLUMNS = (AccountTable.number, AccountTable.total_balance, AccountTable.user_id)
+
+
+def _row_to_dict(row) -> dict:
+    """
+    Converts a (number, balance, user_id) row to the dictionary of the Account model fields
+    """
+
+    number, balance, user_id = row
+    return {"number": number, "balance": balance, "user_id": user_id}
 
 
 def _convert_to_pojo(account: AccountTable) -> AccountPOJO:
@@ -79,7 +341,7 @@ def _convert_to_pojo(account: AccountTable) -> AccountPOJO:
     if account is None:
         return None
 
-    return AccountPOJO(number=account.number, balance=account.balance, user_id=account.user_id)
+    return AccountPOJO(number=account.number, balance=account.total_balance, user_id=account.user_id)
 
 
 def _convert_to_sql(acc: AccountPOJO) -> AccountTable:
@@ -0,0 +1,186 @@
+from datetime import datetime
+from typing import List, AsyncIterator, Optional
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from pojo.account import Account as AccountPOJO, BalanceSummary, BalanceStats
+from dao.async_idempotency_dao import save_record
+from dao.async_user_dao import get_user
+from dao.account_dao import _convert_to_pojo, _convert_to_sql, _select_accounts, _row_to_dict, _select_summary, \
+    _row_to_summary, _select_stats, _row_to_stats, _store_stats, stats_cache, _existing_users_statements, \
+    _used_numbers_statements, _check_accounts
+from dao.ledger_dao import open_balance, _checkpoints
+from db.database import get_async_read_db, on_primary, use_async_db, use_async_read_db, STREAM_BATCH_SIZE
+from db.tables.account import Account as AccountTable
+from db.tables.ledger import BalanceCheckpoint
+from util.messages import *
+from util.entity_cache import account_cache
+from util.util import validate_account_number
+from util.retry import retry_transaction
+
+
+async def get_accounts(user_id, after: str = None, limit: int = None,
+                       session: AsyncSession = None) -> List[AccountPOJO]:
+    """
+    Returns the accounts information based on a given user ID, optionally one page at a time
+    (asyncio version of account_dao.get_accounts)
+    :param user_id: the user ID to whom the accounts belong.
+    :param after: only returns the accounts whose number is greater than this one
+    (number of the last account of the previous page)
+    :param limit: maximum number of accounts to return
+    :param session: the session of the caller, a new session is used if None
+    :return: the list of accounts
+    """
+
+    async with use_async_read_db(session) as session:
+        accounts = await session.scalars(_select_accounts(user_id, after, limit))
+        return [_convert_to_pojo(account) for account in accounts]
+
+
+async def get_account_rows(user_id, after: str = None, limit: int = None,
+                           session: AsyncSession = None) -> List[dict]:
+    """
+    Returns the accounts as plain dictionaries read with a column-only query
+    (asyncio version of account_dao.get_account_rows)
+    :param user_id: the user ID to whom the accounts belong, None for everybody's accounts
+    :param after: only returns the accounts whose number is greater than this one
+    :param limit: maximum number of accounts to return
+    :param session: the session of the caller, a new session is used if None
+    :return: the list of accounts, with the fields of the Account model
+    """
+
+    async with use_async_read_db(session) as session:
+        rows = await session.execute(_select_accounts(user_id, after, limit, columns=True))
+        return [_row_to_dict(row) for row in rows]
+
+
+async def stream_accounts(user_id, after: str = None, limit: int = None) -> AsyncIterator[dict]:
+    """
+    Iterates over the accounts with a server-side cursor, so that memory stays flat whatever the table size.
+    The accounts are read with a column-only query and returned as plain dictionaries.
+    The stream uses its own session since it outlives the request handler
+    :param user_id: the user ID to whom the accounts belong, None for everybody's accounts
+    :param after: only returns the accounts whose number is greater than this one
+    :param limit: maximum number of accounts to return, all of them if None
+    :return: an asynchronous iterator of accounts, with the fields of the Account model
+    """
+
+    session = get_async_read_db()
+    try:
+        query = _select_accounts(user_id, after, limit, columns=True).execution_options(yield_per=STREAM_BATCH_SIZE)
+        async for row in await session.stream(query):
+            yield _row_to_dict(row)
+    finally:
+        await session.close()
+
+
+@retry_transaction
+async def create_account(account: AccountPOJO, session: AsyncSession = None, idempotency_record=None):
+    """
+    Creates a new account (asyncio version of account_dao.create_account)
+    :param account: information of the account to create and the owner (user) ID
+    :param session: the session of the caller, a new session is used if None
+    :param idempotency_record: record of the idempotency key of the request, inserted in the same transaction
+    :raises: BankingException: the user ID is unknown or the account number to create is already used
+    """
+
+    if validate_account_number(account.number) is False:
+        raise BankingException(INVALID_ACCOUNT_NUMBER)
+
+    async with use_async_db(session) as session:
+        await get_user(account.user_id, session)  # raises a BankingException if the user ID is unknown
+
+        if await get_account(account.number, session) is not None:
+            raise BankingException(ALREADY_USED_ACCOUNT_NUMBER)
+
+        session.add(_convert_to_sql(account))
+        await session.flush()  # the account row is inserted before its opening checkpoint
+        open_balance(session, account.number, account.balance)
+        if idempotency_record is not None:
+            await save_record(idempotency_record, session)
+        await session.commit()
+    account_cache.invalidate(account.number)  # discards the cached absence of the account
+
+
+@retry_transaction
+async def create_accounts(accounts: List[AccountPOJO], session: AsyncSession = None) -> List[Optional[str]]:
+    """
+    Creates a list of accounts in a single database transaction, with set-based checks
+    (asyncio version of account_dao.create_accounts)
+    :param accounts: the accounts to create
+    :param session: the session of the caller, a new session is used if None
+    :return: for each account, None if it was created or the error message explaining why it was refused
+    """
+
+    async with use_async_db(session) as session:
+        user_ids, used_numbers = set(), set()
+        for statement in _existing_users_statements(accounts):
+            user_ids.update(await session.scalars(statement))
+        for statement in _used_numbers_statements(accounts):
+            used_numbers.update(await session.scalars(statement))
+
+        results, accepted = _check_accounts(accounts, user_ids, used_numbers)
+        if accepted:
+            try:
+                await session.execute(insert(AccountTable), [account.dict() for account in accepted])
+                await session.execute(insert(BalanceCheckpoint),
+                                      _checkpoints({account.number: account.balance for account in accepted},
+                                                   datetime.utcnow()))
+                await session.commit()
+            except Exception:
+                await session.rollback()
+                raise
+    account_cache.invalidate(*[account.number for account in accepted])  # discards the cached absences
+    return results
+
+
+async def get_account(number: str, session: AsyncSession = None) -> AccountPOJO:
+    """
+    Retrieves information of a given account number (asyncio version of account_dao.get_account)
+    :param number: the account number
+    :param session: the session of the caller, a new session is used if None
+    :return: the account information or None if the account number does not exist
+    """
+
+    found, account, version = account_cache.lookup(number)
+    if not found:
+        async with use_async_db(on_primary(session)) as session:
+            account = _convert_to_pojo(await session.get(AccountTable, number))
+        account_cache.store(number, version, account)
+    return account
+
+
+async def get_user_summary(user_id: int, session: AsyncSession = None) -> BalanceSummary:
+    """
+    Returns the account count, total, lowest and highest balance of a user
+    (asyncio version of account_dao.get_user_summary)
+    :param user_id: the user ID
+    :param session: the session of the caller, a new session is used if None
+    :return: the summary
+    :raises BankingException: the user ID is unknown
+    """
+
+    async with use_async_read_db(session) as session:
+        await get_user(user_id, session)  # raises a BankingException if the user ID is unknown
+        return _row_to_summary(user_id, (await session.execute(_select_summary(user_id))).one())
+
+
+async def get_balance_stats(group_by: str = None, after: str = None, limit: int = None,
+                            session: AsyncSession = None) -> List[BalanceStats]:
+    """
+    Returns the balance totals and distribution of the accounts, computed with a GROUP BY in the database
+    (asyncio version of account_dao.get_balance_stats)
+    :param group_by: GROUP_BY_USER, GROUP_BY_COUNTRY or None for the whole bank
+    :param after: only returns the groups whose key is greater than this one
+    :param limit: maximum number of groups to return
+    :param session: the session of the caller, a new session is used if None
+    :return: the statistics of each group, sorted by key
+    """
+
+    cache_key = (group_by, after, limit)
+    found, stats = stats_cache.lookup(cache_key)
+    if not found:
+        async with use_async_read_db(session) as session:
+            rows = await session.execute(_select_stats(group_by, after, limit))
+            stats = [_row_to_stats(row, group_by is not None) for row in rows]
+        _store_stats(cache_key, stats)
+    return stats
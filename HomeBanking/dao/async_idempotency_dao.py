@@ -0,0 +1,34 @@
+from typing import Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from db.database import use_async_db
+from db.tables.idempotency import IdempotencyKey as IdempotencyKeyTable
+from dao.idempotency_dao import _expired, _insert_statement, _replace_expired_statement, _stored_response
+from util.messages import *
+
+
+async def get_response(key: str, request_hash: str, session: AsyncSession = None) -> Optional[dict]:
+    """
+    Looks up the response of a request already executed with an idempotency key
+    (asyncio version of idempotency_dao.get_response)
+    :param key: the idempotency key
+    :param request_hash: the hash of the request
+    :param session: the session of the caller, a new session is used if None
+    :return: the stored response or None if the key is unknown or expired
+    :raises BankingException: the key was used by a different request
+    """
+
+    async with use_async_db(session) as session:
+        record = await session.get(IdempotencyKeyTable, key)
+        return None if _expired(record) else _stored_response(record, request_hash)
+
+
+async def save_record(record: IdempotencyKeyTable, session: AsyncSession):
+    """
+    Records an idempotency key in the transaction of the request executed with it
+    (asyncio version of idempotency_dao.save_record)
+    :param record: the record built by new_record
+    :param session: the session of the transaction of the request
+    """
+
+    if (await session.execute(_replace_expired_statement(record))).rowcount == 0:
+        await session.execute(_insert_statement(record))
@@ -0,0 +1,28 @@
+from datetime import datetime
+from sqlalchemy.ext.asyncio import AsyncSession
+from db.database import use_async_db, use_async_read_db
+from dao.ledger_dao import _naive_utc, _select_current_balance, _select_checkpoint, _select_balance
+from pojo.account import Balance as BalancePOJO
+from util.messages import *
+
+
+async def get_balance(number: str, as_of: datetime = None, session: AsyncSession = None) -> BalancePOJO:
+    """
+    Returns the balance of an account at a given date (asyncio version of ledger_dao.get_balance)
+    :param number: the account number
+    :param as_of: the date (UTC), now if None
+    :param session: the session of the caller, a new session is used if None
+    :return: the balance
+    :raises BankingException: the account number is unknown
+    """
+
+    as_of = _naive_utc(as_of)
+    async with use_async_read_db(session) as session:
+        if as_of is None:
+            balance = (await session.execute(_select_current_balance(number))).scalar()
+        else:
+            checkpoint = (await session.execute(_select_checkpoint(number, as_of))).first()
+            balance = (await session.execute(_select_balance(number, as_of, checkpoint))).scalar()
+        if balance is None:
+            raise BankingException(UNKNOWN_ACCOUNT)
+        return BalancePOJO(number=number, balance=balance, as_of=as_of or datetime.utcnow())
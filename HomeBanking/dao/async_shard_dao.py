@@ -0,0 +1,54 @@
+from typing import Dict
+from sqlalchemy.ext.asyncio import AsyncSession
+from db.database import use_async_db
+from db.variables import settings
+from dao.shard_dao import HOT_ACCOUNTS, hot_accounts_cache, _select_hot_accounts, _lock_account_statement, \
+    _lock_shards_statement, _reshard_statements
+from util.entity_cache import account_cache
+from util.messages import *
+from util.retry import retry_transaction
+
+
+async def hot_accounts(session: AsyncSession = None) -> Dict[str, int]:
+    """
+    Returns the hot accounts, i.e. the accounts whose balance is split into shards
+    (asyncio version of shard_dao.hot_accounts)
+    :param session: the session of the caller, a new session is used if None
+    :return: the number of shards indexed by account number
+    """
+
+    found, hot = hot_accounts_cache.lookup(HOT_ACCOUNTS)
+    if not found:
+        async with use_async_db(session) as session:
+            hot = dict((await session.execute(_select_hot_accounts())).all())
+        hot_accounts_cache.put(HOT_ACCOUNTS, hot)
+    return hot
+
+
+@retry_transaction
+async def set_shard_count(number: str, count: int, session: AsyncSession = None):
+    """
+    Splits the balance of an account into shards (asyncio version of shard_dao.set_shard_count)
+    :param number: the account number
+    :param count: the number of shards, 0 turning the account back into a regular account
+    :param session: the session of the caller, a new session is used if None
+    :raises BankingException: the account number is unknown or the number of shards is out of range
+    """
+
+    if not 0 <= count <= settings.max_shards:
+        raise BankingException(INVALID_SHARD_COUNT % settings.max_shards)
+
+    async with use_async_db(session) as session:
+        base = (await session.execute(_lock_account_statement(number))).scalar()
+        if base is None:
+            raise BankingException(UNKNOWN_ACCOUNT)
+        total = base + sum(row.balance for row in await session.execute(_lock_shards_statement(number)))
+        try:
+            for statement in _reshard_statements(number, total, count):
+                await session.execute(*statement)
+            await session.commit()
+            hot_accounts_cache.clear()
+            account_cache.invalidate(number)
+        except Exception:
+            await session.rollback()
+            raise
@@ -0,0 +1,196 @@
+from datetime import datetime
+from typing import List, Optional
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from db.database import use_async_db, use_async_read_db
+from db.tables.account import Account as AccountTable
+from db.tables.ledger import LedgerEntry
+from dao.ledger_dao import _entries
+from dao.async_shard_dao import hot_accounts
+from dao.async_account_dao import get_account
+from dao.async_idempotency_dao import get_response, save_record
+from dao.transaction_dao import _involved_accounts, _check_batch, _check_transfer, _balance_deltas, \
+    _lock_statements, _lock_shard_statement, _read_locked_rows, _update_statements, _convert_to_dicts, \
+    _select_transfers, QUEUED_KEY_PREFIX, QUEUED_REQUEST_HASH
+from util.messages import *
+from util.entity_cache import account_cache
+from util.retry import retry_transaction
+from pojo.transaction import Transaction as TransactionPOJO, DIRECTION_ALL
+from db.tables.transaction import Transaction as TransactionTable
+
+
+@retry_transaction
+async def transfer(transaction: TransactionPOJO, session: AsyncSession = None, idempotency_record=None):
+    """
+    Transfers money from an account to another (asyncio version of transaction_dao.transfer)
+    :param transaction: contains the source and destination account numbers as well as the amount in EURO to transfer
+    :param session: the session of the caller, a new session is used if None
+    :param idempotency_record: record of the idempotency key of the request, inserted in the same transaction
+    :raises BankingException: the amount to transfer is negative or the account numbers are unknown
+    """
+
+    async with use_async_db(session) as session:
+        balances, shards, targets = await _lock_transfer(session, transaction, await hot_accounts(session))
+        _check_transfer(transaction, balances)
+
+        try:
+            await _apply_balance_deltas(session, _balance_deltas([transaction]), balances, shards, targets)
+            await session.execute(insert(TransactionTable), _convert_to_dicts([transaction]))
+            await _record_transfers(session, [transaction])
+            if idempotency_record is not None:
+                await save_record(idempotency_record, session)
+            # Validates the transaction
+            await session.commit()
+            account_cache.invalidate(transaction.from_acc, transaction.to_acc)
+
+        except Exception:
+            # In case of error, the transaction is cancelled
+            await session.rollback()
+            raise
+
+
+@retry_transaction
+async def transfer_batch(transactions: List[TransactionPOJO],
+                         session: AsyncSession = None) -> List[Optional[str]]:
+    """
+    Executes a list of transfers in a single database transaction (asyncio version of transaction_dao.transfer_batch)
+    :param transactions: the transfers to execute, in execution order
+    :param session: the session of the caller, a new session is used if None
+    :return: for each transfer, None if it was executed or the error message explaining why it was refused
+    """
+
+    async with use_async_db(session) as session:
+        balances, shards = await _lock_accounts(session, _involved_accounts(transactions), await hot_accounts(session))
+
+        results, accepted = _check_batch(transactions, dict(balances))
+        if accepted:
+            try:
+                await _apply_balance_deltas(session, _balance_deltas(accepted), balances, shards)
+                await session.execute(insert(TransactionTable), _convert_to_dicts(accepted))
+                await _record_transfers(session, accepted)
+                await session.commit()
+                account_cache.invalidate(*_involved_accounts(accepted))
+            except Exception:
+                await session.rollback()
+                raise
+        return results
+
+
+async def check_queued_transfer(transaction: TransactionPOJO, session: AsyncSession = None):
+    """
+    Checks a transfer before queuing it: the amount and the existence of the accounts, usually read from the entity
+    cache (the balance is checked when the queued transfer is executed)
+    :param transaction: the transfer to check
+    :param session: the session of the caller, a new session is used if None
+    :raises BankingException: the amount to transfer is negative or the account numbers are unknown
+    """
+
+    if transaction.amount < 0:
+        raise BankingException(NEGATIVE_AMOUNT)
+    if await get_account(transaction.from_acc, session) is None:
+        raise BankingException(UNKNOWN_FROM_ACCOUNT)
+    if await get_account(transaction.to_acc, session) is None:
+        raise BankingException(UNKNOWN_TO_ACCOUNT)
+
+
+async def get_queued_status(transfer_id: str, session: AsyncSession = None) -> Optional[dict]:
+    """
+    Returns the status recorded with a queued transfer once executed (kept as long as the idempotency keys)
+    :param transfer_id: the ID returned when the transfer was queued
+    :param session: the session of the caller, a new session is used if None
+    :return: the status (id, status and detail if it was refused), None if the transfer is unknown or not executed
+    """
+
+    return await get_response(QUEUED_KEY_PREFIX + transfer_id, QUEUED_REQUEST_HASH, session)
+
+
+async def get_transfers(number: str, date_from: datetime = None, date_to: datetime = None,
+                        direction: str = DIRECTION_ALL, after: int = None, limit: int = 50,
+                        session: AsyncSession = None) -> List[TransactionPOJO]:
+    """
+    Returns the history of an account, most recent transfers first, one page at a time
+    (asyncio version of transaction_dao.get_transfers)
+    :param number: the account number
+    :param date_from: only returns the transfers performed from this date (included)
+    :param date_to: only returns the transfers performed before this date (excluded)
+    :param direction: in (received transfers), out (sent transfers) or all
+    :param after: ID of the last transfer of the previous page
+    :param limit: maximum number of transfers to return
+    :param session: the session of the caller, a new session is used if None
+    :return: the list of transfers
+    :raises BankingException: the account number is unknown
+    """
+
+    async with use_async_read_db(session) as session:
+        result = await session.execute(_select_transfers(number, date_from, date_to, direction, after, limit))
+        transfers = [TransactionPOJO(**row._mapping) for row in result]
+        if not transfers and await session.get(AccountTable, number) is None:
+            raise BankingException(UNKNOWN_ACCOUNT)
+        return transfers
+
+
+async def _lock_transfer(session, transaction: TransactionPOJO, hot: dict):
+    """
+    Locks the accounts of a single transfer, in account number order (asyncio version of
+    transaction_dao._lock_transfer)
+    :param session: the current database session
+    :param transaction: the transfer
+    :param hot: the shard count of the hot accounts
+    :return: the balances, the balances of the shards of the swept hot accounts and the locked shard of the other
+    hot accounts, indexed by account number
+    """
+
+    numbers = {transaction.from_acc, transaction.to_acc}
+    if not numbers & hot.keys():
+        return await _lock_accounts(session, numbers) + ({},)
+
+    balances, shards, targets = {}, {}, {}
+    for number in sorted(numbers):
+        statement = _lock_shard_statement(transaction, number, hot)
+        row = (await session.execute(statement)).first() if statement is not None else None
+        if row is not None:
+            targets[number], balances[number] = row
+            continue
+        for statement in _lock_statements([number], hot):
+            _read_locked_rows(await session.execute(statement), balances, shards)
+    return balances, shards, targets
+
+
+async def _lock_accounts(session, numbers, hot: dict = None):
+    """
+    Reads and locks the balances of the given accounts, in account number order
+    :param session: the current database session
+    :param numbers: the account numbers to lock
+    :param hot: the shard count of the hot accounts, whose shards are locked as well
+    :return: the locked balances and the balances of the shards of the hot accounts, indexed by account number
+    """
+
+    balances, shards = {}, {}
+    for statement in _lock_statements(numbers, hot):
+        _read_locked_rows(await session.execute(statement), balances, shards)
+    return balances, shards
+
+
+async def _apply_balance_deltas(session, deltas: dict, balances: dict = None, shards: dict = None,
+                                targets: dict = None):
+    """
+    Applies balance changes to several accounts
+    :param session: the current database session
+    :param deltas: the balance change indexed by account number
+    :param balances: the locked balances indexed by account number
+    :param shards: the balances of the shards of the swept hot accounts indexed by account number
+    :param targets: the locked shard of the other hot accounts indexed by account number
+    """
+
+    for statement in _update_statements(deltas, balances, shards, targets):
+        await session.execute(statement)
+
+
+async def _record_transfers(session, transactions: List[TransactionPOJO]):
+    """
+    Appends the debit and credit entries of executed transfers to the ledger
+    :param session: the current database session
+    :param transactions: the executed transfers
+    """
+
+    await session.execute(insert(LedgerEntry), _entries(transactions, datetime.utcnow()))
@@ -0,0 +1,218 @@
+from typing import List, AsyncIterator, Optional
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from pojo.user import User as UserPOJO, GEOCODING_PENDING
+from pojo.user import BaseUser
+from db.database import get_async_read_db, on_primary, use_async_db, use_async_read_db, STREAM_BATCH_SIZE
+from db.tables.user import User as UserTable, ImportJob as ImportJobTable
+from dao.user_dao import _convert_to_pojo, _convert_to_sql, _select_users, _row_to_dict, _select_nearby_users, \
+    _nearest, _pending_rows, _select_imported_ids, _count_pending_users, _convert_import_job_to_sql, \
+    _convert_import_job
+from util.messages import *
+from util.entity_cache import user_cache
+from util.retry import retry_transaction
+from util.user_import import ImportJob
+from workers.geocoding_worker import geocoding_worker
+
+
+async def get_users(after: int = None, limit: int = None, session: AsyncSession = None) -> List[UserPOJO]:
+    """
+    Returns the list of users, optionally one page at a time (asyncio version of user_dao.get_users)
+    :param after: only returns the users whose ID is greater than this one (ID of the last user of the previous page)
+    :param limit: maximum number of users to return
+    :param session: the session of the caller, a new session is used if None
+    :return: List[User]
+    """
+
+    async with use_async_read_db(session) as session:
+        users = await session.scalars(_select_users(after, limit))
+        return [_convert_to_pojo(user) for user in users]
+
+
+async def get_user_rows(after: int = None, limit: int = None, session: AsyncSession = None) -> List[dict]:
+    """
+    Returns the list of users as plain dictionaries read with a column-only query
+    (asyncio version of user_dao.get_user_rows)
+    :param after: only returns the users whose ID is greater than this one (ID of the last user of the previous page)
+    :param limit: maximum number of users to return
+    :param session: the session of the caller, a new session is used if None
+    :return: the list of users, with the fields of the User model
+    """
+
+    async with use_async_read_db(session) as session:
+        rows = await session.execute(_select_users(after, limit, columns=True))
+        return [_row_to_dict(row) for row in rows]
+
+
+async def stream_users(after: int = None, limit: int = None) -> AsyncIterator[dict]:
+    """
+    Iterates over the users with a server-side cursor, so that memory stays flat whatever the table size.
+    The users are read with a column-only query and returned as plain dictionaries.
+    The stream uses its own session since it outlives the request handler
+    :param after: only returns the users whose ID is greater than this one
+    :param limit: maximum number of users to return, all of them if None
+    :return: an asynchronous iterator of users, with the fields of the User model
+    """
+
+    session = get_async_read_db()
+    try:
+        query = _select_users(after, limit, columns=True).execution_options(yield_per=STREAM_BATCH_SIZE)
+        rows = await session.stream(query)
+        async for row in rows:
+            yield _row_to_dict(row)
+    finally:
+        await session.close()
+
+
+async def get_nearby_users(latitude: float, longitude: float, radius_km: float, limit: int = 50,
+                           session: AsyncSession = None) -> List[dict]:
+    """
+    Returns the located users within a distance of a location, nearest first
+    (asyncio version of user_dao.get_nearby_users)
+    :param latitude: latitude of the location in degrees
+    :param longitude: longitude of the location in degrees
+    :param radius_km: maximum distance in kilometers
+    :param limit: maximum number of users to return
+    :param session: the session of the caller, a new session is used if None
+    :return: the users as dictionaries (fields of the User model and distance_km)
+    """
+
+    async with use_async_read_db(session) as session:
+        query = _select_nearby_users(latitude, longitude, radius_km, limit, session.bind.dialect.name)
+        return _nearest(await session.execute(query), latitude, longitude, radius_km, limit)
+
+
+async def get_user(user_id: int, session: AsyncSession = None) -> UserPOJO:
+    """
+    Returns the user information based on a given user ID (asyncio version of user_dao.get_user)
+    :param user_id: ID of the user
+    :param session: the session of the caller, a new session is used if None
+    :return: the user information
+    :rtype: User
+    :raises BankingException: the provided user ID is unknown
+    """
+
+    found, res, version = user_cache.lookup(user_id)
+    if not found:
+        async with use_async_db(on_primary(session)) as session:
+            res = _convert_to_pojo(await session.get(UserTable, user_id))
+        user_cache.store(user_id, version, res)
+    if res is None:
+        raise BankingException(UNKNOWN_USER_ID)
+    return res
+
+
+@retry_transaction
+async def create_user(user: BaseUser, session: AsyncSession = None) -> int:
+    """
+    Creates a new user (asyncio version of user_dao.create_user).
+    The geographical location is calculated afterwards by the background geocoding worker
+    :param user: the user information
+    :param session: the session of the caller, a new session is used if None
+    :return: the auto-generated user ID
+    """
+
+    async with use_async_db(session) as session:
+        u = _convert_to_sql(UserPOJO(coordinates=None, geocoding_status=GEOCODING_PENDING, **user.dict()))
+        session.add(u)
+        await session.flush()  # Required to retrieve the auto-generated ID
+        new_user_id = u.id  # Retrieves the user ID
+        await session.commit()
+    user_cache.invalidate(new_user_id)  # discards the cached absence of the user
+
+    geocoding_worker.submit(new_user_id)  # Calculates the geographical location in background
+    return new_user_id
+
+
+@retry_transaction
+async def modify_user(user_id: int, user: BaseUser, session: AsyncSession = None):
+    """
+    Updates an existing user, the geographical position being re-calculated in background if the address has changed
+    (asyncio version of user_dao.modify_user)
+    :param user_id: the ID of the user to modify
+    :param user: the new user information
+    :param session: the session of the caller, a new session is used if None
+    :raises BankingException: the provided user ID is unknown
+    """
+
+    address_changed = False
+    async with use_async_db(session) as session:
+        old_user = await session.get(UserTable, user_id)
+
+        if old_user:
+            if user.firstname:
+                old_user.firstname = user.firstname
+            if user.lastname:
+                old_user.lastname = user.lastname
+            if user.address and old_user.address != user.address:
+                old_user.address = user.address
+                old_user.coordinates = None
+                old_user.geohash = None
+                old_user.geocoding_status = GEOCODING_PENDING
+                old_user.geocoding_attempts = 0
+                address_changed = True
+            await session.commit()
+        else:
+            raise BankingException(UNKNOWN_USER_ID)
+    user_cache.invalidate(user_id)
+
+    if address_changed:
+        geocoding_worker.submit(user_id)
+
+
+@retry_transaction
+async def insert_users(users: List[BaseUser], job_id: str, after: int = None,
+                       session: AsyncSession = None) -> List[int]:
+    """
+    Creates a chunk of users of a bulk import with one executemany INSERT
+    (asyncio version of user_dao.insert_users)
+    :param users: the users information
+    :param job_id: the ID of the import job
+    :param after: the last user ID of the previous chunks of the job, None for the first chunk
+    :param session: the session of the caller, a new session is used if None
+    :return: the IDs generated for the chunk
+    """
+
+    async with use_async_db(session) as session:
+        await session.execute(insert(UserTable), _pending_rows(users, job_id))
+        user_ids = list(await session.scalars(_select_imported_ids(job_id, after)))
+        await session.commit()
+    user_cache.invalidate(*user_ids)  # discards the cached absences of the users
+    return user_ids
+
+
+async def count_pending_users(job_id: str, session: AsyncSession = None) -> int:
+    """
+    Counts the users created by a bulk import whose geographical location is not calculated yet
+    (asyncio version of user_dao.count_pending_users)
+    :param job_id: the ID of the import job
+    :param session: the session of the caller, a new session is used if None
+    :return: the number of pending users
+    """
+
+    async with use_async_db(session) as session:
+        return (await session.execute(_count_pending_users(job_id))).scalar()
+
+
+async def save_import_job(job: ImportJob, session: AsyncSession = None):
+    """
+    Saves the progress of a bulk import, read by every worker (asyncio version of user_dao.save_import_job)
+    :param job: the import job
+    :param session: the session of the caller, a new session is used if None
+    """
+
+    async with use_async_db(session) as session:
+        await session.merge(_convert_import_job_to_sql(job))
+        await session.commit()
+
+
+async def get_import_job(job_id: str, session: AsyncSession = None) -> Optional[ImportJob]:
+    """
+    Returns the progress of a bulk import (asyncio version of user_dao.get_import_job)
+    :param job_id: the ID of the import job
+    :param session: the session of the caller, a new session is used if None
+    :return: the import job, None if the ID is unknown
+    """
+
+    async with use_async_db(session) as session:
+        return _convert_import_job(await session.get(ImportJobTable, job_id))
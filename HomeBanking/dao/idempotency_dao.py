@@ -0,0 +1,95 @@
+import json
+from datetime import datetime, timedelta
+from typing import Optional
+from sqlalchemy import delete, insert, update
+from sqlalchemy.orm import Session
+from db.database import use_db
+from db.tables.idempotency import IdempotencyKey as IdempotencyKeyTable
+from db.variables import settings
+from util.messages import *
+
+
+def new_record(key: str, request_hash: str, response: dict) -> IdempotencyKeyTable:
+    """
+    Builds the record of a request sent with an idempotency key, to be inserted by the DAO function executing the
+    request in the same transaction as its writes
+    :param key: the idempotency key
+    :param request_hash: the hash of the request
+    :param response: the response returned when the request succeeds
+    :return: the SQLAlchemy object to insert
+    """
+
+    return IdempotencyKeyTable(key=key, request_hash=request_hash, response=json.dumps(response),
+                               expires_at=datetime.utcnow() + timedelta(seconds=settings.idempotency_key_ttl))
+
+
+def get_response(key: str, request_hash: str, session: Session = None) -> Optional[dict]:
+    """
+    Looks up the response of a request already executed with an idempotency key (single primary key lookup)
+    :param key: the idempotency key
+    :param request_hash: the hash of the request
+    :param session: the session of the caller, a new session is used if None
+    :return: the stored response or None if the key is unknown or expired
+    :raises BankingException: the key was used by a different request
+    """
+
+    with use_db(session) as session:
+        record = session.get(IdempotencyKeyTable, key)
+        return None if _expired(record) else _stored_response(record, request_hash)
+
+
+def save_record(record: IdempotencyKeyTable, session: Session):
+    """
+    Records an idempotency key in the transaction of the request executed with it: the expired record of a reused
+    key is replaced by an UPDATE guarded by its expiry, the record is inserted otherwise. A key recorded
+    concurrently (and not expired) makes the INSERT fail with an IntegrityError
+    :param record: the record built by new_record
+    :param session: the session of the transaction of the request
+    """
+
+    if session.execute(_replace_expired_statement(record)).rowcount == 0:
+        session.execute(_insert_statement(record))
+
+
+def purge_expired(now: datetime = None, session: Session = None) -> int:
+    """
+    Deletes the expired idempotency keys with one bulk DELETE (range scan of the expiry index)
+    :param now: the current UTC date (defaults to now)
+    :param session: the session of the caller, a new session is used if None
+    :return: the number of deleted keys
+    """
+
+    with use_db(session) as session:
+        result = session.execute(delete(IdempotencyKeyTable)
+                                 .where(IdempotencyKeyTable.expires_at < (now or datetime.utcnow())))
+        session.commit()
+        return result.rowcount
+
+
+def _expired(record: IdempotencyKeyTable) -> bool:
+    return record is not None and record.expires_at <= datetime.utcnow()
+
+
+def _replace_expired_statement(record: IdempotencyKeyTable):
+    return (update(IdempotencyKeyTable)
+            .where(IdempotencyKeyTable.key == record.key, IdempotencyKeyTable.expires_at <= datetime.utcnow())
+            .values(request_hash=record.request_hash, response=record.response, expires_at=record.expires_at))
+
+
+def _insert_statement(record: IdempotencyKeyTable):
+    return insert(IdempotencyKeyTable).values(key=record.key, request_hash=record.request_hash,
+                                              response=record.response, expires_at=record.expires_at)
+
+
+def _stored_response(record: IdempotencyKeyTable, request_hash: str) -> Optional[dict]:
+    """
+    Checks the record of an idempotency key
+    :return: the stored response or None if the key is unknown
+    :raises BankingException: the key was used by a different request
+    """
+
+    if record is None:
+        return None
+    if record.request_hash != request_hash:
+        raise BankingException(IDEMPOTENCY_KEY_REUSED)
+    return json.loads(record.response)
@@ -0,0 +1,228 @@
+from datetime import datetime, timedelta, timezone
+from typing import List
+from sqlalchemy import and_, func, insert, literal, select
+from sqlalchemy.orm import Session
+from db.database import use_db, use_read_db
+from db.tables.account import Account as AccountTable
+from db.tables.ledger import LedgerEntry, BalanceCheckpoint
+from db.variables import settings
+from pojo.account import Balance as BalancePOJO
+from pojo.transaction import Transaction as TransactionPOJO
+from util.messages import *
+
+# date of the opening checkpoints of the accounts created before the ledger (their creation date is unknown)
+PRE_LEDGER_DATE = datetime(1970, 1, 1)
+
+
+def record_transfers(session, transactions: List[TransactionPOJO]):
+    """
+    Appends the debit and credit entries of executed transfers to the ledger, in the transaction of the caller
+    :param session: the current database session
+    :param transactions: the executed transfers
+    """
+
+    session.execute(insert(LedgerEntry), _entries(transactions, datetime.utcnow()))
+
+
+def open_balance(session, number: str, balance: float):
+    """
+    Writes the opening checkpoint of a new account, in the transaction of the caller
+    :param session: the current database session
+    :param number: the account number
+    :param balance: the initial balance in EURO
+    """
+
+    session.add(BalanceCheckpoint(account_number=number, date=datetime.utcnow(), balance=balance))
+
+
+def open_balances(session, balances: dict):
+    """
+    Writes the opening checkpoints of new accounts with one bulk INSERT, in the transaction of the caller
+    :param session: the current database session
+    :param balances: the initial balance in EURO indexed by account number
+    """
+
+    if balances:
+        session.execute(insert(BalanceCheckpoint), _checkpoints(balances, datetime.utcnow()))
+
+
+def get_balance(number: str, as_of: datetime = None, session: Session = None) -> BalancePOJO:
+    """
+    Returns the balance of an account at a given date: the latest checkpoint before this date plus
+    the ledger entries written between the checkpoint and the date
+    :param number: the account number
+    :param as_of: the date (UTC), now if None
+    :param session: the session of the caller, a new session is used if None
+    :return: the balance
+    :raises BankingException: the account number is unknown
+    """
+
+    as_of = _naive_utc(as_of)
+    with use_read_db(session) as session:
+        if as_of is None:
+            balance = session.execute(_select_current_balance(number)).scalar()
+        else:
+            checkpoint = session.execute(_select_checkpoint(number, as_of)).first()
+            balance = session.execute(_select_balance(number, as_of, checkpoint)).scalar()
+        if balance is None:
+            raise BankingException(UNKNOWN_ACCOUNT)
+        return BalancePOJO(number=number, balance=balance, as_of=as_of or datetime.utcnow())
+
+
+def checkpoint_balances(cutoff: datetime = None, session: Session = None) -> int:
+    """
+    Writes a checkpoint for every account having ledger entries since its last checkpoint, so that the as-of balance
+    queries only sum the entries written after the latest checkpoint.
+    The entries of the last seconds (settings.checkpoint_delay) are left out since transactions still in progress
+    may append entries dated before the cutoff. The accounts created before the ledger, which have no opening
+    checkpoint, are given one first (see open_pre_ledger_balances)
+    :param cutoff: date (UTC) of the checkpoints, now minus the checkpoint delay if None
+    :param session: the session of the caller, a new session is used if None
+    :return: the number of checkpoints written
+    """
+
+    if cutoff is None:
+        cutoff = datetime.utcnow() - timedelta(seconds=settings.checkpoint_delay)
+    with use_db(session) as session:
+        open_pre_ledger_balances(session)
+        latest = _latest_checkpoints().subquery()
+        checkpoints = [{"account_number": number, "date": cutoff, "balance": balance + total}
+                       for number, balance, total in session.execute(_select_new_checkpoints(latest, cutoff))]
+        if checkpoints:
+            session.execute(insert(BalanceCheckpoint), checkpoints)
+        session.commit()
+        return len(checkpoints)
+
+
+def open_pre_ledger_balances(session) -> int:
+    """
+    Writes the opening checkpoint of the accounts created before the ledger, dated PRE_LEDGER_DATE, in the transaction
+    of the caller: their current balance minus every ledger entry written since, read by one statement so that
+    both are consistent
+    :param session: the current database session
+    :return: the number of checkpoints written
+    """
+
+    checkpoints = [{"account_number": number, "date": PRE_LEDGER_DATE, "balance": balance}
+                   for number, balance in session.execute(_select_pre_ledger_balances())]
+    if checkpoints:
+        session.execute(insert(BalanceCheckpoint), checkpoints)
+    return len(checkpoints)
+
+
+def _naive_utc(date: datetime):
+    """
+    :return: the date converted to a naive UTC datetime, as stored in the ledger (naive dates are assumed UTC)
+    """
+
+    if date is None or date.tzinfo is None:
+        return date
+    return date.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def _select_current_balance(number: str):
+    """
+    :return: the SELECT statement reading the current balance of an account
+    """
+
+    return select(AccountTable.total_balance).where(AccountTable.number == number)
+
+
+def _select_checkpoint(number: str, as_of: datetime):
+    """
+    :return: the SELECT statement reading the (date, balance) of the latest checkpoint of an account before a date
+    """
+
+    return (select(BalanceCheckpoint.date, BalanceCheckpoint.balance)
+            .where(BalanceCheckpoint.account_number == number, BalanceCheckpoint.date <= as_of)
+            .order_by(BalanceCheckpoint.date.desc())
+            .limit(1))
+
+
+def _select_balance(number: str, as_of: datetime, checkpoint):
+    """
+    Builds the query adding the ledger entries written after a checkpoint up to a date (index range scan on
+    (account_number, date)) to the checkpoint balance. Without checkpoint, the account did not exist at this date
+    and its balance is 0 (or None if the account is unknown)
+    :param number: the account number
+    :param as_of: the date (UTC)
+    :param checkpoint: the (date, balance) of the latest checkpoint before as_of, or None
+    :return: the SELECT statement returning the balance
+    """
+
+    if checkpoint is None:
+        return select(literal(0.0)).where(AccountTable.number == number)
+    total = (select(func.coalesce(func.sum(LedgerEntry.amount), 0.0))
+             .where(LedgerEntry.account_number == number,
+                    LedgerEntry.date > checkpoint.date,
+                    LedgerEntry.date <= as_of)
+             .scalar_subquery())
+    return select(checkpoint.balance + total)
+
+
+def _latest_checkpoints():
+    """
+    :return: the SELECT statement reading the latest checkpoint of every account
+    """
+
+    last = (select(BalanceCheckpoint.account_number, func.max(BalanceCheckpoint.date).label("date"))
+            .group_by(BalanceCheckpoint.account_number)
+            .subquery())
+    return (select(BalanceCheckpoint.account_number, BalanceCheckpoint.date, BalanceCheckpoint.balance)
+            .join(last, and_(BalanceCheckpoint.account_number == last.c.account_number,
+                             BalanceCheckpoint.date == last.c.date)))
+
+
+def _select_pre_ledger_balances():
+    """
+    :return: the SELECT statement returning the (account number, balance before the first ledger entry) rows of the
+    accounts without checkpoint
+    """
+
+    entries = (select(func.coalesce(func.sum(LedgerEntry.amount), 0.0))
+               .where(LedgerEntry.account_number == AccountTable.number)
+               .scalar_subquery())
+    return (select(AccountTable.number, AccountTable.total_balance - entries)
+            .where(~select(BalanceCheckpoint.account_number)
+                   .where(BalanceCheckpoint.account_number == AccountTable.number).exists()))
+
+
+def _select_new_checkpoints(latest, cutoff: datetime):
+    """
+    Builds the query summing, for every account, the ledger entries written between its latest checkpoint
+    and the cutoff (every account has a checkpoint, see open_pre_ledger_balances)
+    :param latest: the subquery of the latest checkpoints
+    :param cutoff: the date (UTC) of the new checkpoints
+    :return: the SELECT statement returning (account number, checkpoint balance, sum of the entries) rows
+    """
+
+    return (select(LedgerEntry.account_number, func.max(latest.c.balance), func.sum(LedgerEntry.amount))
+            .join(latest, LedgerEntry.account_number == latest.c.account_number)
+            .where(LedgerEntry.date <= cutoff, LedgerEntry.date > latest.c.date)
+            .group_by(LedgerEntry.account_number))
+
+
+def _entries(transactions: List[TransactionPOJO], date: datetime) -> List[dict]:
+    """
+    Converts transfers to the column values of the ledger entries bulk INSERT (one debit and one credit per transfer)
+    :param transactions: the transfers
+    :param date: the date (UTC) of the entries
+    :return: the list of column values
+    """
+
+    entries = []
+    for tr in transactions:
+        entries.append({"account_number": tr.from_acc, "amount": -tr.amount, "counterparty": tr.to_acc, "date": date})
+        entries.append({"account_number": tr.to_acc, "amount": tr.amount, "counterparty": tr.from_acc, "date": date})
+    return entries
+
+
+def _checkpoints(balances: dict, date: datetime) -> List[dict]:
+    """
+    Builds the opening checkpoints of new accounts
+    :param balances: the initial balance indexed by account number
+    :param date: the opening date (UTC)
+    :return: the bound values of the checkpoint rows
+    """
+
+    return [{"account_number": number, "date": date, "balance": balance} for number, balance in balances.items()]
@@ -0,0 +1,210 @@
+import math
+import random
+from typing import Dict
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.orm import Session
+from db.database import use_db
+from db.tables.account import Account as AccountTable, AccountShard
+from db.variables import settings
+from util.cache import TTLCache
+from util.entity_cache import account_cache
+from util.messages import *
+from util.retry import retry_transaction
+
+HOT_ACCOUNTS = "hot"
+hot_accounts_cache = TTLCache(1, settings.hot_accounts_refresh)  # shard count of the hot accounts, by account number
+
+
+def hot_accounts(session: Session = None) -> Dict[str, int]:
+    """
+    Returns the hot accounts, i.e. the accounts whose balance is split into shards. The list is read again every
+    settings.hot_accounts_refresh seconds, so a change made by another process is seen after this delay at most
+    (in the meantime, the transfers of a new hot account lock its row and the ones of a former hot account sweep it)
+    :param session: the session of the caller, a new session is used if None
+    :return: the number of shards indexed by account number
+    """
+
+    found, hot = hot_accounts_cache.lookup(HOT_ACCOUNTS)
+    if not found:
+        with use_db(session) as session:
+            hot = dict(session.execute(_select_hot_accounts()).all())
+        hot_accounts_cache.put(HOT_ACCOUNTS, hot)
+    return hot
+
+
+@retry_transaction
+def set_shard_count(number: str, count: int, session: Session = None):
+    """
+    Splits the balance of an account into shards (sub-balances), so that concurrent transfers credit and debit
+    different rows instead of all waiting for the lock of the account row. The balance is spread evenly over the
+    new shards, 0 shard turning the account back into a regular account
+    :param number: the account number
+    :param count: the number of shards
+    :param session: the session of the caller, a new session is used if None
+    :raises BankingException: the account number is unknown or the number of shards is out of range
+    """
+
+    if not 0 <= count <= settings.max_shards:
+        raise BankingException(INVALID_SHARD_COUNT % settings.max_shards)
+
+    with use_db(session) as session:
+        base = session.execute(_lock_account_statement(number)).scalar()
+        if base is None:
+            raise BankingException(UNKNOWN_ACCOUNT)
+        total = base + sum(row.balance for row in session.execute(_lock_shards_statement(number)))
+        try:
+            for statement in _reshard_statements(number, total, count):
+                session.execute(*statement)
+            session.commit()
+            hot_accounts_cache.clear()
+            account_cache.invalidate(number)
+        except Exception:
+            session.rollback()
+            raise
+
+
+def rebalance_shards(session: Session = None) -> int:
+    """
+    Spreads the balance of every hot account evenly over its shards again (the credits fill random shards and the
+    debits empty others), in one short transaction per account
+    :param session: the session of the caller, a new session is used if None
+    :return: the number of rebalanced accounts
+    """
+
+    with use_db(session) as session:
+        numbers = sorted(dict(session.execute(_select_hot_accounts()).all()))
+        session.commit()
+        rebalanced = 0
+        for number in numbers:
+            base = session.execute(_lock_account_statement(number)).scalar()
+            shards = [row.balance for row in session.execute(_lock_shards_statement(number))]
+            if base is None or not shards or _balanced(base, shards):
+                session.rollback()
+                continue
+            for statement in _distribute_statements(number, base + sum(shards), len(shards)):
+                session.execute(statement)
+            session.commit()
+            rebalanced += 1
+        return rebalanced
+
+
+def _select_hot_accounts():
+    """
+    :return: the SELECT statement reading the (number, shard count) of the hot accounts
+    """
+
+    return select(AccountShard.account_number, func.count()).group_by(AccountShard.account_number)
+
+
+def _lock_account_statement(number: str):
+    """
+    :return: the SELECT ... FOR UPDATE statement reading the base balance of an account
+    """
+
+    return select(AccountTable.balance).where(AccountTable.number == number).with_for_update()
+
+
+def _lock_shards_statement(number: str):
+    """
+    Builds the statement locking all the shards of an account, in shard order. With the account row locked first,
+    this is the lock order of every transaction sweeping a hot account
+    :return: the SELECT ... FOR UPDATE statement returning (account_number, shard, balance) rows
+    """
+
+    return select(AccountShard.account_number, AccountShard.shard, AccountShard.balance) \
+        .where(AccountShard.account_number == number) \
+        .order_by(AccountShard.shard) \
+        .with_for_update()
+
+
+def _credit_shard_statement(number: str, count: int):
+    """
+    Builds the statement locking a random shard of a hot account, to be credited
+    :param number: the account number
+    :param count: the number of shards of the account
+    :return: the SELECT ... FOR UPDATE statement returning a (shard, balance) row (none if the shard does not exist)
+    """
+
+    return select(AccountShard.shard, AccountShard.balance) \
+        .where(AccountShard.account_number == number, AccountShard.shard == random.randrange(count)) \
+        .with_for_update()
+
+
+def _debit_shard_statement(number: str, amount: float):
+    """
+    Builds the statement locking a shard of a hot account holding at least the amount to debit. The shards locked
+    by concurrent transfers are skipped instead of waited for (SKIP LOCKED)
+    :param number: the account number
+    :param amount: the amount to debit
+    :return: the SELECT ... FOR UPDATE statement returning a (shard, balance) row (none if no shard is available)
+    """
+
+    return select(AccountShard.shard, AccountShard.balance) \
+        .where(AccountShard.account_number == number, AccountShard.balance >= amount) \
+        .limit(1) \
+        .with_for_update(skip_locked=True)
+
+
+def _shard_update_statement(number: str, shard: int, delta: float):
+    """
+    :return: the UPDATE statement applying a balance change to a shard
+    """
+
+    return update(AccountShard) \
+        .where(AccountShard.account_number == number, AccountShard.shard == shard) \
+        .values(balance=AccountShard.balance + delta) \
+        .execution_options(synchronize_session=False)
+
+
+def _split(total: float, count: int):
+    """
+    Splits a balance into equal shards, rounded down to the cent
+    :return: the (base balance, shard balance) tuple, the base balance keeping the remaining cents
+    """
+
+    if count == 0:
+        return total, 0.0
+    part = math.floor(total * 100 / count) / 100
+    return total - part * count, part
+
+
+def _balanced(base: float, shards) -> bool:
+    """
+    :return: true if the balance of an account is already spread evenly over its shards
+    """
+
+    expected_base, part = _split(base + sum(shards), len(shards))
+    return base == expected_base and all(balance == part for balance in shards)
+
+
+def _distribute_statements(number: str, total: float, count: int):
+    """
+    Builds the UPDATE statements spreading the balance of a hot account evenly over its shards
+    (the account row and all its shards must be locked)
+    :param number: the account number
+    :param total: the balance of the account
+    :param count: the number of shards of the account
+    :return: the list of statements
+    """
+
+    base, part = _split(total, count)
+    return [update(AccountTable).where(AccountTable.number == number).values(balance=base)
+            .execution_options(synchronize_session=False),
+            update(AccountShard).where(AccountShard.account_number == number).values(balance=part)
+            .execution_options(synchronize_session=False)]
+
+
+def _reshard_statements(number: str, total: float, count: int):
+    """
+    Builds the statements replacing the shards of an account (the account row and all its shards must be locked)
+    :return: the list of (statement,) or (statement, parameters) tuples
+    """
+
+    base, part = _split(total, count)
+    statements = [(delete(AccountShard).where(AccountShard.account_number == number),)]
+    if count:
+        statements.append((insert(AccountShard), [{"account_number": number, "shard": shard, "balance": part}
+                                                  for shard in range(count)]))
+    statements.append((update(AccountTable).where(AccountTable.number == number).values(balance=base)
+                       .execution_options(synchronize_session=False),))
+    return statements
@@ -1,45 +1,436 @@
+from datetime import datetime
+from typing import Callable, List, Optional, Tuple
+from sqlalchemy import and_, case, insert, or_, select, union_all, update
 from db.tables.account import Account as AccountTable
-from db.database import get_db
+from sqlalchemy.orm import Session
+from db.database import use_db, use_read_db
+from dao.ledger_dao import record_transfers
+from dao.idempotency_dao import new_record, save_record, _stored_response
+from dao.shard_dao import hot_accounts, _credit_shard_statement, _debit_shard_statement, _lock_shards_statement, \
+    _shard_update_statement, _distribute_statements
 from util.messages import *
-from pojo.transaction import Transaction as TransactionPOJO
+from util.entity_cache import account_cache
+from util.retry import retry_transaction
+from pojo.transaction import Transaction as TransactionPOJO, DIRECTION_IN, DIRECTION_OUT, DIRECTION_ALL, \
+    TRANSFER_DONE, TRANSFER_FAILED
 from db.tables.transaction import Transaction as TransactionTable
+from db.tables.idempotency import IdempotencyKey as IdempotencyKeyTable
 
+IN_CHUNK_SIZE = 500  # maximum number of values in a single IN (...) list
+QUEUED_KEY_PREFIX = "transfer:"  # idempotency key recording the status of a queued transfer: prefix + transfer ID
+QUEUED_REQUEST_HASH = "queued-transfer"
 
-def transfer(transaction: TransactionPOJO):
+
+@retry_transaction
+def transfer(transaction: TransactionPOJO, session: Session = None, idempotency_record=None):
     """
-    Transfers money from an account to another
+    Transfers money from an account to another.
+    Both account rows are locked in a deterministic order (by account number) to avoid deadlocks between
+    concurrent transfers, and both balances are updated by a single guarded UPDATE statement.
+    The balance of a hot account is split into shards: a credit locks a random shard, a debit locks a shard holding
+    the amount (skipping the shards locked by other transfers) and only sweeps the whole account if there is none.
+    The debit and credit are appended to the ledger in the same transaction
     :param transaction: contains the source and destination account numbers as well as the amount in EURO to transfer
+    :param session: the session of the caller, a new session is used if None
+    :param idempotency_record: record of the idempotency key of the request, inserted in the same transaction
     :raises BankingException: the amount to transfer is negative or the account numbers are unknown
     """
 
-    session = get_db()
-    try:
-        if transaction.amount < 0:
-            raise BankingException(NEGATIVE_AMOUNT)
-
-        acc1 = session.query(AccountTable).filter(AccountTable.number == transaction.from_acc).first()
-        if acc1 is None:  # checks the source account existence
-            raise BankingException(UNKNOWN_FROM_ACCOUNT)
-        if acc1.balance < transaction.amount:  # checks that the amount to transfer is positive
-            raise BankingException(NOT_ENOUGH_MONEY)
-
-        acc2 = session.query(AccountTable).filter(AccountTable.number == transaction.to_acc).first()
-        if acc2 is None:  # checks the destination account existence
-            raise BankingException(UNKNOWN_TO_ACCOUNT)
+    with use_db(session) as session:
+        balances, shards, targets = _lock_transfer(session, transaction, hot_accounts(session))
+        _check_transfer(transaction, balances)
 
         try:
-
-            acc1.balance = acc1.balance - transaction.amount
-            acc2.balance = acc2.balance + transaction.amount
+            _apply_balance_deltas(session, _balance_deltas([transaction]), balances, shards, targets)
             session.add(__convert_to_sql(transaction))
+            record_transfers(session, [transaction])
+            if idempotency_record is not None:
+                save_record(idempotency_record, session)
             # Validates the transaction
             session.commit()
+            account_cache.invalidate(transaction.from_acc, transaction.to_acc)
 
-        except Exception as e:
+        except Exception:
             # In case of error, the transaction is cancelled
             session.rollback()
-    finally:
-        session.close()
+            raise
+
+
+@retry_transaction
+def transfer_batch(transactions: List[TransactionPOJO], session: Session = None,
+                   result_records: Callable[[List[Optional[str]]], list] = None) -> List[Optional[str]]:
+    """
+    Executes a list of transfers in a single database transaction.
+    All the involved accounts are loaded and locked with set-based queries, the transfers are checked in order
+    against the running balances and the accepted ones are written with one UPDATE and two bulk INSERTs
+    (transfers and ledger entries). The hot accounts are swept: all their shards are locked, and their balance
+    is spread evenly over the shards again.
+    A refused transfer does not prevent the next ones from being executed
+    :param transactions: the transfers to execute, in execution order
+    :param session: the session of the caller, a new session is used if None
+    :param result_records: builds the records to insert in the same transaction from the results of the transfers
+    :return: for each transfer, None if it was executed or the error message explaining why it was refused
+    """
+
+    with use_db(session) as session:
+        balances, shards = _lock_accounts(session, _involved_accounts(transactions), hot_accounts(session))
+
+        results, accepted = _check_batch(transactions, dict(balances))
+        records = result_records(results) if result_records is not None else []
+        if accepted or records:
+            try:
+                if accepted:
+                    _apply_balance_deltas(session, _balance_deltas(accepted), balances, shards)
+                    session.execute(insert(TransactionTable), _convert_to_dicts(accepted))
+                    record_transfers(session, accepted)
+                session.add_all(records)
+                session.commit()
+                account_cache.invalidate(*_involved_accounts(accepted))
+            except Exception:
+                session.rollback()
+                raise
+        return results
+
+
+@retry_transaction
+def transfer_queued(transfers: List[Tuple[str, TransactionPOJO]], session: Session = None) -> List[dict]:
+    """
+    Executes queued transfers in a single database transaction (group commit). The transfers are checked in order
+    like the ones of transfer_batch, and the status of each transfer is recorded in the same transaction, so that
+    a transfer executed before a crash is recognized and not executed again when its queue is replayed
+    :param transfers: the (transfer ID, transfer) tuples, in execution order
+    :param session: the session of the caller, a new session is used if None
+    :return: the status of each transfer (id, status and detail if it was refused)
+    """
+
+    with use_db(session) as session:
+        keys = [QUEUED_KEY_PREFIX + transfer_id for transfer_id, transaction in transfers]
+        recorded = {record.key: _stored_response(record, QUEUED_REQUEST_HASH) for record in
+                    session.scalars(select(IdempotencyKeyTable).where(IdempotencyKeyTable.key.in_(keys)))}
+        pending = [(transfer_id, transaction) for transfer_id, transaction in transfers
+                   if QUEUED_KEY_PREFIX + transfer_id not in recorded]
+        statuses = {}
+
+        def status_records(results: List[Optional[str]]) -> list:
+            for (transfer_id, transaction), error in zip(pending, results):
+                statuses[transfer_id] = _queued_status(transfer_id, error)
+            return [new_record(QUEUED_KEY_PREFIX + transfer_id, QUEUED_REQUEST_HASH, status)
+                    for transfer_id, status in statuses.items()]
+
+        if pending:
+            transfer_batch([transaction for transfer_id, transaction in pending], session, status_records)
+        return [statuses.get(transfer_id) or recorded[QUEUED_KEY_PREFIX + transfer_id]
+                for transfer_id, transaction in transfers]
+
+
+def fail_queued(transfer_id: str, detail: str, session: Session = None) -> dict:
+    """
+    Records a queued transfer which cannot be executed as failed (dead letter), unless it was executed meanwhile
+    :param transfer_id: the ID returned when the transfer was queued
+    :param detail: the reason of the failure
+    :param session: the session of the caller, a new session is used if None
+    :return: the status of the transfer
+    """
+
+    with use_db(session) as session:
+        record = session.get(IdempotencyKeyTable, QUEUED_KEY_PREFIX + transfer_id)
+        status = _stored_response(record, QUEUED_REQUEST_HASH) if record is not None else None
+        if status is None:
+            status = _queued_status(transfer_id, detail)
+            session.merge(new_record(QUEUED_KEY_PREFIX + transfer_id, QUEUED_REQUEST_HASH, status))
+            session.commit()
+        return status
+
+
+def get_transfers(number: str, date_from: datetime = None, date_to: datetime = None,
+                  direction: str = DIRECTION_ALL, after: int = None, limit: int = 50,
+                  session: Session = None) -> List[TransactionPOJO]:
+    """
+    Returns the history of an account, most recent transfers first, one page at a time
+    :param number: the account number
+    :param date_from: only returns the transfers performed from this date (included)
+    :param date_to: only returns the transfers performed before this date (excluded)
+    :param direction: in (received transfers), out (sent transfers) or all
+    :param after: ID of the last transfer of the previous page
+    :param limit: maximum number of transfers to return
+    :param session: the session of the caller, a new session is used if None
+    :return: the list of transfers
+    :raises BankingException: the account number is unknown
+    """
+
+    with use_read_db(session) as session:
+        transfers = [TransactionPOJO(**row._mapping)
+                     for row in session.execute(_select_transfers(number, date_from, date_to, direction, after, limit))]
+        if not transfers and session.get(AccountTable, number) is None:
+            raise BankingException(UNKNOWN_ACCOUNT)
+        return transfers
+
+
+def _select_transfers(number: str, date_from: datetime, date_to: datetime, direction: str, after: int, limit: int):
+    """
+    Builds the query of an account history page. Sent and received transfers are read by two index range scans
+    on (from_acc, date) and (to_acc, date), each one limited to the page size, then merged.
+    The page starts right after the transfer provided as cursor in the (date, id) descending order
+    :return: the SELECT statement
+    """
+
+    table = TransactionTable.__table__
+    conditions = []
+    if direction in (DIRECTION_OUT, DIRECTION_ALL):
+        conditions.append(table.c.from_acc == number)
+    if direction == DIRECTION_IN:
+        conditions.append(table.c.to_acc == number)
+    if direction == DIRECTION_ALL:
+        conditions.append(and_(table.c.to_acc == number, table.c.from_acc != number))  # self transfers only once
+
+    branches = []
+    for condition in conditions:
+        branch = select(table.c.id, table.c.amount, table.c.date, table.c.from_acc, table.c.to_acc).where(condition)
+        if date_from is not None:
+            branch = branch.where(table.c.date >= date_from)
+        if date_to is not None:
+            branch = branch.where(table.c.date < date_to)
+        if after is not None:
+            after_date = select(table.c.date).where(table.c.id == after).scalar_subquery()
+            branch = branch.where(or_(table.c.date < after_date,
+                                      and_(table.c.date == after_date, table.c.id < after)))
+        branches.append(branch.order_by(table.c.date.desc(), table.c.id.desc()).limit(limit))
+
+    if len(branches) == 1:
+        return branches[0]
+    merged = union_all(*[select(branch.subquery()) for branch in branches]).subquery()
+    return select(merged).order_by(merged.c.date.desc(), merged.c.id.desc()).limit(limit)
+
+
+def _queued_status(transfer_id: str, error: Optional[str]) -> dict:
+    """
+    :return: the status of a queued transfer, with the error message if it was refused
+    """
+
+    if error is None:
+        return {"id": transfer_id, "status": TRANSFER_DONE}
+    return {"id": transfer_id, "status": TRANSFER_FAILED, "detail": error}
+
+
+def _involved_accounts(transactions: List[TransactionPOJO]) -> set:
+    """
+    Returns the numbers of all the accounts involved in a list of transfers
+    :param transactions: the transfers
+    :return: the set of account numbers
+    """
+
+    numbers = set()
+    for transaction in transactions:
+        numbers.update((transaction.from_acc, transaction.to_acc))
+    return numbers
+
+
+def _check_batch(transactions: List[TransactionPOJO], balances: dict):
+    """
+    Checks a list of transfers in order against the running balances of the involved accounts
+    :param transactions: the transfers to check
+    :param balances: the current balances indexed by account number, updated with the accepted transfers
+    :return: the error message (or None) of each transfer and the list of accepted transfers
+    """
+
+    results = []
+    accepted = []
+    for transaction in transactions:
+        try:
+            _check_transfer(transaction, balances)
+        except BankingException as e:
+            results.append(str(e))
+            continue
+        for number, delta in _balance_deltas([transaction]).items():
+            balances[number] += delta
+        accepted.append(transaction)
+        results.append(None)
+    return results, accepted
+
+
+def _check_transfer(transaction: TransactionPOJO, balances: dict):
+    """
+    Checks that a transfer can be executed
+    :param transaction: the transfer to check
+    :param balances: the current balances of the involved accounts indexed by account number
+    :raises BankingException: the amount to transfer is negative, the account numbers are unknown
+    or the source balance is insufficient
+    """
+
+    if transaction.amount < 0:
+        raise BankingException(NEGATIVE_AMOUNT)
+    if transaction.from_acc not in balances:  # checks the source account existence
+        raise BankingException(UNKNOWN_FROM_ACCOUNT)
+    if balances[transaction.from_acc] < transaction.amount:  # checks that the source balance is sufficient
+        raise BankingException(NOT_ENOUGH_MONEY)
+    if transaction.to_acc not in balances:  # checks the destination account existence
+        raise BankingException(UNKNOWN_TO_ACCOUNT)
+
+
+def _lock_transfer(session, transaction: TransactionPOJO, hot: dict):
+    """
+    Locks the accounts of a single transfer, in account number order. A hot account only has one of its shards
+    locked, unless no shard can be used (the account is then swept like in a batch)
+    :param session: the current database session
+    :param transaction: the transfer
+    :param hot: the shard count of the hot accounts
+    :return: the balances (of the locked shard for a hot account), the balances of the shards of the swept hot
+    accounts and the locked shard of the other hot accounts, indexed by account number
+    """
+
+    numbers = {transaction.from_acc, transaction.to_acc}
+    if not numbers & hot.keys():
+        return _lock_accounts(session, numbers) + ({},)
+
+    balances, shards, targets = {}, {}, {}
+    for number in sorted(numbers):
+        statement = _lock_shard_statement(transaction, number, hot)
+        row = session.execute(statement).first() if statement is not None else None
+        if row is not None:
+            targets[number], balances[number] = row
+            continue
+        for statement in _lock_statements([number], hot):
+            _read_locked_rows(session.execute(statement), balances, shards)
+    return balances, shards, targets
+
+
+def _lock_accounts(session, numbers, hot: dict = None):
+    """
+    Reads and locks (SELECT ... FOR UPDATE) the balances of the given accounts with IN queries.
+    Rows are locked in account number order so that two transfers touching the same accounts cannot deadlock
+    :param session: the current database session
+    :param numbers: the account numbers to lock
+    :param hot: the shard count of the hot accounts, whose shards are locked as well
+    :return: the locked balances (including the shards) and the balances of the shards of the hot accounts,
+    indexed by account number (unknown numbers are missing)
+    """
+
+    balances, shards = {}, {}
+    for statement in _lock_statements(numbers, hot):
+        _read_locked_rows(session.execute(statement), balances, shards)
+    return balances, shards
+
+
+def _lock_statements(numbers, hot: dict = None):
+    """
+    Builds the SELECT ... FOR UPDATE statements reading the balances of the given accounts, in account number order.
+    The shards of a hot account are locked right after its row, so that the lock order is the same for all the
+    transfers (account number, then account row before its shards, then shard number)
+    :param numbers: the account numbers to lock
+    :param hot: the shard count of the hot accounts, whose shards are locked as well
+    :return: the list of statements, each one returning (number, balance) or (number, shard, balance) rows
+    """
+
+    hot = hot or {}
+    statements = []
+    chunk = []
+    for number in sorted(numbers):
+        chunk.append(number)
+        if number in hot or len(chunk) == IN_CHUNK_SIZE:
+            statements.append(_lock_rows_statement(chunk))
+            chunk = []
+        if number in hot:
+            statements.append(_lock_shards_statement(number))
+    if chunk:
+        statements.append(_lock_rows_statement(chunk))
+    return statements
+
+
+def _lock_rows_statement(numbers: List[str]):
+    return select(AccountTable.number, AccountTable.balance) \
+        .where(AccountTable.number.in_(numbers)) \
+        .order_by(AccountTable.number) \
+        .with_for_update()
+
+
+def _lock_shard_statement(transaction: TransactionPOJO, number: str, hot: dict):
+    """
+    Builds the statement locking the shard of a hot account used by a single transfer
+    :return: the statement returning a (shard, balance) row, None if the account is not hot or is both the source
+    and the destination
+    """
+
+    if number not in hot or transaction.from_acc == transaction.to_acc:
+        return None
+    if number == transaction.to_acc:
+        return _credit_shard_statement(number, hot[number])
+    return _debit_shard_statement(number, transaction.amount)
+
+
+def _read_locked_rows(rows, balances: dict, shards: dict):
+    """
+    Reads the rows returned by the lock statements
+    :param rows: (number, balance) rows of accounts or (number, shard, balance) rows of shards
+    :param balances: the balances indexed by account number, the shards being added to their account balance
+    :param shards: the balances of the shards indexed by account number
+    """
+
+    for row in rows:
+        if len(row) == 2:
+            balances[row[0]] = row[1]
+        else:
+            number, shard, balance = row
+            balances[number] += balance
+            shards.setdefault(number, []).append(balance)
+
+
+def _balance_deltas(transactions: List[TransactionPOJO]) -> dict:
+    """
+    Computes the net balance change of every account involved in a list of transfers
+    (a transfer to the same account leaves its balance unchanged)
+    :param transactions: the transfers
+    :return: the balance change indexed by account number
+    """
+
+    deltas = {}
+    for tr in transactions:
+        deltas[tr.from_acc] = deltas.get(tr.from_acc, 0.0) - tr.amount
+        deltas[tr.to_acc] = deltas.get(tr.to_acc, 0.0) + tr.amount
+    return deltas
+
+
+def _apply_balance_deltas(session, deltas: dict, balances: dict = None, shards: dict = None, targets: dict = None):
+    """
+    Applies balance changes to several accounts with a single UPDATE ... SET balance = balance + CASE ... statement
+    (and the statements updating the shards of the hot accounts)
+    :param session: the current database session
+    :param deltas: the balance change indexed by account number
+    :param balances: the locked balances indexed by account number
+    :param shards: the balances of the shards of the swept hot accounts indexed by account number
+    :param targets: the locked shard of the other hot accounts indexed by account number
+    """
+
+    for statement in _update_statements(deltas, balances, shards, targets):
+        session.execute(statement)
+
+
+def _update_statements(deltas: dict, balances: dict = None, shards: dict = None, targets: dict = None):
+    """
+    Builds the UPDATE statements applying balance changes to several accounts. A change is applied to the locked
+    shard of a hot account, or spread over all the shards of a swept hot account
+    :param deltas: the balance change indexed by account number
+    :param balances: the locked balances indexed by account number
+    :param shards: the balances of the shards of the swept hot accounts indexed by account number
+    :param targets: the locked shard of the other hot accounts indexed by account number
+    :return: the list of statements
+    """
+
+    shards = shards or {}
+    targets = targets or {}
+    numbers = sorted(number for number in deltas if number not in shards and number not in targets)
+    statements = []
+    for i in range(0, len(numbers), IN_CHUNK_SIZE):
+        chunk = {number: deltas[number] for number in numbers[i:i + IN_CHUNK_SIZE]}
+        delta = case(chunk, value=AccountTable.number, else_=0.0)
+        statements.append(update(AccountTable)
+                          .where(AccountTable.number.in_(list(chunk)))
+                          .values(balance=AccountTable.balance + delta)
+                          .execution_options(synchronize_session=False))
+    for number in sorted(targets.keys() & deltas.keys()):
+        statements.append(_shard_update_statement(number, targets[number], deltas[number]))
+    for number in sorted(shards.keys() & deltas.keys()):
+        statements.extend(_distribute_statements(number, balances[number] + deltas[number], len(shards[number])))
+    return statements
 
 
 def __convert_to_sql(tr: TransactionPOJO) -> TransactionTable:
@@ -49,3 +440,12 @@ def __convert_to_sql(tr: TransactionPOJO) -> TransactionTable:
     :return:
     """
     return TransactionTable(from_acc=tr.from_acc, to_acc=tr.to_acc, amount=tr.amount)
+
+
+def _convert_to_dicts(transactions: List[TransactionPOJO]) -> List[dict]:
+    """
+    Converts model transactions to the column values of a bulk INSERT
+    :param transactions:
+    :return:
+    """
+    return [{"from_acc": tr.from_acc, "to_acc": tr.to_acc, "amount": tr.amount} for tr in transactions]
@@ -1,68 +1,104 @@
-from typing import List
-from pojo.user import User as UserPOJO, Coordinates
+from typing import List, Optional
+
+import orjson
+from sqlalchemy import func, insert, or_, select
+from pojo.user import User as UserPOJO, Coordinates, GEOCODING_PENDING
 from pojo.user import BaseUser
-from db.database import get_db
-from db.tables.user import User as UserTable
-from util import util
+from sqlalchemy.orm import Session
+from db.database import on_primary, use_db, use_read_db
+from db.tables.user import User as UserTable, ImportJob as ImportJobTable
 from util.messages import *
+from util import geohash
+from util.entity_cache import user_cache
+from util.retry import retry_transaction
+from util.user_import import ImportJob
+from workers.geocoding_worker import geocoding_worker
 
 
-def get_users() -> List[UserPOJO]:
+def get_users(after: int = None, limit: int = None, session: Session = None) -> List[UserPOJO]:
     """
-    Returns the list of users
+    Returns the list of users, optionally one page at a time (keyset pagination on the user ID)
+    :param after: only returns the users whose ID is greater than this one (ID of the last user of the previous page)
+    :param limit: maximum number of users to return
+    :param session: the session of the caller, a new session is used if None
     :return: List[User]
     """
 
     users = []
-    session = get_db()
-    try:
-        for user in session.query(UserTable).all():
+    with use_read_db(session) as session:
+        for user in session.scalars(_select_users(after, limit)):
             users.append(_convert_to_pojo(user))
-    finally:
-        session.close();
 
     return users
 
 
-def get_user(user_id: int) -> UserPOJO:
+def get_user_rows(after: int = None, limit: int = None, session: Session = None) -> List[dict]:
+    """
+    Returns the list of users as plain dictionaries, ready to be encoded to JSON. The users are read with a
+    column-only query, without building ORM entities nor pydantic models
+    :param after: only returns the users whose ID is greater than this one (ID of the last user of the previous page)
+    :param limit: maximum number of users to return
+    :param session: the session of the caller, a new session is used if None
+    :return: the list of users, with the fields of the User model
+    """
+
+    with use_read_db(session) as session:
+        return [_row_to_dict(row) for row in session.execute(_select_users(after, limit, columns=True))]
+
+
+def get_nearby_users(latitude: float, longitude: float, radius_km: float, limit: int = 50,
+                     session: Session = None) -> List[dict]:
+    """
+    Returns the located users within a distance of a location, nearest first.
+    The candidates are read by index range scans on the geohash cells covering the circle, then the exact
+    great-circle distance is checked (by ST_Distance_Sphere on MySQL, and in Python)
+    :param latitude: latitude of the location in degrees
+    :param longitude: longitude of the location in degrees
+    :param radius_km: maximum distance in kilometers
+    :param limit: maximum number of users to return
+    :param session: the session of the caller, a new session is used if None
+    :return: the users as dictionaries (fields of the User model and distance_km)
+    """
+
+    with use_read_db(session) as session:
+        rows = session.execute(_select_nearby_users(latitude, longitude, radius_km, limit, session.bind.dialect.name))
+        return _nearest(rows, latitude, longitude, radius_km, limit)
+
+
+def get_user(user_id: int, session: Session = None) -> UserPOJO:
     """
     Returns the user information based on a given user ID
     :param user_id: ID of the user
+    :param session: the session of the caller, a new session is used if None
     :return: the user information
     :rtype: User
     :raises BankingException: the provided user ID is unknown
     """
 
-    session = get_db()
-    try:
-        user = session.query(UserTable).get(user_id)
-        res = _convert_to_pojo(user)
-        if res is None:
-            raise BankingException(UNKNOWN_USER_ID)
-        return res
-    finally:
-        session.close()
+    found, res, version = user_cache.lookup(user_id)
+    if not found:
+        with use_db(on_primary(session)) as session:
+            res = _convert_to_pojo(session.get(UserTable, user_id))
+        user_cache.store(user_id, version, res)
+    if res is None:
+        raise BankingException(UNKNOWN_USER_ID)
+    return res
 
 
-def create_user(user: BaseUser) -> int:
+@retry_transaction
+def create_user(user: BaseUser, session: Session = None) -> int:
     """
-    Creates a new user and calculates the geographical location based on the provided address
+    Creates a new user. The geographical location is calculated afterwards by the background geocoding worker
+    based on the provided address
     :param user: the user information
+    :param session: the session of the caller, a new session is used if None
     :return: the auto-generated user ID
     """
 
-    session = get_db()
-
-    try:
-        latitude, longitude = util.get_coordinates(user.address) # Calculates the geographical location
-
-        if latitude is None or longitude is None:
-            coordinates = None
-        else:
-            coordinates = Coordinates(latitude=latitude, longitude=longitude)
-
+    with use_db(session) as session:
         x = UserPOJO(
-            coordinates=coordinates,
+            coordinates=None,
+            geocoding_status=GEOCODING_PENDING,
             **user.dict()
         )
         u = _convert_to_sql(x)
@@ -70,22 +106,25 @@ def create_user(user: BaseUser) -> int:
         session.flush()  # Required to retrieve the auto-generated ID
         new_user_id = u.id  # Retrieves the user ID
         session.commit()
-        return new_user_id
-    finally:
-        session.close()
+    user_cache.invalidate(new_user_id)  # discards the cached absence of the user
+
+    geocoding_worker.submit(new_user_id)  # Calculates the geographical location in background
+    return new_user_id
 
 
-def modify_user(user_id: int, user: BaseUser):
+@retry_transaction
+def modify_user(user_id: int, user: BaseUser, session: Session = None):
     """
-    Updates an existing user and re-calculates the geographical position if the address has changed
+    Updates an existing user. The geographical position is re-calculated in background if the address has changed
     :param user_id: the ID of the user to modify
     :param user: the new user information
+    :param session: the session of the caller, a new session is used if None
     :raises BankingException: the provided user ID is unknown
     """
 
-    session = get_db()
+    address_changed = False
 
-    try:
+    with use_db(session) as session:
         old_user = session.query(UserTable).filter(UserTable.id == user_id).first()
 
         if old_user:
@@ -95,13 +134,191 @@ def modify_user(user_id: int, user: BaseUser):
                 old_user.lastname = user.lastname
             if user.address and old_user.address != user.address:
                 old_user.address = user.address
-                latitude, longitude = util.get_coordinates(user.address)
-                old_user.coordinates = None if latitude is None and longitude is None else f"{latitude} {longitude}"
+                old_user.coordinates = None
+                old_user.geohash = None
+                old_user.geocoding_status = GEOCODING_PENDING
+                old_user.geocoding_attempts = 0
+                address_changed = True
             session.commit()
         else:
             raise BankingException(UNKNOWN_USER_ID)
-    finally:
-        session.close()
+    user_cache.invalidate(user_id)
+
+    if address_changed:
+        geocoding_worker.submit(user_id)
+
+
+@retry_transaction
+def insert_users(users: List[BaseUser], job_id: str, after: int = None, session: Session = None) -> List[int]:
+    """
+    Creates a chunk of users of a bulk import with one executemany INSERT, their location being calculated
+    afterwards by the geocoding worker (which polls the pending users). The users are tagged with the job ID,
+    which gives their IDs back whatever the users created concurrently
+    :param users: the users information
+    :param job_id: the ID of the import job
+    :param after: the last user ID of the previous chunks of the job, None for the first chunk
+    :param session: the session of the caller, a new session is used if None
+    :return: the IDs generated for the chunk
+    """
+
+    with use_db(session) as session:
+        session.execute(insert(UserTable), _pending_rows(users, job_id))
+        user_ids = list(session.scalars(_select_imported_ids(job_id, after)))
+        session.commit()
+    user_cache.invalidate(*user_ids)  # discards the cached absences of the users
+    return user_ids
+
+
+def count_pending_users(job_id: str, session: Session = None) -> int:
+    """
+    Counts the users created by a bulk import whose geographical location is not calculated yet
+    :param job_id: the ID of the import job
+    :param session: the session of the caller, a new session is used if None
+    :return: the number of pending users
+    """
+
+    with use_db(session) as session:
+        return session.execute(_count_pending_users(job_id)).scalar()
+
+
+def save_import_job(job: ImportJob, session: Session = None):
+    """
+    Saves the progress of a bulk import, read by every worker
+    :param job: the import job
+    :param session: the session of the caller, a new session is used if None
+    """
+
+    with use_db(session) as session:
+        session.merge(_convert_import_job_to_sql(job))
+        session.commit()
+
+
+def get_import_job(job_id: str, session: Session = None) -> Optional[ImportJob]:
+    """
+    Returns the progress of a bulk import
+    :param job_id: the ID of the import job
+    :param session: the session of the caller, a new session is used if None
+    :return: the import job, None if the ID is unknown
+    """
+
+    with use_db(session) as session:
+        return _convert_import_job(session.get(ImportJobTable, job_id))
+
+
+def _pending_rows(users: List[BaseUser], job_id: str) -> List[dict]:
+    """
+    :return: the bound values inserting the users of an import job with a pending geocoding status
+    """
+
+    return [dict(user.dict(), geocoding_status=GEOCODING_PENDING, import_job=job_id) for user in users]
+
+
+def _select_imported_ids(job_id: str, after: int = None):
+    query = select(UserTable.id).where(UserTable.import_job == job_id).order_by(UserTable.id)
+    return query.where(UserTable.id > after) if after is not None else query
+
+
+def _count_pending_users(job_id: str):
+    return select(func.count()).select_from(UserTable) \
+        .where(UserTable.import_job == job_id, UserTable.geocoding_status == GEOCODING_PENDING)
+
+
+def _convert_import_job_to_sql(job: ImportJob) -> ImportJobTable:
+    return ImportJobTable(id=job.id, status=job.status, started_at=job.started_at, finished_at=job.finished_at,
+                          rows_read=job.rows, imported=job.imported, error_count=job.error_count,
+                          errors=orjson.dumps(job.errors).decode())
+
+
+def _convert_import_job(row: ImportJobTable) -> Optional[ImportJob]:
+    if row is None:
+        return None
+    job = ImportJob(row.id)
+    job.status = row.status
+    job.started_at = row.started_at
+    job.finished_at = row.finished_at
+    job.rows = row.rows_read
+    job.imported = row.imported
+    job.error_count = row.error_count
+    job.errors = orjson.loads(row.errors)
+    return job
+
+
+def _select_users(after: int = None, limit: int = None, columns: bool = False):
+    """
+    Builds the query listing the users. When a page is requested, the users are sorted by ID
+    and the page starts right after the provided ID, so that every page is an index range scan
+    :param after: only selects the users whose ID is greater than this one
+    :param limit: maximum number of users to select
+    :param columns: selects the columns converted by _row_to_dict instead of ORM entities
+    :return: the SELECT statement
+    """
+
+    query = select(*_USER_COLUMNS) if columns else select(UserTable)
+    if after is not None or limit is not None:
+        query = query.order_by(UserTable.id)
+    if after is not None:
+        query = query.where(UserTable.id > after)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def _select_nearby_users(latitude: float, longitude: float, radius_km: float, limit: int, dialect: str):
+    """
+    Builds the query reading the candidate users of a proximity search: one geohash prefix range per covering cell.
+    The prefixes are matched with LIKE 'cell%' (a constant pattern, read by an index range scan): a range bounded by
+    a character above the BASE32 alphabet depends on the collation of the column
+    On MySQL, the distance filter, the ordering and the limit are also applied by the database
+    :param dialect: name of the database dialect
+    :return: the SELECT statement, returning the columns converted by _row_to_dict
+    """
+
+    cells = sorted(geohash.covering_cells(latitude, longitude, radius_km))
+    query = select(*_USER_COLUMNS).where(or_(*[UserTable.geohash.like(cell + "%") for cell in cells]))
+    if dialect == "mysql":
+        # the POINT stores (latitude longitude) while ST_Distance_Sphere expects (longitude latitude)
+        location = func.POINT(func.ST_Y(UserTable.coordinates), func.ST_X(UserTable.coordinates))
+        distance = func.ST_Distance_Sphere(location, func.POINT(longitude, latitude))
+        query = query.where(distance <= radius_km * 1000).order_by(distance).limit(limit)
+    return query
+
+
+def _nearest(rows, latitude: float, longitude: float, radius_km: float, limit: int) -> List[dict]:
+    """
+    Refines the candidates of a proximity search with the exact great-circle distance
+    :param rows: the candidate rows
+    :return: the users within the radius as dictionaries with their distance_km, nearest first
+    """
+
+    users = []
+    for row in rows:
+        user = _row_to_dict(row)
+        distance = geohash.haversine_km(latitude, longitude,
+                                        user["coordinates"]["latitude"], user["coordinates"]["longitude"])
+        if distance <= radius_km:
+            user["distance_km"] = round(distance, 3)
+            users.append(user)
+    users.sort(key=lambda u: (u["distance_km"], u["id"]))
+    return users[:limit]
+
+
+_USER_COLUMNS = (UserTable.id, UserTable.firstname, UserTable.lastname, UserTable.address, UserTable.coordinates,
+                 UserTable.geocoding_status)
+
+
+def _row_to_dict(row) -> dict:
+    """
+    Converts a row of the column-only users query to the dictionary of the User model fields
+    :param row: the (id, firstname, lastname, address, coordinates, geocoding_status) row
+    :return: the user as a dictionary
+    """
+
+    user_id, firstname, lastname, address, coordinates, geocoding_status = row
+    if coordinates is not None:
+        latitude, longitude = coordinates.split()
+        coordinates = {"latitude": float(latitude), "longitude": float(longitude)}
+    return {"firstname": firstname, "lastname": lastname, "address": address, "id": user_id,
+            "coordinates": coordinates, "geocoding_status": geocoding_status}
 
 
 def _convert_to_pojo(user: UserTable) -> UserPOJO:
@@ -125,7 +342,8 @@ def _convert_to_pojo(user: UserTable) -> UserPOJO:
 
     return UserPOJO(id=user.id, firstname=user.firstname,
                     lastname=user.lastname,
-                    address=user.address, coordinates=coordinates)
+                    address=user.address, coordinates=coordinates,
+                    geocoding_status=user.geocoding_status)
 
 
 def _convert_to_sql(user: UserPOJO) -> UserTable:
@@ -144,7 +362,10 @@ def _convert_to_sql(user: UserPOJO) -> UserTable:
     res.address = user.address
     if user.coordinates is None:
         res.coordinates = None
+        res.geohash = None
     else:
         res.coordinates = f"{user.coordinates.latitude} {user.coordinates.longitude}" #required to respect the MySQL POINT data type format
+        res.geohash = geohash.encode(user.coordinates.latitude, user.coordinates.longitude)
+    res.geocoding_status = user.geocoding_status
 
     return res
@@ -1,29 +1,445 @@
-from sqlalchemy import create_engine
+import itertools
+import logging
+import threading
+from contextlib import contextmanager, asynccontextmanager
+from typing import List, Optional
+
+from fastapi import Request
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
 from db.variables import *
+from util import metrics, query_counter
+
+
+def database_url() -> str:
+    """
+    :return: the URL of the primary database: the MySQL database of the MYSQL_* environment variables if they are
+    set, settings.db_url otherwise
+    """
+
+    if "MYSQL_HOST" not in os.environ:
+        return settings.db_url  # default database url
+    return _mysql_url(os.environ["MYSQL_HOST"] + ":" + os.environ["MYSQL_PORT"])
+
+
+def replica_urls() -> List[str]:
+    """
+    :return: the URLs of the read replicas: the MySQL hosts of the MYSQL_REPLICA_HOSTS environment variable
+    (comma-separated host:port sharing the credentials of the primary) if the MYSQL_* variables are set,
+    settings.replica_urls otherwise
+    """
+
+    if "MYSQL_HOST" not in os.environ:
+        return settings.replica_urls
+    return [_mysql_url(host.strip()) for host in os.environ.get("MYSQL_REPLICA_HOSTS", "").split(",") if host.strip()]
+
+
+def _mysql_url(host: str) -> str:
+    return f"mysql+pymysql://{os.environ['MYSQL_USER']}:{os.environ['MYSQL_PWD']}@{host}/{os.environ['MYSQL_DB']}"
+
+
+def to_async_url(url: str) -> str:
+    """
+    Converts a synchronous database URL to the URL of the equivalent asyncio driver
+    (aiomysql for MySQL, aiosqlite for SQLite)
+    :param url: the synchronous database URL
+    :return: the asyncio database URL
+    """
+
+    for sync_prefix, async_prefix in (("mysql+pymysql://", "mysql+aiomysql://"),
+                                      ("mysql://", "mysql+aiomysql://"),
+                                      ("sqlite://", "sqlite+aiosqlite://")):
+        if url.startswith(sync_prefix):
+            return async_prefix + url[len(sync_prefix):]
+    return url
 
-try:
-    MYSQL_HOST = os.environ["MYSQL_HOST"]
-    MYSQL_PORT = os.environ["MYSQL_PORT"]
-    MYSQL_USER = os.environ["MYSQL_USER"]
-    MYSQL_PWD = os.environ["MYSQL_PWD"]
-    MYSQL_DB = os.environ["MYSQL_DB"]
 
-    SQLALCHEMY_DATABASE_URL = (
-        f"mysql+pymysql://{MYSQL_USER}:{MYSQL_PWD}@{MYSQL_HOST}:{MYSQL_PORT}/{MYSQL_DB}"
-    )
+def pool_options(asyncio: bool = False) -> dict:
+    """
+    :param asyncio: whether the options are those of an asyncio engine
+    :return: the connection pool options of the engines, taken from the settings
+    """
 
-except KeyError:
-    SQLALCHEMY_DATABASE_URL = settings.db_url  # default database url
+    return {"poolclass": metrics.TimedAsyncQueuePool if asyncio else metrics.TimedQueuePool,
+            "pool_size": settings.pool_size, "max_overflow": settings.pool_max_overflow,
+            "pool_timeout": settings.pool_timeout, "pool_pre_ping": settings.pool_pre_ping,
+            "pool_recycle": settings.pool_recycle}
 
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, pool_recycle=3600)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# The engines are created on first use (or at startup by the application lifespan): importing the application
+# does not load the database drivers nor read the database settings
+_engines = {}  # "sync" or "async" -> engine of the primary database
+_engines_lock = threading.Lock()
+
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
+AsyncSessionLocal = async_sessionmaker(autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
 
+STREAM_BATCH_SIZE = 1000  # number of rows fetched at once from a server-side cursor
+READ_PRIMARY_HEADER = "X-Read-Primary"  # request header sending the reads of a request to the primary
+ROUND_ROBIN = "round_robin"
+LEAST_CONNECTIONS = "least_connections"
+
+logger = logging.getLogger("homebanking.replicas")
+
+
+def get_engine():
+    """
+    :return: the engine of the primary database, created on first use
+    """
+
+    engine = _engines.get("sync")
+    return engine if engine is not None else _create_engine("sync")
+
+
+def get_async_engine() -> AsyncEngine:
+    """
+    :return: the asyncio engine of the primary database, created on first use
+    """
+
+    engine = _engines.get("async")
+    return engine if engine is not None else _create_engine("async")
+
+
+def _create_engine(label: str):
+    """
+    Creates and instruments an engine of the primary database, once
+    :param label: "sync" or "async"
+    """
+
+    with _engines_lock:
+        if label not in _engines:
+            url = database_url()
+            if label == "sync":
+                engine = sync_engine = create_engine(url, **pool_options())
+            else:
+                engine = create_async_engine(to_async_url(url), **pool_options(asyncio=True))
+                sync_engine = engine.sync_engine
+            query_counter.instrument_engine(sync_engine)
+            metrics.instrument_engine(sync_engine, label)
+            _engines[label] = engine
+        return _engines[label]
+
+
+async def dispose_engines():
+    """
+    Closes the connections of the primary and replica engines (at shutdown), new engines are created on next use
+    """
+
+    global replicas
+    engines = list(_engines.values())
+    if replicas is not None:
+        engines += [engine for replica in replicas.replicas for engine in (replica.engine, replica.async_engine)]
+    _engines.clear()
+    replicas = None
+    for engine in engines:
+        if isinstance(engine, AsyncEngine):
+            await engine.dispose()
+        else:
+            engine.dispose()
+
+
+class Replica:
+    """
+    Read replica of the primary database, with its own engines and connection pools
+
+    Attributes:
+        url: the synchronous database URL of the replica
+        label: name of the replica in the metrics and in the session info
+        healthy: result of the last health check (a replica is healthy until its first check), or False since a
+        query of either engine lost its connection
+        lag: seconds the replica was behind the primary at the last health check, None if it is not measured
+    """
+
+    def __init__(self, url: str, label: str):
+        self.url = url
+        self.label = label
+        self.healthy = True
+        self.lag = None
+        self.engine = create_engine(url, **pool_options())
+        self.async_engine = create_async_engine(to_async_url(url), **pool_options(asyncio=True))
+        self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine,
+                                         info={"replica": label})
+        self.AsyncSessionLocal = async_sessionmaker(autoflush=False, expire_on_commit=False, bind=self.async_engine,
+                                                    info={"replica": label})
+        for instrumented_engine, suffix in ((self.engine, "sync"), (self.async_engine.sync_engine, "async")):
+            query_counter.instrument_engine(instrumented_engine)
+            metrics.instrument_engine(instrumented_engine, "%s-%s" % (label, suffix))
+            event.listen(instrumented_engine, "handle_error", self._on_error)
+
+    def connections(self) -> int:
+        """
+        :return: the number of connections currently checked out of the pools of the replica
+        """
+
+        return self.engine.pool.checkedout() + self.async_engine.sync_engine.pool.checkedout()
+
+    def check(self) -> bool:
+        """
+        Checks that the replica answers a trivial query and, if settings.replica_max_lag is set, that a MySQL
+        replica is not further behind the primary (the replication lag of the other databases is not measured).
+        The check uses the synchronous engine: the failures of the asyncio engine are caught by its queries
+        :return: the new health of the replica
+        """
+
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+                healthy = True
+                if settings.replica_max_lag is not None and connection.dialect.name == "mysql":
+                    self.lag = _replication_lag(connection)
+                    healthy = self.lag is not None and self.lag <= settings.replica_max_lag
+            if self.healthy and not healthy:
+                logger.warning("Read replica %s is behind the primary (lag %s seconds), reading from the primary",
+                               self.label, self.lag)
+            elif healthy and not self.healthy:
+                logger.info("Read replica %s available again", self.label)
+            self.healthy = healthy
+        except Exception:
+            if self.healthy:
+                logger.warning("Read replica %s unavailable, reading from the primary", self.label, exc_info=True)
+            self.healthy = False
+        return self.healthy
+
+    def _on_error(self, context):
+        """
+        Stops reading the replica as soon as a query of the sync or asyncio engine loses its connection,
+        until the next successful health check
+        """
+
+        if context.is_disconnect and self.healthy:
+            logger.warning("Read replica %s disconnected, reading from the primary", self.label)
+            self.healthy = False
+
+    def dispose(self):
+        self.engine.dispose()
+        # the asyncio connections cannot be closed outside of the event loop, they are released once unreferenced
+        self.async_engine.sync_engine.dispose(close=False)
+
+
+def _replication_lag(connection) -> Optional[float]:
+    """
+    :param connection: a connection to a MySQL replica (8.0.22 or later)
+    :return: the seconds the replica is behind its source, None if the replication is stopped
+    """
+
+    row = connection.execute(text("SHOW REPLICA STATUS")).mappings().first()
+    lag = row.get("Seconds_Behind_Source") if row is not None else None
+    return float(lag) if lag is not None else None
+
+
+class ReplicaPool:
+    """
+    Read replicas among which the read-only queries are balanced
+
+    Attributes:
+        replicas: the replicas
+        balancing: ROUND_ROBIN, or LEAST_CONNECTIONS to choose the replica having the fewest connections in use
+    """
+
+    def __init__(self, urls: List[str], balancing: str = ROUND_ROBIN):
+        self.replicas = [Replica(url, "replica%d" % n) for n, url in enumerate(urls)]
+        self.balancing = balancing
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+
+    def choose(self) -> Optional[Replica]:
+        """
+        :return: the replica serving the next read, None if no replica is healthy
+        """
+
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        if self.balancing == LEAST_CONNECTIONS:
+            return min(healthy, key=Replica.connections)
+        with self._lock:
+            return healthy[next(self._next) % len(healthy)]
+
+    def check(self):
+        """
+        Checks the health of every replica
+        """
+
+        for replica in self.replicas:
+            replica.check()
+
+    def dispose(self):
+        for replica in self.replicas:
+            replica.dispose()
+
+
+replicas: Optional[ReplicaPool] = None  # created on first use, see get_replicas
+metrics.replica_healthy.function = lambda: {(replica.label, ): int(replica.healthy)
+                                            for replica in (replicas.replicas if replicas is not None else ())}
+metrics.replica_lag.function = lambda: {(replica.label, ): replica.lag
+                                        for replica in (replicas.replicas if replicas is not None else ())
+                                        if replica.lag is not None}
+
+
+def get_replicas() -> ReplicaPool:
+    """
+    :return: the read replicas, created on first use from replica_urls()
+    """
+
+    global replicas
+    if replicas is None:
+        with _engines_lock:
+            if replicas is None:
+                replicas = ReplicaPool(replica_urls(), settings.replica_balancing)
+    return replicas
+
+
+def configure_replicas(urls: List[str], balancing: str = None):
+    """
+    Replaces the read replicas
+    :param urls: the URLs of the new replicas, empty to read from the primary
+    :param balancing: ROUND_ROBIN or LEAST_CONNECTIONS, settings.replica_balancing by default
+    """
+
+    global replicas
+    previous = replicas
+    replicas = ReplicaPool(urls, balancing or settings.replica_balancing)
+    if previous is not None:
+        previous.dispose()
+
+
+def check_replicas():
+    """
+    Checks the health of the read replicas: the reads are sent to the primary while no replica is healthy
+    """
+
+    get_replicas().check()
+
 
 def get_db():
-    return SessionLocal()
+    return SessionLocal(bind=get_engine())
+
+
+def get_async_db():
+    return AsyncSessionLocal(bind=get_async_engine())
+
+
+def get_read_db():
+    """
+    :return: a session on a healthy read replica, or on the primary if there is none
+    """
+
+    replica = get_replicas().choose()
+    return replica.SessionLocal() if replica is not None else get_db()
+
+
+def get_async_read_db():
+    """
+    :return: an asyncio session on a healthy read replica, or on the primary if there is none
+    """
+
+    replica = get_replicas().choose()
+    return replica.AsyncSessionLocal() if replica is not None else get_async_db()
+
+
+async def get_request_db():
+    """
+    FastAPI dependency providing one asyncio session per request, shared by all the DAO calls of the request
+    """
+
+    session = get_async_db()
+    try:
+        yield session
+    finally:
+        await session.close()
+
+
+async def get_request_read_db(request: Request):
+    """
+    FastAPI dependency providing the asyncio session of a read-only request, on a read replica.
+    The replicas lag behind the primary: a client reading its own writes sends the X-Read-Primary header
+    """
+
+    session = get_async_db() if READ_PRIMARY_HEADER in request.headers else get_async_read_db()
+    try:
+        yield session
+    finally:
+        await session.close()
+
+
+def on_primary(session=None):
+    """
+    Keeps the reads which must see the latest writes (e.g. the loads filling the entity caches) on the primary
+    :param session: the session of the caller or None
+    :return: the session of the caller, None (for a new session) if it is connected to a read replica
+    """
+
+    return None if session is not None and "replica" in session.info else session
+
+
+@contextmanager
+def use_db(session=None):
+    """
+    Provides the session of the caller, or a new session closed on exit if the caller has none
+    :param session: the session of the caller (e.g. the request session) or None
+    """
+
+    if session is not None:
+        yield session
+        return
+    session = get_db()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@asynccontextmanager
+async def use_async_db(session=None):
+    """
+    Provides the asyncio session of the caller, or a new session closed on exit if the caller has none
+    :param session: the asyncio session of the caller (e.g. the request session) or None
+    """
+
+    if session is not None:
+        yield session
+        return
+    session = get_async_db()
+    try:
+        yield session
+    finally:
+        await session.close()
+
+
+@contextmanager
+def use_read_db(session=None):
+    """
+    Provides the session of the caller, or a new read replica session closed on exit if the caller has none
+    :param session: the session of the caller (e.g. the request session) or None
+    """
+
+    if session is not None:
+        yield session
+        return
+    session = get_read_db()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@asynccontextmanager
+async def use_async_read_db(session=None):
+    """
+    Provides the asyncio session of the caller, or a new read replica session closed on exit if the caller has none
+    :param session: the asyncio session of the caller (e.g. the request session) or None
+    """
+
+    if session is not None:
+        yield session
+        return
+    session = get_async_read_db()
+    try:
+        yield session
+    finally:
+        await session.close()
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, String, Float, Integer
+from sqlalchemy import Column, String, Float, Integer, func, select
+from sqlalchemy.orm import column_property
 from db.database import Base
 
 
@@ -10,5 +11,26 @@ class Account(Base):
     __tablename__ = "account"
 
     number = Column(String, primary_key=True, index=True)
-    balance = Column(Float, nullable=False)
+    balance = Column(Float, nullable=False)  # whole balance, or the part of a hot account balance not in its shards
     user_id = Column(Integer, nullable=False)
+
+
+class AccountShard(Base):
+    """
+    SQL interface to the table account_shard (sub-balances of the hot accounts: the credits and debits of a hot
+    account are spread over its shard rows instead of all locking the account row)
+    """
+
+    __tablename__ = "account_shard"
+
+    account_number = Column(String, primary_key=True)
+    shard = Column(Integer, primary_key=True)
+    balance = Column(Float, nullable=False)
+
+
+# Balance of an account including its shards (index lookups on the account_shard primary key)
+Account.total_balance = column_property(
+    Account.balance + func.coalesce(select(func.sum(AccountShard.balance))
+                                    .where(AccountShard.account_number == Account.number)
+                                    .correlate_except(AccountShard)
+                                    .scalar_subquery(), 0.0))
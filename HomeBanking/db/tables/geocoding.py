@@ -0,0 +1,16 @@
+from sqlalchemy import Column, String, Float, DateTime
+from db.database import Base
+
+
+class GeocodingCache(Base):
+    """
+    SQL interface to table geocoding_cache (persistent cache of the geocoder results).
+    Addresses that cannot be located are stored with NULL coordinates (negative caching)
+    """
+
+    __tablename__ = "geocoding_cache"
+
+    address_key = Column(String(64), primary_key=True, index=True)  # SHA-256 of the normalized address
+    latitude = Column(Float, nullable=True)
+    longitude = Column(Float, nullable=True)
+    expires_at = Column(DateTime, nullable=False)
@@ -0,0 +1,19 @@
+from sqlalchemy import Column, String, DateTime, Index
+from db.database import Base
+
+
+class IdempotencyKey(Base):
+    """
+    SQL interface to table idempotency_key (response of the mutating requests sent with an Idempotency-Key header,
+    returned again when the request is retried)
+    """
+
+    __tablename__ = "idempotency_key"
+    __table_args__ = (
+        Index("Idempotency_Expires_IND", "expires_at"),
+    )
+
+    key = Column(String, primary_key=True, index=True)  # Idempotency-Key header of the request
+    request_hash = Column(String, nullable=False)  # SHA-256 of the method, path and parameters of the request
+    response = Column(String, nullable=False)  # JSON body of the response
+    expires_at = Column(DateTime, nullable=False)  # UTC
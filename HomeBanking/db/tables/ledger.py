@@ -0,0 +1,31 @@
+from sqlalchemy import Column, String, Float, Integer, DateTime, Index
+from db.database import Base
+
+
+class LedgerEntry(Base):
+    """
+    SQL interface to table ledger_entry (append-only debits and credits of the accounts, one per account and transfer)
+    """
+
+    __tablename__ = "ledger_entry"
+    __table_args__ = (
+        Index("Ledger_Account_Date_IND", "account_number", "date"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    account_number = Column(String, nullable=False)
+    amount = Column(Float, nullable=False)  # negative for a debit, positive for a credit
+    counterparty = Column(String, nullable=False)  # the other account of the transfer
+    date = Column(DateTime, nullable=False)  # UTC
+
+
+class BalanceCheckpoint(Base):
+    """
+    SQL interface to table balance_checkpoint (balance of an account including every ledger entry up to a date)
+    """
+
+    __tablename__ = "balance_checkpoint"
+
+    account_number = Column(String, primary_key=True)
+    date = Column(DateTime, primary_key=True)  # UTC
+    balance = Column(Float, nullable=False)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Float, Integer, DateTime
+from sqlalchemy import Column, String, Float, Integer, DateTime, Index, func
 from db.database import Base
 
 
@@ -8,8 +8,14 @@ class Transaction(Base):
     """
 
     __tablename__ = "transfer"
+    __table_args__ = (
+        # composite indexes serving the account history (transfers of an account in a date range)
+        Index("FKto_IND", "from_acc", "date"),
+        Index("FKfrom_IND", "to_acc", "date"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     amount = Column(Float, nullable=False)
+    date = Column(DateTime, nullable=False, server_default=func.current_timestamp())
     from_acc = Column(String, nullable=False)
     to_acc = Column(String, nullable=False)
@@ -1,6 +1,6 @@
 from abc import ABC, ABCMeta
 
-from sqlalchemy import Column, Integer, String, Date
+from sqlalchemy import Column, Integer, String, Date, DateTime
 from db.database import Base
 from sqlalchemy import func
 from sqlalchemy.types import UserDefinedType
@@ -16,6 +16,8 @@ class Geometry(UserDefinedType):
     Class used to deal with MySQL POINT data type
     """
 
+    cache_ok = True  # stateless type, the statements using it can be cached
+
     def bind_expression(self, bindvalue):  # function used when a INSERT SQL statement is executed (str to POINT)
         return func.ST_GeomFromText(func.CONCAT("POINT(", bindvalue, ")"), type_=self)
 
@@ -35,3 +37,24 @@ class User(Base):
     lastname = Column(String, nullable=False)
     address = Column(String, nullable=False)
     coordinates = Column(Geometry().with_variant(String, 'sqlite'), nullable=True)  # String type if test sqlite db
+    geocoding_status = Column(String, nullable=True, index=True)  # pending until the background worker locates the address
+    geocoding_attempts = Column(Integer, nullable=False, default=0, server_default="0")  # failed geocoder calls
+    geohash = Column(String, nullable=True, index=True)  # geohash of the coordinates, serves the proximity searches
+    import_job = Column(String, nullable=True, index=True)  # ID of the bulk import which created the user
+
+
+class ImportJob(Base):
+    """
+    SQL interface to table import_job (progress and error report of the bulk user imports, read by every worker)
+    """
+
+    __tablename__ = "import_job"
+
+    id = Column(String, primary_key=True, index=True)  # job ID returned by POST /users/bulk
+    status = Column(String, nullable=False)  # running, done or failed
+    started_at = Column(DateTime, nullable=False)  # UTC
+    finished_at = Column(DateTime, nullable=True)  # UTC
+    rows_read = Column(Integer, nullable=False)
+    imported = Column(Integer, nullable=False)  # users created
+    error_count = Column(Integer, nullable=False)  # rejected rows
+    errors = Column(String, nullable=False)  # JSON list of the first rejected rows (line number and error)
@@ -1,9 +1,101 @@
+import sys
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 
-from routers import user, account, transaction
+from db.variables import Settings, settings
+
+# modules building caches, workers and jobs from the settings when they are imported
+SETTINGS_READERS = ("util.util", "util.iban", "util.entity_cache", "dao.account_dao", "dao.shard_dao",
+                    "workers.geocoding_worker", "workers.transfer_writer", "workers.periodic_job")
+
+
+def create_app(app_settings: Settings = None) -> FastAPI:
+    """
+    Builds the application (uvicorn main:create_app --factory).
+    The routers, and the DAO and workers they depend on, are imported here rather than when this module is
+    imported: the settings are installed first, so that the caches and jobs created at import use them.
+    The settings of a process are therefore installed once, by the first call
+    :param app_settings: the settings of the application, the current settings (db.variables.settings) if None
+    :return: the application, whose lifespan creates the database engines and runs the background workers
+    :raises RuntimeError: different settings are provided once the caches and jobs are created
+    """
+
+    if app_settings is not None and vars(app_settings) != vars(settings):
+        readers = [name for name in SETTINGS_READERS if name in sys.modules]
+        if readers:
+            raise RuntimeError("The settings must be provided before %s is imported" % ", ".join(readers))
+        vars(settings).update(vars(app_settings))
+
+    from routers import user, account, transaction, metrics
+    from util.metrics import MetricsMiddleware
+    from util.query_counter import QueryCounterMiddleware
+
+    application = FastAPI(lifespan=lifespan)
+    application.include_router(user.router)
+    application.include_router(account.router)
+    application.include_router(transaction.router)
+    application.include_router(metrics.router)
+    application.add_middleware(MetricsMiddleware)
+    application.add_middleware(QueryCounterMiddleware)
+    return application
+
+
+@asynccontextmanager
+async def lifespan(application: FastAPI):
+    """
+    Creates the database engines before the first request and runs the background workers until the shutdown.
+    The geocoder (and geopy) is only created by the first geocoding
+    """
+
+    from db.database import get_engine, get_async_engine, dispose_engines
+
+    get_engine()
+    get_async_engine()
+    start_workers()
+    try:
+        yield
+    finally:
+        from util.user_import import cancel_imports
+
+        await cancel_imports()  # the users of the chunks already inserted are kept, the jobs are saved as failed
+        stop_workers()
+        await dispose_engines()
+
+
+def start_workers():
+    from workers.geocoding_worker import geocoding_worker
+    from workers.transfer_writer import transfer_writer
+    from workers.periodic_job import checkpoint_job, idempotency_purge_job, rebalance_job, replica_health_job
+
+    geocoding_worker.start()  # also resumes the geocoding left pending at the last shutdown
+    checkpoint_job.start()
+    idempotency_purge_job.start()
+    rebalance_job.start()
+    replica_health_job.start()
+    transfer_writer.start()  # also executes the transfers left queued at the last shutdown
+
+
+def stop_workers():
+    from workers.geocoding_worker import geocoding_worker
+    from workers.transfer_writer import transfer_writer
+    from workers.periodic_job import checkpoint_job, idempotency_purge_job, rebalance_job, replica_health_job
+
+    geocoding_worker.stop()
+    checkpoint_job.stop()
+    idempotency_purge_job.stop()
+    rebalance_job.stop()
+    replica_health_job.stop()
+    transfer_writer.stop()
+
 
-app = FastAPI()
-app.include_router(user.router)
-app.include_router(account.router)
-app.include_router(transaction.router)
+def __getattr__(name: str):
+    """
+    Builds the default application on first access to main.app (uvicorn main:app), importing this module is cheap
+    """
 
+    if name != "app":
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    global app
+    app = create_app()
+    return app
@@ -1,4 +1,5 @@
-from typing import Optional
+from datetime import datetime
+from typing import Dict, Optional, Union
 from pydantic import BaseModel
 
 
@@ -15,3 +16,58 @@ class Account(BaseModel):
     number: str
     balance: Optional[float] = 0.0
     user_id: int
+
+
+class Balance(BaseModel):
+    """
+    Model class representing the balance of an account at a given date
+
+    Attributes:
+        number: account number
+        balance: balance in EURO
+        as_of: date (UTC) of the balance
+    """
+
+    number: str
+    balance: float
+    as_of: datetime
+
+
+class BalanceSummary(BaseModel):
+    """
+    Model class summarizing the accounts of a user
+
+    Attributes:
+        user_id: owner ID
+        account_count: number of accounts
+        total: sum of the balances in EURO
+        min_balance: lowest balance, None without account
+        max_balance: highest balance, None without account
+    """
+
+    user_id: int
+    account_count: int
+    total: float
+    min_balance: Optional[float] = None
+    max_balance: Optional[float] = None
+
+
+class BalanceStats(BaseModel):
+    """
+    Model class giving the balance totals and distribution of a group of accounts
+
+    Attributes:
+        key: the group (user ID or IBAN country code), None for the whole bank
+        account_count: number of accounts
+        total: sum of the balances in EURO
+        min_balance: lowest balance
+        max_balance: highest balance
+        buckets: number of accounts per balance range (e.g. "100-1000" for balances from 100 included to 1000)
+    """
+
+    key: Optional[Union[int, str]] = None
+    account_count: int
+    total: float
+    min_balance: Optional[float] = None
+    max_balance: Optional[float] = None
+    buckets: Dict[str, int]
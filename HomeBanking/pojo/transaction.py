@@ -1,7 +1,14 @@
 from typing import Optional
-from datetime import date
+from datetime import date, datetime
 from pydantic import BaseModel
 
+DIRECTION_IN = "in"  # transfers received by an account
+DIRECTION_OUT = "out"  # transfers sent by an account
+DIRECTION_ALL = "all"  # transfers received or sent by an account
+TRANSFER_PENDING = "pending"  # queued transfer not executed yet
+TRANSFER_DONE = "done"  # queued transfer executed
+TRANSFER_FAILED = "failed"  # queued transfer refused by the checks of the transfer
+
 
 class Transaction(BaseModel):
     """
@@ -12,9 +19,11 @@ class Transaction(BaseModel):
         amount: amount in EURO that was transferred
         from_acc: source account number
         to_acc: destination account number
+        date: date and time of the transfer (set by the database)
     """
 
     id: Optional[int] = None
     amount: float
     from_acc: str
     to_acc: str
+    date: Optional[datetime] = None
@@ -2,6 +2,11 @@ from typing import Optional
 from datetime import date
 from pydantic import BaseModel
 
+GEOCODING_PENDING = "pending"  # the address has not been located yet
+GEOCODING_DONE = "done"  # the address has been located
+GEOCODING_NOT_FOUND = "not_found"  # the address cannot be located
+GEOCODING_FAILED = "failed"  # the geocoder failed settings.geocoding_max_attempts times on the address
+
 
 class BaseUser(BaseModel):
     """
@@ -38,8 +43,10 @@ class User(BaseUser):
     Attributes:
         id: user ID
         coordinates: geographical location dynamically calculated from the address
+        geocoding_status: progress of the geographical location calculation (pending, done, not_found or failed)
     """
     id: Optional[int] = None
     coordinates: Optional[Coordinates] = None
+    geocoding_status: Optional[str] = None
 
 
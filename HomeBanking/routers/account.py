@@ -1,58 +1,212 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Body, Depends, Header, Query, Request
+from sqlalchemy.ext.asyncio import AsyncSession
+from db.database import get_request_db, get_request_read_db
 from dao.account_dao import *
+from dao import async_account_dao, async_ledger_dao, async_shard_dao
+from util.iban import validate_ibans
 from routers.util import *
 from pojo.account import Account as AccountPOJO
-from typing import Optional
+from pydantic import ValidationError
+from datetime import datetime
+from typing import List, Optional
 
 router = APIRouter()
 
 
 @router.get("/accounts/{user_id}")
-def get_user_accounts(user_id: int):
+async def get_user_accounts(user_id: int, after: Optional[str] = None,
+                            limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                            session: AsyncSession = Depends(get_request_read_db)):
     """
     Endpoint to retrieve the accounts information based on a provided user ID
 
     :param user_id: the user ID to whom the accounts belong
+    :param after: number of the last account of the previous page
+    :param limit: page size (the X-Next-After header gives the after parameter of the next page)
     :return: the user accounts
     :rtype: List[Account]
     :raises HTTPException (code 500): unexpected internal server error
     """
 
     try:
-        return get_accounts(user_id)
+        return json_response(await async_account_dao.get_account_rows(user_id, after, limit, session), limit, "number")
     except Exception as e:
         print_error(e)
 
 
 @router.get("/accounts/")
-def get_all_accounts():
+async def get_all_accounts(request: Request, after: Optional[str] = None,
+                           limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                           session: AsyncSession = Depends(get_request_read_db)):
     """
-    Endpoint to retrieve the information of all the accounts
+    Endpoint to retrieve the information of all the accounts.
+    With the header Accept: application/x-ndjson, the accounts are streamed (one JSON document per line)
+    :param after: number of the last account of the previous page
+    :param limit: page size (the X-Next-After header gives the after parameter of the next page)
     :return: a list of accounts
     :rtype: List[Account]
     :raises HTTPException (code 500): unexpected internal server error
     """
 
     try:
-        return get_accounts(None)
+        if wants_ndjson(request):
+            return ndjson_response(async_account_dao.stream_accounts(None, after, limit))
+        return json_response(await async_account_dao.get_account_rows(None, after, limit, session), limit, "number")
     except Exception as e:
         print_error(e)
 
 
 @router.post("/create_account/")
-def create_new_account(number: str, user_id: int, balance: Optional[float] = 0.0):
+async def create_new_account(number: str, user_id: int, request: Request, balance: Optional[float] = 0.0,
+                             idempotency_key: Optional[str] = Header(None, max_length=MAX_IDEMPOTENCY_KEY_LENGTH),
+                             session: AsyncSession = Depends(get_request_db)):
     """
-    Endpoint to create an account and attach it to an existing user
+    Endpoint to create an account and attach it to an existing user.
+    A creation retried with the same Idempotency-Key header is answered like the first one
     :param number: account number to create (IBAN)
     :param balance: amount of money on this account
     :param user_id: user owning this account
+    :param idempotency_key: key chosen by the client, identical for every retry of the creation
     :return: true if the creation is successful
-    :raises HTTPException (code 422) if the user ID is unknown or if the account number format is invalid
+    :raises HTTPException (code 422) if the user ID is unknown, if the account number format is invalid or if the
+    idempotency key was used by a different request
     :raises HTTPException (code 500): unexpected internal server error
     """
 
     try:
-        create_account(AccountPOJO(number=number, balance=balance, user_id=user_id))
+        account = AccountPOJO(number=number, balance=balance, user_id=user_id)
+        return await run_idempotent(request, session, idempotency_key, {'ok': True},
+                                    lambda record: async_account_dao.create_account(account, session, record))
+    except BankingException as e:
+        return wrap_error_msg(e)
+    except Exception as e:
+        print_error(e)
+
+
+@router.post("/accounts/bulk")
+async def create_accounts_in_bulk(request: Request, session: AsyncSession = Depends(get_request_db)):
+    """
+    Endpoint to create a list of accounts in a single database transaction.
+    The body is either a JSON list of accounts or NDJSON (one account per line, content type application/x-ndjson),
+    each account having the fields number, user_id and optionally balance
+    :return: for each account, ok if it was created or the error explaining why it was refused
+    :raises HTTPException (code 422) if the body is malformed
+    :raises HTTPException (code 500): unexpected internal server error
+    """
+
+    try:
+        accounts = parse_items(await request.body(), request.headers.get("content-type", ""), AccountPOJO,
+                               "accounts")
+    except (ValueError, TypeError, ValidationError) as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    try:
+        errors = await async_account_dao.create_accounts(accounts, session)
+        return [{'ok': True} if error is None else {'ok': False, 'detail': error} for error in errors]
+    except Exception as e:
+        print_error(e)
+
+
+@router.post("/accounts/validate")
+def validate_account_numbers(numbers: List[str] = Body(...)):
+    """
+    Endpoint to check the format and the checksum of a list of account numbers (IBAN) in one request.
+    The endpoint is synchronous since the validation is CPU-bound
+    :param numbers: the account numbers to check (JSON list)
+    :return: the validity of each account number, in order
+    :rtype: List[bool]
+    :raises HTTPException (code 500): unexpected internal server error
+    """
+
+    try:
+        return validate_ibans(numbers)
+    except Exception as e:
+        print_error(e)
+
+
+@router.get("/users/{user_id}/summary")
+async def get_user_summary(user_id: int, session: AsyncSession = Depends(get_request_read_db)):
+    """
+    Endpoint to retrieve the account count, total, lowest and highest balance of a user, aggregated by the database
+    :param user_id: the user ID
+    :return: the summary
+    :rtype: BalanceSummary
+    :raises HTTPException (code 422) if the user ID is unknown
+    :raises HTTPException (code 500): unexpected internal server error
+    """
+
+    try:
+        return await async_account_dao.get_user_summary(user_id, session)
+    except BankingException as e:
+        return wrap_error_msg(e)
+    except Exception as e:
+        print_error(e)
+
+
+@router.get("/stats/balances")
+async def get_balance_stats(group_by: Optional[str] = Query(None, regex=f"^({GROUP_BY_USER}|{GROUP_BY_COUNTRY})$"),
+                            after: Optional[str] = None,
+                            limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                            session: AsyncSession = Depends(get_request_read_db)):
+    """
+    Endpoint to retrieve the balance totals and distribution (number of accounts per balance range) of the bank,
+    computed with a GROUP BY in the database and cached for a short time
+    :param group_by: user, country (of the IBAN) or nothing for the whole bank
+    :param after: key of the last group of the previous page
+    :param limit: page size (the X-Next-After header gives the after parameter of the next page)
+    :return: the statistics of each group
+    :rtype: List[BalanceStats]
+    :raises HTTPException (code 422) if the group_by or after parameter is invalid
+    :raises HTTPException (code 500): unexpected internal server error
+    """
+
+    if group_by == GROUP_BY_USER and after is not None and not after.lstrip("-").isdigit():
+        raise HTTPException(status_code=422, detail="after must be a user ID")
+    try:
+        stats = await async_account_dao.get_balance_stats(group_by, after, limit, session)
+        return json_response([item.dict() for item in stats], limit, "key")
+    except Exception as e:
+        print_error(e)
+
+
+@router.get("/accounts/{number}/balance")
+async def get_account_balance(number: str, as_of: Optional[datetime] = None,
+                              session: AsyncSession = Depends(get_request_read_db)):
+    """
+    Endpoint to retrieve the balance of an account at a given date, computed from the latest balance checkpoint
+    before this date and the ledger entries written since
+    :param number: the account number
+    :param as_of: date of the balance (UTC unless a time zone is given), the current balance is returned if None
+    :return: the balance
+    :rtype: Balance
+    :raises HTTPException (code 422) if the account number is unknown
+    :raises HTTPException (code 500): unexpected internal server error
+    """
+
+    try:
+        return await async_ledger_dao.get_balance(number, as_of, session)
+    except BankingException as e:
+        return wrap_error_msg(e)
+    except Exception as e:
+        print_error(e)
+
+
+@router.put("/accounts/{number}/shards")
+async def set_account_shards(number: str, count: int = Query(..., ge=0),
+                             session: AsyncSession = Depends(get_request_db)):
+    """
+    Endpoint to turn an account into a hot account, whose balance is split into shards so that concurrent
+    transfers do not all wait for the lock of the account row (0 shard turns it back into a regular account).
+    The balance of the account is unchanged
+    :param number: the account number
+    :param count: the number of shards
+    :return: true if the change is successful
+    :raises HTTPException (code 422) if the account number is unknown or the number of shards is too large
+    :raises HTTPException (code 500): unexpected internal server error
+    """
+
+    try:
+        await async_shard_dao.set_shard_count(number, count, session)
         return {'ok': True}
     except BankingException as e:
         return wrap_error_msg(e)
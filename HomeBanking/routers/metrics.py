@@ -0,0 +1,16 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from util import metrics
+
+router = APIRouter()
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """
+    Endpoint exposing the metrics of the process in the Prometheus text format: latency and status codes per route,
+    SQL statements per request, connection pool usage and geocoder calls
+    :return: the metrics
+    """
+
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
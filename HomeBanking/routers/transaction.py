@@ -1,28 +1,131 @@
-from fastapi import APIRouter
+from datetime import datetime
+from typing import Optional
+from fastapi import APIRouter, Depends, Header, Query, Request, Response, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from db.database import get_request_db, get_request_read_db
+from pydantic import ValidationError
 from dao.transaction_dao import *
+from dao import async_transaction_dao
 from routers.util import *
-from pojo.transaction import Transaction
+from pojo.transaction import Transaction, DIRECTION_IN, DIRECTION_OUT, DIRECTION_ALL, TRANSFER_PENDING
+from workers.transfer_writer import transfer_writer
 
 router = APIRouter()
 
 
 @router.post("/transfer/")
-def transfer_money(from_acc: str, to_acc: str, amount: float):
+async def transfer_money(from_acc: str, to_acc: str, amount: float, request: Request, queued: bool = False,
+                         idempotency_key: Optional[str] = Header(None, max_length=MAX_IDEMPOTENCY_KEY_LENGTH),
+                         session: AsyncSession = Depends(get_request_db)):
     """
-    Endpoint to transfer money from a source account to a destination account
+    Endpoint to transfer money from a source account to a destination account.
+    A transfer retried with the same Idempotency-Key header is executed only once.
+    A queued transfer is only checked for its amount and accounts, then written to the transfer queue and executed
+    shortly after with other queued transfers in a single database transaction (GET /transfer/{id} gives its status)
     :param from_acc: source account number
     :param to_acc: destination account number
     :param amount: money to transfer
-    :return: ok if the transfer is successful
-    :raises HTTPException (code 422) if the amount to transfer is negative or if the account numbers are unknown
+    :param queued: queues the transfer instead of executing it
+    :param idempotency_key: key chosen by the client, identical for every retry of the transfer
+    :return: ok if the transfer is successful, or the ID and pending status of a queued transfer (code 202)
+    :raises HTTPException (code 422) if the amount to transfer is negative, if the account numbers are unknown or if
+    the idempotency key was used by a different request (or sent with a queued transfer)
     :raises HTTPException (code 500): unexpected internal server error
     """
 
     try:
-        transfer(Transaction(from_acc=from_acc, to_acc=to_acc, amount=amount))
-        return {'ok': True}
+        transaction = Transaction(from_acc=from_acc, to_acc=to_acc, amount=amount)
+        if queued:
+            if idempotency_key is not None:
+                raise BankingException(QUEUED_IDEMPOTENCY_KEY)
+            await async_transaction_dao.check_queued_transfer(transaction, session)
+            transfer_id = await run_in_threadpool(transfer_writer.submit, transaction)
+            return ORJSONResponse({"id": transfer_id, "status": TRANSFER_PENDING}, status_code=202)
+        return await run_idempotent(request, session, idempotency_key, {'ok': True},
+                                    lambda record: async_transaction_dao.transfer(transaction, session, record))
     except BankingException as e:
         return wrap_error_msg(e)
     except Exception as e:
         print_error(e)
 
+
+@router.get("/transfer/{transfer_id}")
+async def get_transfer_status(transfer_id: str, session: AsyncSession = Depends(get_request_db)):
+    """
+    Endpoint to retrieve the status of a queued transfer
+    :param transfer_id: the ID returned when the transfer was queued
+    :return: the ID and the status of the transfer (pending, done or failed with the error detail)
+    :raises HTTPException (code 422) if the transfer ID is unknown
+    :raises HTTPException (code 500): unexpected internal server error
+    """
+
+    try:
+        status = transfer_writer.status(transfer_id) or \
+            await async_transaction_dao.get_queued_status(transfer_id, session)
+        if status is None:
+            raise BankingException(UNKNOWN_TRANSFER)
+        return status
+    except BankingException as e:
+        return wrap_error_msg(e)
+    except Exception as e:
+        print_error(e)
+
+
+@router.post("/transfers/batch")
+async def transfer_money_batch(request: Request, session: AsyncSession = Depends(get_request_db)):
+    """
+    Endpoint to execute a list of transfers in a single database transaction.
+    The body is either a JSON list of transfers or NDJSON (one transfer per line, content type application/x-ndjson),
+    each transfer having the fields from_acc, to_acc and amount
+    :return: for each transfer, ok if it was executed or the error explaining why it was refused
+    :raises HTTPException (code 422) if the body is malformed
+    :raises HTTPException (code 500): unexpected internal server error
+    """
+
+    try:
+        transactions = parse_items(await request.body(), request.headers.get("content-type", ""), Transaction,
+                                   "transfers")
+    except (ValueError, TypeError, ValidationError) as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    try:
+        errors = await async_transaction_dao.transfer_batch(transactions, session)
+        return [{'ok': True} if error is None else {'ok': False, 'detail': error} for error in errors]
+    except Exception as e:
+        print_error(e)
+
+
+@router.get("/accounts/{number}/transfers")
+async def get_account_transfers(number: str, response: Response,
+                                date_from: Optional[datetime] = Query(None, alias="from"),
+                                date_to: Optional[datetime] = Query(None, alias="to"),
+                                direction: str = Query(DIRECTION_ALL,
+                                                       regex=f"^({DIRECTION_IN}|{DIRECTION_OUT}|{DIRECTION_ALL})$"),
+                                after: Optional[int] = None,
+                                limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+                                session: AsyncSession = Depends(get_request_read_db)):
+    """
+    Endpoint to retrieve the history of an account, most recent transfers first
+    :param number: the account number
+    :param date_from: only returns the transfers performed from this date (included)
+    :param date_to: only returns the transfers performed before this date (excluded)
+    :param direction: in (received transfers), out (sent transfers) or all
+    :param after: ID of the last transfer of the previous page
+    :param limit: page size (the X-Next-After header gives the after parameter of the next page)
+    :return: the list of transfers
+    :rtype: List[Transaction]
+    :raises HTTPException (code 422) if the account number is unknown
+    :raises HTTPException (code 500): unexpected internal server error
+    """
+
+    try:
+        transfers = await async_transaction_dao.get_transfers(number, date_from, date_to, direction, after, limit,
+                                                              session)
+        set_next_page(response, transfers, limit, "id")
+        return transfers
+    except BankingException as e:
+        return wrap_error_msg(e)
+    except Exception as e:
+        print_error(e)
@@ -1,8 +1,14 @@
-from fastapi import APIRouter
+from typing import Optional
+from fastapi import APIRouter, Depends, Query, Request
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from db.database import get_request_db, get_request_read_db
 from dao.user_dao import *
+from dao import async_user_dao
 from pojo.user import BaseUser
 from routers.util import *
-from util.messages import BankingException
+from util import user_import
+from util.messages import BankingException, UNKNOWN_IMPORT_JOB
 router = APIRouter()
 
 
@@ -12,23 +18,53 @@ async def root():
 
 
 @router.get("/users")
-def list_users():
+async def list_users(request: Request, after: Optional[int] = None,
+                     limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                     session: AsyncSession = Depends(get_request_read_db)):
     """
-    Endpoint to retrieve the list of users
+    Endpoint to retrieve the list of users.
+    With the header Accept: application/x-ndjson, the users are streamed (one JSON document per line)
 
+    :param after: ID of the last user of the previous page
+    :param limit: page size (the X-Next-After header gives the after parameter of the next page)
     :return: list of users
     :rtype: List[User]
     :raises HTTPException (code 500): unexpected internal server error
     """
 
     try:
-        return get_users()
+        if wants_ndjson(request):
+            return ndjson_response(async_user_dao.stream_users(after, limit))
+        return json_response(await async_user_dao.get_user_rows(after, limit, session), limit, "id")
+    except Exception as e:
+        print_error(e)
+
+
+@router.get("/users/nearby")
+async def list_nearby_users(lat: float = Query(..., ge=-90, le=90), lon: float = Query(..., ge=-180, le=180),
+                            radius_km: float = Query(..., gt=0, le=20000),
+                            limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+                            session: AsyncSession = Depends(get_request_read_db)):
+    """
+    Endpoint to retrieve the located users within a distance of a location, nearest first
+
+    :param lat: latitude of the location in degrees
+    :param lon: longitude of the location in degrees
+    :param radius_km: maximum distance in kilometers
+    :param limit: maximum number of users to return
+    :return: list of users, each one with its distance_km
+    :rtype: List[User]
+    :raises HTTPException (code 500): unexpected internal server error
+    """
+
+    try:
+        return json_response(await async_user_dao.get_nearby_users(lat, lon, radius_km, limit, session))
     except Exception as e:
         print_error(e)
 
 
 @router.get("/user/{user_id}")
-def get_user_by_id(user_id: int):
+async def get_user_by_id(user_id: int, session: AsyncSession = Depends(get_request_db)):
     """
     Endpoint to retrieve user information based on the provided user ID
 
@@ -40,7 +76,7 @@ def get_user_by_id(user_id: int):
     """
 
     try:
-        user = get_user(user_id)
+        user = await async_user_dao.get_user(user_id, session)
         return user
     except BankingException as e:
         return wrap_error_msg(e)
@@ -49,7 +85,8 @@ def get_user_by_id(user_id: int):
 
 
 @router.post("/create_user/")
-def create_new_user(firstname: str, lastname: str, address: str):
+async def create_new_user(firstname: str, lastname: str, address: str,
+                          session: AsyncSession = Depends(get_request_db)):
     """
     Endpoint to create a new user and calculates his/her geographical location based on his/her provided address
 
@@ -61,14 +98,71 @@ def create_new_user(firstname: str, lastname: str, address: str):
     """
 
     try:
-        user_id = create_user(BaseUser(firstname=firstname, lastname=lastname, address=address))
+        user_id = await async_user_dao.create_user(BaseUser(firstname=firstname, lastname=lastname, address=address),
+                                                   session)
         return {"user_id": user_id}
     except Exception as e:
         print_error(e)
 
 
+@router.post("/users/bulk")
+async def import_users(request: Request, session: AsyncSession = Depends(get_request_db)):
+    """
+    Endpoint to create users in bulk from a streamed upload: CSV (content type text/csv, header line with the
+    firstname, lastname and address columns) or NDJSON (application/x-ndjson, one JSON object per line).
+    The upload is copied to a temporary file and imported in the background: the rows are validated and inserted
+    by chunks, and the users are located afterwards by the geocoding worker
+
+    :return: the report of the running job (code 202), its progress, the errors of the rejected lines and the
+    geocoding progress being given by GET /users/bulk/{job_id}
+    :raises HTTPException (code 415): the content type is neither CSV nor NDJSON
+    :raises HTTPException (code 500): unexpected internal server error
+    """
+
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("text/csv"):
+        data_format = user_import.FORMAT_CSV
+    elif content_type.startswith(NDJSON_MEDIA_TYPE):
+        data_format = user_import.FORMAT_NDJSON
+    else:
+        raise HTTPException(status_code=415, detail="text/csv or %s content expected" % NDJSON_MEDIA_TYPE)
+
+    try:
+        upload = await user_import.spool(request.stream())
+        job = user_import.ImportJob()
+        await async_user_dao.save_import_job(job, session)
+        user_import.start_import(job, upload, data_format, async_user_dao.insert_users, async_user_dao.save_import_job)
+        return ORJSONResponse(job.report(), status_code=202)
+    except Exception as e:
+        print_error(e)
+
+
+@router.get("/users/bulk/{job_id}")
+async def get_import_job(job_id: str, session: AsyncSession = Depends(get_request_db)):
+    """
+    Endpoint to follow a bulk user import
+
+    :param job_id: the job ID returned by POST /users/bulk
+    :return: the job report, with the number of created users not located yet
+    :raises HTTPException (code 422): the job ID is unknown
+    :raises HTTPException (code 500): unexpected internal server error
+    """
+
+    try:
+        job = await async_user_dao.get_import_job(job_id, session)
+        if job is None:
+            raise BankingException(UNKNOWN_IMPORT_JOB)
+        pending = await async_user_dao.count_pending_users(job_id, session) if job.imported else 0
+        return job.report(pending)
+    except BankingException as e:
+        return wrap_error_msg(e)
+    except Exception as e:
+        print_error(e)
+
+
 @router.put("/update_user/{user_id}")
-def update_user(user_id: int, firstname: str, lastname: str, address: str):
+async def update_user(user_id: int, firstname: str, lastname: str, address: str,
+                      session: AsyncSession = Depends(get_request_db)):
     """
     Endpoint to update user information based on a provided user ID
 
@@ -82,7 +176,8 @@ def update_user(user_id: int, firstname: str, lastname: str, address: str):
     """
 
     try:
-        modify_user(user_id, BaseUser(firstname=firstname, lastname=lastname, address=address))
+        await async_user_dao.modify_user(user_id, BaseUser(firstname=firstname, lastname=lastname, address=address),
+                                         session)
         return {'ok': True}
     except BankingException as e:
         return wrap_error_msg(e)
@@ -1,11 +1,148 @@
-from fastapi import HTTPException
-from util.messages import BankingException
+import hashlib
+import logging
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Type, Union
+import orjson
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from dao import idempotency_dao, async_idempotency_dao
+from util.messages import BankingException, UNEXPECTED_ERROR, CONCURRENT_UPDATE
+from util.metrics import http_unexpected_errors
+from util.retry import TransactionConflict
+
+logger = logging.getLogger("homebanking")
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+MAX_PAGE_SIZE = 1000  # maximum value of the limit parameter of the paginated endpoints
+NEXT_PAGE_HEADER = "X-Next-After"  # header giving the after parameter of the next page
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
 
 
 def wrap_error_msg(e: BankingException):
     raise HTTPException(status_code=422, detail=str(e))
 
 
+def wants_ndjson(request: Request) -> bool:
+    """
+    :return: true if the client asked for a streamed NDJSON response (Accept: application/x-ndjson)
+    """
+
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def parse_items(body: bytes, content_type: str, model: Type[BaseModel], name: str) -> List[BaseModel]:
+    """
+    Parses the body of a bulk request, either a JSON list or NDJSON (one JSON document per line, content type
+    application/x-ndjson)
+    :param body: the raw request body
+    :param content_type: the request content type
+    :param model: the model of the items
+    :param name: name of the items in the error message (e.g. accounts)
+    :return: the list of items
+    :raises ValueError: the body is neither a JSON list nor NDJSON
+    """
+
+    if content_type.startswith(NDJSON_MEDIA_TYPE):
+        items = [orjson.loads(line) for line in body.splitlines() if line.strip()]
+    else:
+        items = orjson.loads(body)
+        if not isinstance(items, list):
+            raise ValueError("A list of %s is expected" % name)
+    return [model(**item) for item in items]
+
+
+def ndjson_response(items: AsyncIterator[Union[BaseModel, dict]]) -> StreamingResponse:
+    """
+    Streams models as NDJSON (one JSON document per line) while they are read from the database
+    :param items: asynchronous iterator of models or of plain dictionaries (encoded with orjson)
+    """
+
+    async def lines():
+        async for item in items:
+            if isinstance(item, dict):
+                yield orjson.dumps(item) + b"\n"
+            else:
+                yield item.json() + "\n"
+
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE)
+
+
+def json_response(items: list, limit: int = None, key: str = None) -> ORJSONResponse:
+    """
+    Encodes plain dictionaries straight to JSON bytes with orjson, bypassing the pydantic validation and
+    serialization of the response (fast path of the list endpoints)
+    :param items: the items of the current page, as dictionaries
+    :param limit: the requested page size
+    :param key: the field used as cursor
+    """
+
+    response = ORJSONResponse(items)
+    set_next_page(response, items, limit, key)
+    return response
+
+
+def set_next_page(response: Response, items: list, limit: int, key: str):
+    """
+    Sets the header giving the cursor of the next page when the current page is full
+    :param response: the response of the paginated endpoint
+    :param items: the items of the current page (models or dictionaries)
+    :param limit: the requested page size
+    :param key: the attribute used as cursor
+    """
+
+    if limit is not None and len(items) == limit:
+        last = items[-1]
+        response.headers[NEXT_PAGE_HEADER] = str(last[key] if isinstance(last, dict) else getattr(last, key))
+
+
+def hash_request(request: Request) -> str:
+    """
+    :return: the SHA-256 of the method, path and parameters of a request, identifying it for its idempotency key
+    """
+
+    params = "&".join("%s=%s" % item for item in sorted(request.query_params.multi_items()))
+    return hashlib.sha256(("%s %s?%s" % (request.method, request.url.path, params)).encode()).hexdigest()
+
+
+async def run_idempotent(request: Request, session: AsyncSession, key: Optional[str], response: dict,
+                         operation: Callable[[object], Awaitable]) -> dict:
+    """
+    Executes a mutating request at most once per idempotency key. A retried request is answered with the stored
+    response (one primary key lookup), the key being recorded by the operation in the transaction of its writes
+    :param request: the HTTP request
+    :param session: the session of the request
+    :param key: the Idempotency-Key header, the operation is always executed if None
+    :param response: the response of the request when it succeeds
+    :param operation: executes the request, called with the record of the key to insert (None without key)
+    :return: the response
+    :raises BankingException: the key was used by a different request
+    """
+
+    if key is None:
+        await operation(None)
+        return response
+
+    request_hash = hash_request(request)
+    stored = await async_idempotency_dao.get_response(key, request_hash, session)
+    if stored is not None:
+        return stored
+    try:
+        await operation(idempotency_dao.new_record(key, request_hash, response))
+    except IntegrityError:
+        # a concurrent request with the same key was committed first
+        await session.rollback()
+        stored = await async_idempotency_dao.get_response(key, request_hash, session)
+        if stored is None:
+            raise
+        return stored
+    return response
+
+
 def print_error(e: Exception):
-    print("Unexpected error: ", str(e))
+    if isinstance(e, TransactionConflict):  # still failing after its retries, the client may retry later
+        raise HTTPException(status_code=503, detail=CONCURRENT_UPDATE, headers={"Retry-After": "1"})
+    logger.error("Unexpected error: %s", e, exc_info=e)
+    http_unexpected_errors.inc(type(e).__name__)
     raise HTTPException(status_code=500, detail=UNEXPECTED_ERROR)
@@ -1,4 +1,9 @@
 import json
+import datetime
+
+from sqlalchemy import event
+
+from db.database import get_async_engine
 
 import dao.account_dao
 import routers.account
@@ -157,6 +162,40 @@ def test_create_account_with_option_balance(client):
     assert account.user_id == user_id
 
 
+def test_create_account_idempotency_key(client):
+    """
+    Tests that a creation retried with the same idempotency key is answered like the first one
+    """
+
+    user_id = create_user(BaseUser(firstname="Loup", lastname="Meurice", address="rue Léopold 11, 5500 Dinant, Belgique"))
+    data = {"number": "FR7630006000011234567890189", "balance": 100, "user_id": user_id}
+    headers = {"Idempotency-Key": "create-1"}
+
+    assert client.post("/create_account/", params=data, headers=headers).json() == {"ok": True}
+    assert client.post("/create_account/", params=data, headers=headers).json() == {"ok": True}
+    assert client.post("/create_account/", params=data).status_code == 422  # already used account number
+
+
+def test_create_accounts_in_bulk(client):
+    """
+    Tests the bulk creation of accounts from JSON and NDJSON bodies
+    """
+
+    user_id = create_user(BaseUser(firstname="Loup", lastname="Meurice", address="rue Léopold 11, 5500 Dinant, Belgique"))
+    body = [{"number": "FR7630006000011234567890189", "balance": 100, "user_id": user_id},
+            {"number": "INVALID", "user_id": user_id}]
+    response = client.post("/accounts/bulk", json=body)
+    assert response.status_code == 200
+    assert response.json() == [{"ok": True}, {"ok": False, "detail": "This account number is invalid"}]
+
+    body = json.dumps({"number": "DE91100000000123456789", "user_id": user_id}) + "\n"
+    response = client.post("/accounts/bulk", content=body, headers={"content-type": "application/x-ndjson"})
+    assert response.json() == [{"ok": True}]
+    assert read_account("DE91100000000123456789").user_id == user_id
+
+    assert client.post("/accounts/bulk", json={"number": "x"}).status_code == 422
+
+
 def test_create_account_to_non_existent_user(client):
     """
     Tests the creation of a new account attached to a nonexitent user
@@ -190,3 +229,146 @@ def test_create_account_with_invalid_iban(client):
     response = client.post("/create_account/", params=data, )
     assert response.status_code == 422
 
+
+def test_get_accounts_by_page(client):
+    """
+    Tests the keyset pagination of the accounts
+    """
+
+    user_id1, user1, user_id2, user2, account1, account2 = create_test_users_and_accounts()
+
+    response = client.get("/accounts/", params={"limit": 1})
+    assert response.status_code == 200
+    assert [a["number"] for a in response.json()] == [account2.number]  # sorted by account number
+
+    response = client.get("/accounts/", params={"limit": 1, "after": response.headers["X-Next-After"]})
+    assert [a["number"] for a in response.json()] == [account1.number]
+
+    response = client.get(f"/accounts/{user_id1}", params={"after": account1.number})
+    assert response.json() == []
+
+
+def test_stream_accounts(client):
+    """
+    Tests the streaming of the accounts as NDJSON
+    """
+
+    user_id1, user1, user_id2, user2, account1, account2 = create_test_users_and_accounts()
+
+    response = client.get("/accounts/", headers={"accept": "application/x-ndjson"})
+    assert response.status_code == 200
+    accounts = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(a["number"] for a in accounts) == sorted([account1.number, account2.number])
+
+
+def test_create_account_uses_one_connection(client):
+    """
+    Tests that the account creation checks out a single pooled connection (one session per request)
+    """
+
+    user_id = create_user(BaseUser(firstname="Loup", lastname="Meurice", address="wrong address"))
+    checkouts = []
+
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        checkouts.append(connection_record)
+
+    pool = get_async_engine().sync_engine.pool
+    event.listen(pool, "checkout", on_checkout)
+    try:
+        response = client.post("/create_account/", params={"number": "FR7630006000011234567890189",
+                                                           "user_id": user_id})
+    finally:
+        event.remove(pool, "checkout", on_checkout)
+
+    assert response.status_code == 200
+    assert len(checkouts) == 1
+
+
+def test_get_user_summary(client):
+    """
+    Tests the summary of the accounts of a user
+    """
+
+    user_id1, user1, user_id2, user2, account1, account2 = create_test_users_and_accounts()
+
+    response = client.get(f"/users/{user_id1}/summary")
+    assert response.status_code == 200
+    assert response.json() == {"user_id": user_id1, "account_count": 1, "total": 100.0, "min_balance": 100.0,
+                               "max_balance": 100.0}
+    assert client.get("/users/-1/summary").status_code == 422
+
+
+def test_get_balance_stats(client):
+    """
+    Tests the balance statistics, cached for a short time
+    """
+
+    user_id1, user1, user_id2, user2, account1, account2 = create_test_users_and_accounts()
+
+    response = client.get("/stats/balances", params={"group_by": "country", "limit": 1})
+    assert response.status_code == 200
+    assert [stats["key"] for stats in response.json()] == ["DE"]
+    assert response.headers["X-Next-After"] == "DE"
+    response = client.get("/stats/balances", params={"group_by": "country", "after": "DE"})
+    assert [(stats["key"], stats["total"]) for stats in response.json()] == [("FR", 100.0)]
+
+    assert client.get("/stats/balances").json()[0]["total"] == 100.0
+    client.post("/transfer/", params={"from_acc": account1.number, "to_acc": account2.number, "amount": 40})
+    cached = client.get("/stats/balances")
+    assert cached.headers["X-SQL-Queries"] == "0"
+    assert cached.json()[0]["total"] == 100.0
+
+    assert client.get("/stats/balances", params={"group_by": "iban"}).status_code == 422
+    assert client.get("/stats/balances", params={"group_by": "user", "after": "x"}).status_code == 422
+
+
+def test_get_account_balance(client):
+    """
+    Tests the retrieval of the current balance and of a past balance of an account
+    """
+
+    user_id1, user1, user_id2, user2, account1, account2 = create_test_users_and_accounts()
+    as_of = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    client.post("/transfer/", params={"from_acc": account1.number, "to_acc": account2.number, "amount": 40})
+
+    response = client.get(f"/accounts/{account1.number}/balance")
+    assert response.status_code == 200
+    assert response.json()["balance"] == 60.0
+
+    response = client.get(f"/accounts/{account1.number}/balance", params={"as_of": as_of})
+    assert response.json()["balance"] == 100.0
+
+    response = client.get("/accounts/unknown/balance", params={"as_of": as_of})
+    assert response.status_code == 422
+
+
+def test_validate_account_numbers(client):
+    """
+    Tests the bulk validation of account numbers
+    """
+
+    response = client.post("/accounts/validate", json=["FR7630006000011234567890189", "FR76300060000112345678901",
+                                                        "DE91100000000123456789"])
+    assert response.status_code == 200
+    assert response.json() == [True, False, True]
+
+
+def test_hot_account(client):
+    """
+    Tests the transfers of a hot account through the API and the balance reported with its shards
+    """
+
+    user_id1, user1, user_id2, user2, account1, account2 = create_test_users_and_accounts()
+    response = client.put(f"/accounts/{account1.number}/shards", params={"count": 4})
+    assert response.status_code == 200
+    assert response.json() == {"ok": True}
+
+    client.post("/transfer/", params={"from_acc": account1.number, "to_acc": account2.number, "amount": 10})
+    client.post("/transfer/", params={"from_acc": account1.number, "to_acc": account2.number, "amount": 30})
+    client.post("/transfer/", params={"from_acc": account2.number, "to_acc": account1.number, "amount": 5})
+
+    assert client.get(f"/accounts/{user_id1}").json() == [{"number": account1.number, "balance": 65.0,
+                                                           "user_id": user_id1}]
+    assert client.get(f"/accounts/{account1.number}/balance").json()["balance"] == 65.0
+    assert client.put("/accounts/unknown/shards", params={"count": 2}).status_code == 422
+    assert client.put(f"/accounts/{account1.number}/shards", params={"count": 1000}).status_code == 422
@@ -15,12 +15,24 @@ from db.variables import settings
 
 DATABASE_URL = "sqlite:///./test_db.db"
 settings.db_url = DATABASE_URL
+# strict mode: a request executing more SQL statements than the budget fails
+settings.sql_debug_headers = True
+settings.sql_query_budget = 10
 
 # this is to include backend dir in sys.path so that we can import from db,main.py
 
-from db.database import Base
-from db.database import get_db
-from routers import account, transaction, user
+from db.database import Base, get_db
+from routers import account, transaction, user, metrics
+from dao.account_dao import create_account
+from dao.user_dao import create_user, _convert_to_sql
+from pojo.account import Account
+from pojo.user import BaseUser, Coordinates, User
+from util import entity_cache, util
+from util.geocoder import StubGeocoder
+from dao.account_dao import stats_cache
+from dao.shard_dao import hot_accounts_cache
+from util.metrics import MetricsMiddleware
+from util.query_counter import QueryCounterMiddleware
 
 
 def start_application():
@@ -28,6 +40,9 @@ def start_application():
     app.include_router(account.router)
     app.include_router(user.router)
     app.include_router(transaction.router)
+    app.include_router(metrics.router)
+    app.add_middleware(MetricsMiddleware)
+    app.add_middleware(QueryCounterMiddleware)
     return app
 
 
@@ -37,6 +52,9 @@ engine = create_engine(
 # Use connect_args parameter only with sqlite
 SessionTesting = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+USER_ADDRESS = "rue Comte Jacques de Meeus, 13, 1428 Lillois, Belgique"  # address of the test users
+USER_LOCATION = (50.64842575, 4.372272362912566)
+
 
 @pytest.fixture(scope="function")
 def app() -> Generator[FastAPI, Any, None]:
@@ -47,6 +65,9 @@ def app() -> Generator[FastAPI, Any, None]:
     _app = start_application()
     yield _app
     Base.metadata.drop_all(engine)
+    entity_cache.clear()  # the IDs and account numbers are reused by the next test
+    stats_cache.clear()
+    hot_accounts_cache.clear()
 
 
 @pytest.fixture(scope="function")
@@ -65,17 +86,64 @@ def client(
         app: FastAPI, db_session: SessionTesting
 ) -> Generator[TestClient, Any, None]:
     """
-    Create a new FastAPI TestClient that uses the `db_session` fixture to override
-    the `get_db` dependency that is injected into routes.
+    Create a new FastAPI TestClient. The routes are not overridden: their asyncio sessions (get_request_db and
+    get_request_read_db) use the engines of the application, on the SQLite test database created by the `app` fixture
     """
 
-    def _get_test_db():
-        try:
-            yield db_session
-        finally:
-            pass
-
-    app.dependency_overrides[get_db] = _get_test_db
-
     with TestClient(app) as client:
         yield client
+
+
+@pytest.fixture(scope="function")
+def user_with_accounts(app: FastAPI):
+    """
+    Creates a user owning two accounts, the first one with a balance of 100
+    :return: the (user ID, first account, second account) tuple
+    """
+
+    user_id = create_user(BaseUser(firstname="Loup",
+                                   lastname="Meurice",
+                                   address=USER_ADDRESS))
+    account1 = Account(number="FR7630006000011234567890189", balance=100, user_id=user_id)
+    account2 = Account(number="DE91100000000123456789", user_id=user_id)
+    create_account(account1)
+    create_account(account2)
+    return user_id, account1, account2
+
+
+@pytest.fixture(scope="function")
+def located_users(app: FastAPI):
+    """
+    Creates 3 located users (Brussels, Antwerp and Paris) and a user not located yet
+    :return: the user IDs indexed by city
+    """
+
+    cities = {"Brussels": (50.8503, 4.3517), "Antwerp": (51.2194, 4.4025), "Paris": (48.8566, 2.3522), "Nowhere": None}
+    session = get_db()
+    try:
+        users = {}
+        for city, location in cities.items():
+            coordinates = Coordinates(latitude=location[0], longitude=location[1]) if location else None
+            users[city] = _convert_to_sql(User(firstname="Loup", lastname="Meurice", address=city,
+                                               coordinates=coordinates))
+            session.add(users[city])
+        session.commit()
+        return {city: user.id for city, user in users.items()}
+    finally:
+        session.close()
+
+
+@pytest.fixture(scope="function")
+def stub_geocoder(monkeypatch):
+    """
+    Installs a StubGeocoder locating the address of the test users, without rate limit, so that the geocoding
+    pipeline runs offline (the other addresses are not found)
+    :return: the geocoder
+    """
+
+    geocoder = StubGeocoder({USER_ADDRESS: USER_LOCATION})
+    previous = util.geocoder
+    util.set_geocoder(geocoder)
+    monkeypatch.setattr(util.geocoder_rate_limiter, "rate", None)
+    yield geocoder
+    util.set_geocoder(previous)
@@ -2,11 +2,15 @@ import pytest
 import datetime
 
 from tests.conftest import client, app, db_session
-from dao.account_dao import get_accounts, get_account, create_account
+from dao.account_dao import get_accounts, get_account, get_account_rows, create_account, get_user_summary, \
+    get_balance_stats, GROUP_BY_USER, GROUP_BY_COUNTRY, create_accounts
+from dao.ledger_dao import get_balance
+from util.query_counter import count_queries
 from dao.user_dao import create_user
 from pojo.user import BaseUser
 from pojo.account import Account
-from util.messages import BankingException
+from util.messages import BankingException, INVALID_ACCOUNT_NUMBER, UNKNOWN_USER_ID, ALREADY_USED_ACCOUNT_NUMBER
+from db.database import get_db
 
 
 @pytest.fixture(autouse=True)
@@ -137,3 +141,99 @@ def test_get_unknown_account():
     """
 
     assert get_account("unknown") is None
+
+
+def test_create_account_with_caller_session():
+    """
+    Tests the account creation within a session provided by the caller
+    """
+
+    user_id = create_test_user()
+    account = Account(number="FR7630006000011234567890189", user_id=user_id)
+
+    session = get_db()
+    try:
+        create_account(account, session)
+        assert get_account(account.number, session).user_id == user_id
+    finally:
+        session.close()
+
+
+def test_get_account_rows():
+    """
+    Tests that the column-only accounts query returns the same fields as the Account model
+    """
+
+    user_id = create_test_user()
+    create_account(Account(number="FR7630006000011234567890189", balance=100, user_id=user_id))
+    create_account(Account(number="DE91100000000123456789", user_id=user_id))
+
+    assert get_account_rows(user_id) == [account.dict() for account in get_accounts(user_id)]
+    assert get_account_rows(None, limit=1) == [{"number": "DE91100000000123456789", "balance": 0.0,
+                                               "user_id": user_id}]
+
+
+def test_get_user_summary():
+    """
+    Tests the aggregation of the accounts of a user
+    """
+
+    user_id = create_test_user()
+    summary = get_user_summary(user_id)
+    assert (summary.account_count, summary.total, summary.min_balance) == (0, 0.0, None)
+
+    create_account(Account(number="FR7630006000011234567890189", balance=100, user_id=user_id))
+    create_account(Account(number="DE91100000000123456789", balance=20, user_id=user_id))
+    summary = get_user_summary(user_id)
+    assert (summary.account_count, summary.total, summary.min_balance, summary.max_balance) == (2, 120.0, 20.0, 100.0)
+
+    with pytest.raises(BankingException):
+        get_user_summary(-1)
+
+
+def test_get_balance_stats():
+    """
+    Tests the balance statistics of the bank, by user and by country
+    """
+
+    user_id1 = create_test_user()
+    user_id2 = create_test_user()
+    create_account(Account(number="FR7630006000011234567890189", balance=100, user_id=user_id1))
+    create_account(Account(number="DE91100000000123456789", balance=20, user_id=user_id1))
+    create_account(Account(number="DE89370400440532013000", balance=5000, user_id=user_id2))
+
+    [bank] = get_balance_stats()
+    assert (bank.key, bank.account_count, bank.total, bank.min_balance, bank.max_balance) == \
+           (None, 3, 5120.0, 20.0, 5000.0)
+    assert bank.buckets == {"<0": 0, "0-100": 1, "100-1000": 1, "1000-10000": 1, "10000-100000": 0, ">=100000": 0}
+
+    assert [(stats.key, stats.account_count, stats.total) for stats in get_balance_stats(GROUP_BY_COUNTRY)] == \
+           [("DE", 2, 5020.0), ("FR", 1, 100.0)]
+    assert [(stats.key, stats.total) for stats in get_balance_stats(GROUP_BY_USER, str(user_id1), 10)] == \
+           [(user_id2, 5000.0)]
+
+
+def test_create_accounts():
+    """
+    Tests the bulk creation of accounts with set-based checks and per-account errors
+    """
+
+    user_id = create_test_user()
+    create_account(Account(number="FR7630006000011234567890189", user_id=user_id))
+    accounts = [Account(number="DE91100000000123456789", balance=10, user_id=user_id),
+                Account(number="INVALID", user_id=user_id),
+                Account(number="DE89370400440532013000", user_id=-1),
+                Account(number="FR7630006000011234567890189", user_id=user_id),
+                Account(number="DE91100000000123456789", user_id=user_id),
+                Account(number="BE71096123456769", balance=5, user_id=user_id)]
+
+    get_account("BE71096123456769")  # caches the absence of the account
+    with count_queries() as queries:
+        results = create_accounts(accounts)
+    assert results == [None, INVALID_ACCOUNT_NUMBER, UNKNOWN_USER_ID, ALREADY_USED_ACCOUNT_NUMBER,
+                       ALREADY_USED_ACCOUNT_NUMBER, None]
+    assert queries.count == 4  # owners and numbers IN queries, accounts and checkpoints inserts
+
+    assert get_account("BE71096123456769").balance == 5
+    assert get_balance("DE91100000000123456789").balance == 10
+    assert len(get_accounts(user_id)) == 3
@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+from tests.conftest import client, app, db_session
+from dao import async_user_dao, async_account_dao, async_transaction_dao
+from pojo.user import BaseUser
+from pojo.account import Account
+from pojo.transaction import Transaction
+from util.messages import BankingException, NOT_ENOUGH_MONEY
+
+
+@pytest.fixture(autouse=True)
+def init(app, client, db_session):
+    """
+    Required to initialize the SQLite test database
+    """
+    pass
+
+
+async def create_user_with_accounts():
+    user = BaseUser(firstname="Loup",
+                    lastname="Meurice",
+                    address="rue Comte Jacques de Meeus, 13, 1428 Lillois, Belgique")
+    user_id = await async_user_dao.create_user(user)
+    account1 = Account(number="FR7630006000011234567890189", balance=100, user_id=user_id)
+    account2 = Account(number="DE91100000000123456789", user_id=user_id)
+    await async_account_dao.create_account(account1)
+    await async_account_dao.create_account(account2)
+    return user_id, account1, account2
+
+
+def test_create_and_read_user():
+    """
+    Tests the user creation and retrieval through the asyncio DAO
+    """
+
+    async def scenario():
+        user = BaseUser(firstname="Loup", lastname="Meurice", address="malformed address")
+        user_id = await async_user_dao.create_user(user)
+        user2 = await async_user_dao.get_user(user_id)
+        users = await async_user_dao.get_users()
+        return user, user2, users
+
+    user, user2, users = asyncio.run(scenario())
+    assert user2.firstname == user.firstname
+    assert user2.coordinates is None
+    assert len(users) == 1
+
+
+def test_modify_unknown_user():
+    """
+    Tests the modification of an unknown user through the asyncio DAO
+    """
+
+    user = BaseUser(firstname="Loup", lastname="Meurice", address="malformed address")
+    with pytest.raises(BankingException):
+        asyncio.run(async_user_dao.modify_user(-1, user))
+
+
+def test_create_account_already_used():
+    """
+    Tests that an account number cannot be used twice through the asyncio DAO
+    """
+
+    async def scenario():
+        user_id, account1, account2 = await create_user_with_accounts()
+        await async_account_dao.create_account(account1)
+
+    with pytest.raises(BankingException):
+        asyncio.run(scenario())
+
+
+def test_transfer():
+    """
+    Tests the money transfer between two accounts through the asyncio DAO
+    """
+
+    async def scenario():
+        user_id, account1, account2 = await create_user_with_accounts()
+        await async_transaction_dao.transfer(Transaction(from_acc=account1.number, to_acc=account2.number,
+                                                         amount=25.0))
+        errors = await async_transaction_dao.transfer_batch(
+            [Transaction(from_acc=account1.number, to_acc=account2.number, amount=100.0)])
+        return errors, await async_account_dao.get_accounts(user_id)
+
+    errors, accounts = asyncio.run(scenario())
+    assert errors == [NOT_ENOUGH_MONEY]
+    assert {a.number: a.balance for a in accounts} == {"FR7630006000011234567890189": 75.0,
+                                                       "DE91100000000123456789": 25.0}
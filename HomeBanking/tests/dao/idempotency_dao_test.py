@@ -0,0 +1,56 @@
+import datetime
+
+import pytest
+
+from tests.conftest import client, app, db_session
+from dao.account_dao import get_account
+from dao.idempotency_dao import new_record, get_response, purge_expired
+from dao.transaction_dao import transfer
+from db.database import get_db
+from pojo.transaction import Transaction
+from util.messages import BankingException, IDEMPOTENCY_KEY_REUSED
+
+
+@pytest.fixture(autouse=True)
+def init(app, client, db_session):
+    """
+    Required to initialize the SQLite test database
+    """
+    pass
+
+
+def test_record_with_transfer(user_with_accounts):
+    """
+    Tests that the key is recorded by the transfer transaction and checked against the request hash
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    assert get_response("key", "hash") is None
+    transfer(Transaction(from_acc=account1.number, to_acc=account2.number, amount=10.0),
+             idempotency_record=new_record("key", "hash", {"ok": True}))
+    assert get_response("key", "hash") == {"ok": True}
+    assert get_account(account1.number).balance == 90.0
+
+    with pytest.raises(BankingException) as e:
+        get_response("key", "other hash")
+    assert str(e.value) == IDEMPOTENCY_KEY_REUSED
+
+
+def test_purge_expired():
+    """
+    Tests that the expired keys are purged and ignored until then
+    """
+
+    session = get_db()
+    try:
+        expired = new_record("expired", "hash", {"ok": True})
+        expired.expires_at = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+        session.add_all([expired, new_record("valid", "hash", {"ok": True})])
+        session.commit()
+    finally:
+        session.close()
+
+    assert get_response("valid", "hash") == {"ok": True}
+    assert purge_expired() == 1
+    assert get_response("expired", "hash") is None
+    assert get_response("valid", "hash") == {"ok": True}
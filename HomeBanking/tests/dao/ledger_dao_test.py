@@ -0,0 +1,79 @@
+import datetime
+
+import pytest
+
+from sqlalchemy import delete
+
+from tests.conftest import client, app, db_session
+from dao.ledger_dao import get_balance, checkpoint_balances, PRE_LEDGER_DATE
+from db.database import get_db
+from db.tables.ledger import BalanceCheckpoint
+from dao.transaction_dao import transfer, transfer_batch
+from pojo.transaction import Transaction
+from util.messages import BankingException
+
+
+@pytest.fixture(autouse=True)
+def init(app, client, db_session):
+    """
+    Required to initialize the SQLite test database
+    """
+    pass
+
+
+def test_get_balance_as_of(user_with_accounts):
+    """
+    Tests the balance of an account at several dates, before and after a checkpoint
+    """
+
+    before = datetime.datetime(2000, 1, 1)
+    user_id, account1, account2 = user_with_accounts
+    transfer(Transaction(from_acc=account1.number, to_acc=account2.number, amount=25.0))
+    first = datetime.datetime.utcnow()
+    transfer_batch([Transaction(from_acc=account1.number, to_acc=account2.number, amount=10.0),
+                    Transaction(from_acc=account2.number, to_acc=account1.number, amount=5.0)])
+
+    assert get_balance(account1.number, before).balance == 0.0  # the account did not exist yet
+    assert get_balance(account1.number, first).balance == 75.0
+    assert get_balance(account2.number, first).balance == 25.0
+    assert get_balance(account1.number).balance == 70.0
+
+    assert checkpoint_balances(datetime.datetime.utcnow()) == 2
+    assert checkpoint_balances(datetime.datetime.utcnow()) == 0  # no entry since the previous checkpoints
+    transfer(Transaction(from_acc=account2.number, to_acc=account1.number, amount=30.0))
+
+    assert get_balance(account1.number, first).balance == 75.0
+    assert get_balance(account1.number, datetime.datetime.utcnow()).balance == 100.0
+    assert get_balance(account2.number, datetime.datetime.utcnow()).balance == 0.0
+
+
+def test_account_created_before_the_ledger(user_with_accounts):
+    """
+    Tests that the checkpoints of an account without opening checkpoint start from its balance before the ledger
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    session = get_db()
+    try:
+        session.execute(delete(BalanceCheckpoint).where(BalanceCheckpoint.account_number == account1.number))
+        session.commit()
+    finally:
+        session.close()
+    transfer(Transaction(from_acc=account1.number, to_acc=account2.number, amount=25.0))
+    before_checkpoint = datetime.datetime.utcnow()
+
+    assert checkpoint_balances(datetime.datetime.utcnow()) == 2
+    assert get_balance(account1.number, PRE_LEDGER_DATE).balance == 100.0
+    assert get_balance(account1.number, before_checkpoint).balance == 75.0
+    transfer(Transaction(from_acc=account1.number, to_acc=account2.number, amount=5.0))
+    assert get_balance(account1.number, datetime.datetime.utcnow()).balance == 70.0
+    assert checkpoint_balances(datetime.datetime.utcnow()) == 2
+
+
+def test_get_balance_of_unknown_account():
+    """
+    Tests the balance of an unknown account
+    """
+
+    with pytest.raises(BankingException):
+        get_balance("unknown", datetime.datetime.utcnow())
@@ -0,0 +1,121 @@
+import pytest
+from sqlalchemy import select
+
+from tests.conftest import client, app, db_session
+from dao.account_dao import get_account, get_user_summary
+from dao.shard_dao import hot_accounts, set_shard_count, rebalance_shards
+from dao.transaction_dao import transfer, transfer_batch
+from db.database import get_db
+from db.tables.account import Account as AccountTable, AccountShard
+from pojo.transaction import Transaction
+from util.messages import BankingException, NOT_ENOUGH_MONEY, UNKNOWN_ACCOUNT
+
+
+@pytest.fixture(autouse=True)
+def init(app, client, db_session):
+    """
+    Required to initialize the SQLite test database
+    """
+    pass
+
+
+def read_shards(number: str):
+    """
+    :return: the base balance and the shard balances of an account
+    """
+
+    session = get_db()
+    try:
+        base = session.execute(select(AccountTable.balance).where(AccountTable.number == number)).scalar()
+        shards = session.execute(select(AccountShard.balance).where(AccountShard.account_number == number)
+                                 .order_by(AccountShard.shard)).scalars().all()
+        return base, shards
+    finally:
+        session.close()
+
+
+def test_set_shard_count(user_with_accounts):
+    """
+    Tests that the balance is spread over the shards (the remaining cents staying in the account row)
+    and that the reported balance is unchanged
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    set_shard_count(account1.number, 3)
+
+    assert hot_accounts() == {account1.number: 3}
+    base, shards = read_shards(account1.number)
+    assert shards == [33.33, 33.33, 33.33]
+    assert base == pytest.approx(0.01)
+    assert get_account(account1.number).balance == pytest.approx(100.0)
+    assert get_user_summary(user_id).total == pytest.approx(100.0)
+
+    set_shard_count(account1.number, 0)
+    assert hot_accounts() == {}
+    assert read_shards(account1.number) == (pytest.approx(100.0), [])
+
+
+def test_set_shard_count_errors(user_with_accounts):
+    """
+    Tests the unknown account and the number of shards out of range
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    with pytest.raises(BankingException, match=UNKNOWN_ACCOUNT):
+        set_shard_count("unknown", 2)
+    with pytest.raises(BankingException):
+        set_shard_count(account1.number, 1000)
+
+
+def test_hot_account_transfers(user_with_accounts):
+    """
+    Tests the debits drawn from a shard, the sweep when no shard holds the amount and the credits
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    set_shard_count(account1.number, 4)
+
+    transfer(Transaction(from_acc=account1.number, to_acc=account2.number, amount=10.0))
+    assert sorted(read_shards(account1.number)[1]) == [15.0, 25.0, 25.0, 25.0]
+
+    transfer(Transaction(from_acc=account1.number, to_acc=account2.number, amount=30.0))  # sweep
+    assert read_shards(account1.number) == (0.0, [15.0, 15.0, 15.0, 15.0])
+
+    transfer(Transaction(from_acc=account2.number, to_acc=account1.number, amount=5.0))
+    assert sorted(read_shards(account1.number)[1]) == [15.0, 15.0, 15.0, 20.0]
+    assert get_account(account1.number).balance == 65.0
+    assert get_account(account2.number).balance == 35.0
+
+    with pytest.raises(BankingException, match=NOT_ENOUGH_MONEY):
+        transfer(Transaction(from_acc=account1.number, to_acc=account2.number, amount=65.5))
+
+
+def test_hot_account_batch(user_with_accounts):
+    """
+    Tests that a batch sweeps the hot accounts and checks the transfers against their whole balance
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    set_shard_count(account1.number, 4)
+    errors = transfer_batch([Transaction(from_acc=account1.number, to_acc=account2.number, amount=60.0),
+                             Transaction(from_acc=account1.number, to_acc=account2.number, amount=60.0),
+                             Transaction(from_acc=account2.number, to_acc=account1.number, amount=20.0)])
+
+    assert errors == [None, NOT_ENOUGH_MONEY, None]
+    assert read_shards(account1.number) == (0.0, [15.0, 15.0, 15.0, 15.0])
+    assert get_account(account2.number).balance == 40.0
+
+
+def test_rebalance_shards(user_with_accounts):
+    """
+    Tests that the rebalancing only rewrites the accounts whose shards are uneven
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    set_shard_count(account1.number, 2)
+    assert rebalance_shards() == 0
+
+    transfer(Transaction(from_acc=account1.number, to_acc=account2.number, amount=20.0))
+    assert rebalance_shards() == 1
+    assert read_shards(account1.number) == (0.0, [40.0, 40.0])
+    assert rebalance_shards() == 0
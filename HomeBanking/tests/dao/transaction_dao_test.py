@@ -2,13 +2,12 @@ import pytest
 import datetime
 
 from tests.conftest import client, app, db_session
-from dao.account_dao import get_accounts, get_account, create_account
-from dao.user_dao import create_user
-from pojo.user import BaseUser
-from pojo.account import Account
-from util.messages import BankingException
-from dao.transaction_dao import transfer
-from pojo.transaction import Transaction
+from dao.account_dao import get_accounts, get_account
+from util.messages import BankingException, NOT_ENOUGH_MONEY, UNKNOWN_FROM_ACCOUNT, NEGATIVE_AMOUNT
+from dao.transaction_dao import transfer, transfer_batch, get_transfers
+from db.database import get_db
+from db.tables.transaction import Transaction as TransactionTable
+from pojo.transaction import Transaction, DIRECTION_IN, DIRECTION_OUT
 
 @pytest.fixture(autouse=True)
 def init(app, client, db_session):
@@ -18,28 +17,12 @@ def init(app, client, db_session):
     pass
 
 
-def create_user_with_accounts():
-    # test user creation
-    user = BaseUser(firstname="Loup",
-                    lastname="Meurice",
-                    address="rue Comte Jacques de Meeus, 13, 1428 Lillois, Belgique")
-
-    # user creation
-    user_id = create_user(user)
-    account1 = Account(number="FR7630006000011234567890189", balance=100, user_id=user_id)
-    account2 = Account(number="DE91100000000123456789", user_id=user_id)
-    create_account(account1)
-    create_account(account2)
-
-    return user_id, account1, account2
-
-
-def test_transfer():
+def test_transfer(user_with_accounts):
     """
     Tests the money transfer between two accounts
     """
 
-    user_id, account1, account2 = create_user_with_accounts()
+    user_id, account1, account2 = user_with_accounts
     transaction = Transaction(from_acc=account1.number, to_acc=account2.number, amount=25.0)
     transfer(transaction)
 
@@ -50,37 +33,149 @@ def test_transfer():
     assert acc2.balance == account2.balance + transaction.amount
 
 
-def test_transfer_not_enough_money():
+def test_transfer_not_enough_money(user_with_accounts):
     with pytest.raises(BankingException):
         """
         Tests the money transfer when not enough money
         """
 
-        user_id, account1, account2 = create_user_with_accounts()
+        user_id, account1, account2 = user_with_accounts
         transaction = Transaction(from_acc=account2.number, to_acc=account1.number, amount=25.0)
         transfer(transaction)
 
 
-def test_transfer_invalid_source():
+def test_transfer_invalid_source(user_with_accounts):
     with pytest.raises(BankingException):
         """
         Tests the money transfer when the source account is unknown
         """
 
-        user_id, account1, account2 = create_user_with_accounts()
+        user_id, account1, account2 = user_with_accounts
         transaction = Transaction(from_acc="unknown", to_acc=account2.number, amount=25.0)
         transfer(transaction)
 
 
-def test_transfer_invalid_destination():
+def test_transfer_invalid_destination(user_with_accounts):
     with pytest.raises(BankingException):
         """
         Tests the money transfer when the destination account is unknown
         """
 
-        user_id, account1, account2 = create_user_with_accounts()
+        user_id, account1, account2 = user_with_accounts
         transaction = Transaction(from_acc=account1.number, to_acc="unknown", amount=25.0)
         transfer(transaction)
 
 
+def test_transfer_to_same_account(user_with_accounts):
+    """
+    Tests that a transfer to the same account leaves its balance unchanged
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    transaction = Transaction(from_acc=account1.number, to_acc=account1.number, amount=25.0)
+    transfer(transaction)
+
+    acc1 = get_account(account1.number)
+    assert acc1.balance == account1.balance
+
+
+def test_transfer_refused_keeps_balances(user_with_accounts):
+    """
+    Tests that a refused transfer does not modify any balance
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    transaction = Transaction(from_acc=account1.number, to_acc="unknown", amount=25.0)
+    with pytest.raises(BankingException):
+        transfer(transaction)
+
+    acc1 = get_account(account1.number)
+    assert acc1.balance == account1.balance
+
+
+def test_successive_transfers(user_with_accounts):
+    """
+    Tests that successive transfers in both directions keep the total balance
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    for i in range(5):
+        transfer(Transaction(from_acc=account1.number, to_acc=account2.number, amount=10.0))
+    transfer(Transaction(from_acc=account2.number, to_acc=account1.number, amount=20.0))
+
+    acc1 = get_account(account1.number)
+    acc2 = get_account(account2.number)
+    assert acc1.balance == 70.0
+    assert acc2.balance == 30.0
+
 
+def test_transfer_batch(user_with_accounts):
+    """
+    Tests that a batch of transfers is checked against the running balances
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    transactions = [Transaction(from_acc=account1.number, to_acc=account2.number, amount=80.0),
+                    Transaction(from_acc=account1.number, to_acc=account2.number, amount=80.0),
+                    Transaction(from_acc="unknown", to_acc=account2.number, amount=1.0),
+                    Transaction(from_acc=account2.number, to_acc=account1.number, amount=-1.0)]
+    errors = transfer_batch(transactions)
+
+    assert errors == [None, NOT_ENOUGH_MONEY, UNKNOWN_FROM_ACCOUNT, NEGATIVE_AMOUNT]
+    assert get_account(account1.number).balance == 20.0
+    assert get_account(account2.number).balance == 80.0
+
+
+def create_history(account1, account2):
+    """
+    Creates 5 transfers between the two accounts, one per day from the 1st to the 5th of January 2023
+    (odd days from account1 to account2, even days from account2 to account1)
+    """
+
+    session = get_db()
+    try:
+        for day in range(1, 6):
+            from_acc, to_acc = (account1, account2) if day % 2 else (account2, account1)
+            session.add(TransactionTable(amount=day, from_acc=from_acc.number, to_acc=to_acc.number,
+                                         date=datetime.datetime(2023, 1, day)))
+        session.commit()
+    finally:
+        session.close()
+
+
+def test_get_transfers(user_with_accounts):
+    """
+    Tests the retrieval of an account history, most recent transfers first
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    create_history(account1, account2)
+
+    assert [t.amount for t in get_transfers(account1.number)] == [5, 4, 3, 2, 1]
+    assert [t.amount for t in get_transfers(account1.number, direction=DIRECTION_OUT)] == [5, 3, 1]
+    assert [t.amount for t in get_transfers(account1.number, direction=DIRECTION_IN)] == [4, 2]
+    assert [t.amount for t in get_transfers(account1.number, date_from=datetime.datetime(2023, 1, 2),
+                                            date_to=datetime.datetime(2023, 1, 4))] == [3, 2]
+
+
+def test_get_transfers_by_page(user_with_accounts):
+    """
+    Tests the keyset pagination of an account history
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    create_history(account1, account2)
+
+    page1 = get_transfers(account2.number, limit=2)
+    page2 = get_transfers(account2.number, after=page1[-1].id, limit=2)
+    page3 = get_transfers(account2.number, after=page2[-1].id, limit=2)
+    assert [t.amount for t in page1 + page2 + page3] == [5, 4, 3, 2, 1]
+
+
+def test_get_transfers_of_unknown_account():
+    """
+    Tests the history retrieval of an unknown account
+    """
+
+    with pytest.raises(BankingException):
+        get_transfers("unknown")
@@ -1,9 +1,14 @@
 import pytest
 
-from tests.conftest import client, app, db_session
-from dao.user_dao import create_user, get_user, get_users, modify_user
+from tests.conftest import client, app, db_session, located_users, stub_geocoder
+from sqlalchemy.dialects import mysql
+
+from dao.user_dao import create_user, get_user, get_users, get_user_rows, get_nearby_users, modify_user, \
+    _select_nearby_users, insert_users, count_pending_users, save_import_job, get_import_job
 from pojo.user import BaseUser
 from util.messages import BankingException
+from util.user_import import ImportJob
+from workers.geocoding_worker import geocoding_worker
 
 
 @pytest.fixture(autouse=True)
@@ -14,7 +19,7 @@ def init(app, client, db_session):
     pass
 
 
-def test_create_and_read_user():
+def test_create_and_read_user(stub_geocoder):
     """
     Tests the user creation and the retrieval of his/her information once created.
     It also checks if the geographical location is correctly calculated
@@ -26,6 +31,7 @@ def test_create_and_read_user():
     # user creation
     user_id = create_user(user)
     assert user_id >= 0
+    geocoding_worker.process_pending()  # calculates the geographical location
 
     # user reading
     user2 = get_user(user_id)
@@ -37,7 +43,7 @@ def test_create_and_read_user():
            and user2.coordinates.longitude == 4.372272362912566
 
 
-def test_create_and_read_user_with_malformed_address():
+def test_create_and_read_user_with_malformed_address(stub_geocoder):
     """
     Checks that malformed address is properly handled (no coordinates)
     """
@@ -49,6 +55,7 @@ def test_create_and_read_user_with_malformed_address():
     # user creation
     user_id = create_user(user)
     assert user_id >= 0
+    geocoding_worker.process_pending()  # tries to calculate the geographical location
 
     # user reading
     user2 = get_user(user_id)
@@ -132,4 +139,84 @@ def test_modify_unknown_user():
         user = BaseUser(firstname="Loup",
                         lastname="Meurice",
                         address="rue Comte Jacques de Meeus, 15, 1428 Lillois, Belgique")
-        modify_user(-1, user)
\ No newline at end of file
+        modify_user(-1, user)
+
+
+def test_get_users_by_page():
+    """
+    Tests the keyset pagination of the users
+    """
+
+    user = BaseUser(firstname="Loup",
+                    lastname="Meurice",
+                    address="malformed address")
+    user_ids = [create_user(user) for i in range(3)]
+
+    assert [u.id for u in get_users(limit=2)] == user_ids[:2]
+    assert [u.id for u in get_users(after=user_ids[1], limit=2)] == user_ids[2:]
+    assert get_users(after=user_ids[2]) == []
+
+
+def test_get_user_rows(stub_geocoder):
+    """
+    Tests that the column-only users query returns the same fields as the User model
+    """
+
+    create_user(BaseUser(firstname="Loup", lastname="Meurice",
+                         address="rue Comte Jacques de Meeus, 13, 1428 Lillois, Belgique"))
+    create_user(BaseUser(firstname="Loup", lastname="Meurice", address="malformed address"))
+    geocoding_worker.process_pending()
+
+    rows = get_user_rows()
+    assert rows == [user.dict() for user in get_users()]
+    assert rows[0]["coordinates"] is not None and rows[1]["coordinates"] is None
+    assert get_user_rows(after=rows[0]["id"], limit=1) == rows[1:]
+
+
+def test_get_nearby_users(located_users):
+    """
+    Tests the proximity search of the users, nearest first
+    """
+
+    users = get_nearby_users(50.8467, 4.3525, 50)
+    assert [u["id"] for u in users] == [located_users["Brussels"], located_users["Antwerp"]]
+    assert users[0]["distance_km"] < 1 and 40 < users[1]["distance_km"] < 43
+    assert users[0]["coordinates"] == {"latitude": 50.8503, "longitude": 4.3517}
+
+    assert [u["id"] for u in get_nearby_users(50.8467, 4.3525, 300)] == \
+           [located_users["Brussels"], located_users["Antwerp"], located_users["Paris"]]
+    assert [u["id"] for u in get_nearby_users(48.85, 2.35, 300, limit=1)] == [located_users["Paris"]]
+    assert get_nearby_users(0.0, 0.0, 100) == []
+
+
+def test_nearby_users_prefix_filter():
+    """
+    Tests that the geohash cells are matched by prefix, whatever the collation of the MySQL column
+    """
+
+    query = _select_nearby_users(50.8467, 4.3525, 50, 10, "mysql")
+    sql = str(query.compile(dialect=mysql.dialect(), compile_kwargs={"literal_binds": True}))
+    assert "users.geohash LIKE 'u1" in sql
+    assert "~" not in sql
+
+
+def test_insert_users():
+    """
+    Tests that a bulk import gets the IDs of its users back, whatever the users created concurrently
+    """
+
+    user = BaseUser(firstname="Loup", lastname="Meurice", address="wrong address")
+    job = ImportJob()
+    first_ids = insert_users([user, user], job.id)
+    concurrent_id = create_user(user)
+    other_ids = insert_users([user], ImportJob().id)
+    last_ids = insert_users([user], job.id, max(first_ids))
+    assert len(first_ids) == 2 and len(last_ids) == 1
+    assert concurrent_id not in first_ids + last_ids and not set(other_ids) & set(first_ids + last_ids)
+    assert count_pending_users(job.id) == 3
+
+    job.inserted(first_ids + last_ids)
+    job.reject(4, "error")
+    save_import_job(job)
+    assert get_import_job(job.id).report(3) == job.report(3)
+    assert get_import_job("unknown") is None
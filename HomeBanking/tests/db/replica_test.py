@@ -0,0 +1,108 @@
+import os
+
+import pytest
+from sqlalchemy import insert
+
+from tests.conftest import client, app, db_session
+from db import database
+from db.database import Base, get_db, configure_replicas, check_replicas, ReplicaPool, LEAST_CONNECTIONS, \
+    READ_PRIMARY_HEADER
+from db.tables.user import User as UserTable
+from pojo.user import GEOCODING_DONE
+from util import metrics
+
+REPLICA_FILES = ("test_replica.db", "test_replica2.db")
+
+
+@pytest.fixture(autouse=True)
+def init(app, client, db_session):
+    """
+    Required to initialize the SQLite test database
+    """
+    yield
+    configure_replicas([])
+    for name in REPLICA_FILES:
+        if os.path.exists(name):
+            os.remove(name)
+
+
+@pytest.fixture
+def replica():
+    """
+    Second SQLite database playing the read replica of the test database
+    """
+
+    configure_replicas(["sqlite:///./" + REPLICA_FILES[0]])
+    replica = database.replicas.replicas[0]
+    Base.metadata.create_all(replica.engine)
+    return replica
+
+
+def insert_user(session, lastname: str) -> int:
+    try:
+        user_id = session.execute(insert(UserTable).values(firstname="John", lastname=lastname, address="Bruxelles",
+                                                           geocoding_status=GEOCODING_DONE)).inserted_primary_key[0]
+        session.commit()
+        return user_id
+    finally:
+        session.close()
+
+
+def test_reads_on_replica(client, replica):
+    """
+    Tests that the read-only endpoints read the replica, unless the client asks for the primary,
+    and that the read-your-writes paths stay on the primary
+    """
+
+    insert_user(get_db(), "Primary")
+    new_user_id = insert_user(get_db(), "New")  # not replicated yet
+    insert_user(replica.SessionLocal(), "Replica")
+
+    assert [user["lastname"] for user in client.get("/users").json()] == ["Replica"]
+    response = client.get("/users", headers={READ_PRIMARY_HEADER: "1"})
+    assert [user["lastname"] for user in response.json()] == ["Primary", "New"]
+    assert client.get("/accounts/%d" % new_user_id).json() == []
+
+    # the users and accounts are read (and cached) from the primary only
+    assert client.get("/user/%d" % new_user_id).json()["lastname"] == "New"
+    assert client.get("/users/%d/summary" % new_user_id).json()["account_count"] == 0
+
+
+def test_fallback_to_primary(client, caplog):
+    """
+    Tests that the reads are sent to the primary once the health check finds no healthy replica
+    """
+
+    insert_user(get_db(), "Primary")
+    configure_replicas(["sqlite:////nonexistent-directory/replica.db"])
+    check_replicas()
+    assert not database.replicas.replicas[0].healthy
+    assert "Read replica replica0 unavailable" in caplog.text
+    assert [user["lastname"] for user in client.get("/users").json()] == ["Primary"]
+    assert 'db_replica_healthy{replica="replica0"} 0.0' in metrics.render()
+
+
+def test_balancing():
+    """
+    Tests the round robin and least connections balancing among the healthy replicas
+    """
+
+    urls = ["sqlite:///./" + name for name in REPLICA_FILES]
+    pool = ReplicaPool(urls)
+    try:
+        assert [pool.choose().label for i in range(4)] == ["replica0", "replica1", "replica0", "replica1"]
+        pool.replicas[0].healthy = False
+        assert [pool.choose().label for i in range(2)] == ["replica1", "replica1"]
+        pool.replicas[1].healthy = False
+        assert pool.choose() is None
+    finally:
+        pool.dispose()
+
+    pool = ReplicaPool(urls, LEAST_CONNECTIONS)
+    try:
+        with pool.replicas[0].engine.connect():
+            assert pool.choose() is pool.replicas[1]
+        with pool.replicas[1].engine.connect():
+            assert pool.choose() is pool.replicas[0]
+    finally:
+        pool.dispose()
@@ -0,0 +1,44 @@
+import copy
+
+import pytest
+from fastapi.testclient import TestClient
+
+from tests.conftest import app
+from benchmarks.import_time import measure
+from db.variables import settings
+from main import create_app
+from workers.periodic_job import checkpoint_job
+from workers.transfer_writer import transfer_writer
+
+
+def test_create_app(app, tmp_path, monkeypatch):
+    """
+    Tests that the lifespan of the application runs the background workers until the shutdown
+    """
+
+    monkeypatch.setattr(transfer_writer, "directory", str(tmp_path))
+    with TestClient(create_app()) as client:
+        assert client.get("/").json() == {"message": "Hello world"}
+        assert checkpoint_job._thread is not None
+    assert checkpoint_job._thread is None
+
+
+def test_create_app_settings():
+    """
+    Tests that the settings cannot be replaced once the caches and jobs are created from them
+    """
+
+    same_settings = copy.copy(settings)
+    assert create_app(same_settings) is not None
+    new_settings = copy.copy(settings)
+    new_settings.stats_cache_ttl += 1
+    with pytest.raises(RuntimeError):
+        create_app(new_settings)
+
+
+def test_deferred_imports():
+    """
+    Tests that building the application loads neither the geocoder, nor schwifty, nor the database drivers
+    """
+
+    assert measure("import main; main.create_app()", 1, set())["deferred_imported"] == []
@@ -0,0 +1,30 @@
+from tests.conftest import client
+from tests.user_router_test import create_user
+from pojo.user import BaseUser
+from util import metrics
+
+
+def test_get_metrics(client):
+    """
+    Tests that the requests, their SQL statements and the connection pool are measured
+    """
+
+    create_user(BaseUser(firstname="Loup", lastname="Meurice", address="wrong address"))
+    requests = metrics.sql_statements_per_request.count("GET", "/user/{user_id}")
+    statements = metrics.sql_statements_per_request.sum("GET", "/user/{user_id}")
+    client.get("/user/1")
+    client.get("/user/1000")
+
+    assert metrics.http_requests.value("GET", "/user/{user_id}", "200") >= 1
+    assert metrics.http_requests.value("GET", "/user/{user_id}", "422") >= 1
+    assert metrics.sql_statements_per_request.count("GET", "/user/{user_id}") == requests + 2
+    assert metrics.sql_statements_per_request.sum("GET", "/user/{user_id}") >= statements + 2
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'http_requests_total{method="GET",route="/user/{user_id}",status="200"}' in response.text
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/user/{user_id}",le="+Inf"}' in response.text
+    assert 'db_pool_checkout_wait_seconds_count{engine="async"}' in response.text
+    assert 'db_pool_connection_hold_seconds_count{engine="async"}' in response.text
+    assert 'db_pool_connections_in_use{engine="async"} 0.0' in response.text
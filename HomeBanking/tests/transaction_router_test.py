@@ -1,6 +1,8 @@
 import json
 from tests.conftest import client
 from tests.account_router_test import create_test_users_and_accounts, read_account
+from util.messages import NOT_ENOUGH_MONEY, UNKNOWN_TO_ACCOUNT, IDEMPOTENCY_KEY_REUSED
+from util.query_counter import QUERIES_HEADER
 
 
 def test_transfer(client):
@@ -22,6 +24,27 @@ def test_transfer(client):
     assert acc2.balance == account2.balance + data["amount"]
 
 
+def test_transfer_idempotency_key(client):
+    """
+    Tests that a transfer retried with the same idempotency key is executed once
+    """
+
+    user_id1, user1, user_id2, user2, account1, account2 = create_test_users_and_accounts()
+
+    data = {"from_acc": account1.number, "to_acc": account2.number, "amount": 20.00}
+    headers = {"Idempotency-Key": "transfer-1"}
+    assert client.post("/transfer/", params=data, headers=headers).json() == {"ok": True}
+    retry = client.post("/transfer/", params=data, headers=headers)
+    assert retry.json() == {"ok": True}
+    assert retry.headers[QUERIES_HEADER] == "1"  # answered by the key lookup
+    assert read_account(account1.number).balance == account1.balance - data["amount"]
+
+    # same key, different transfer
+    response = client.post("/transfer/", params=dict(data, amount=30.00), headers=headers)
+    assert response.status_code == 422
+    assert response.json()["detail"] == IDEMPOTENCY_KEY_REUSED
+
+
 def test_transfer_with_insufficient_money(client):
     """
     Tests money transfer between two accounts with insufficient balance
@@ -60,3 +83,89 @@ def test_transfer_with_nonexistent_destination_account(client):
     response = client.post("/transfer/", params=data)
     assert response.status_code == 422
 
+
+def test_transfer_batch(client):
+    """
+    Tests the execution of a list of transfers, some of them being refused
+    """
+
+    # Creates test users and accounts
+    user_id1, user1, user_id2, user2, account1, account2 = create_test_users_and_accounts()
+
+    data = [{"from_acc": account1.number, "to_acc": account2.number, "amount": 60.00},
+            {"from_acc": account1.number, "to_acc": account2.number, "amount": 60.00},  # insufficient balance
+            {"from_acc": account1.number, "to_acc": "KO", "amount": 10.00},
+            {"from_acc": account2.number, "to_acc": account1.number, "amount": 20.00}]
+    response = client.post("/transfers/batch", json=data)
+    assert response.status_code == 200
+    results = response.json()
+    assert [r["ok"] for r in results] == [True, False, False, True]
+    assert results[1]["detail"] == NOT_ENOUGH_MONEY
+    assert results[2]["detail"] == UNKNOWN_TO_ACCOUNT
+
+    acc1 = read_account(account1.number)
+    acc2 = read_account(account2.number)
+    assert acc1.balance == account1.balance - 40.00
+    assert acc2.balance == account2.balance + 40.00
+
+
+def test_transfer_batch_ndjson(client):
+    """
+    Tests the execution of a list of transfers sent as NDJSON
+    """
+
+    # Creates test users and accounts
+    user_id1, user1, user_id2, user2, account1, account2 = create_test_users_and_accounts()
+
+    lines = [json.dumps({"from_acc": account1.number, "to_acc": account2.number, "amount": 10.00})] * 3
+    response = client.post("/transfers/batch", content="\n".join(lines),
+                           headers={"content-type": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert all(r["ok"] for r in response.json())
+
+    acc2 = read_account(account2.number)
+    assert acc2.balance == account2.balance + 30.00
+
+
+def test_transfer_batch_malformed(client):
+    """
+    Tests the batch transfer with a malformed body
+    """
+
+    response = client.post("/transfers/batch", json={"from_acc": "KO"})
+    assert response.status_code == 422
+
+
+def test_get_account_transfers(client):
+    """
+    Tests the retrieval of an account history one page at a time
+    """
+
+    # Creates test users and accounts
+    user_id1, user1, user_id2, user2, account1, account2 = create_test_users_and_accounts()
+    for amount in (10.00, 20.00, 30.00):
+        client.post("/transfer/", params={"from_acc": account1.number, "to_acc": account2.number, "amount": amount})
+
+    response = client.get(f"/accounts/{account2.number}/transfers", params={"limit": 2, "direction": "in"})
+    assert response.status_code == 200
+    assert [t["amount"] for t in response.json()] == [30.00, 20.00]
+
+    response = client.get(f"/accounts/{account2.number}/transfers",
+                          params={"limit": 2, "after": response.headers["X-Next-After"]})
+    assert [t["amount"] for t in response.json()] == [10.00]
+    assert response.json()[0]["date"] is not None
+
+    response = client.get(f"/accounts/{account2.number}/transfers", params={"direction": "out"})
+    assert response.json() == []
+
+
+def test_get_unknown_account_transfers(client):
+    """
+    Tests the history retrieval of an unknown account
+    """
+
+    response = client.get("/accounts/KO/transfers")
+    assert response.status_code == 422
+
+    response = client.get("/accounts/KO/transfers", params={"direction": "sideways"})
+    assert response.status_code == 422
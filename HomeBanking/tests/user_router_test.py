@@ -1,12 +1,16 @@
 import json
+import time
 
 from schwifty.common import Base
 
 import routers.user
 from pojo.user import BaseUser, User
-from tests.conftest import client
+from tests.conftest import client, located_users, stub_geocoder
 from datetime import datetime as d
 import datetime
+from workers.geocoding_worker import geocoding_worker
+from util import util
+from util.geocoder import StubGeocoder
 
 
 def create_user(user: BaseUser) -> int:
@@ -86,7 +90,7 @@ def test_get_nonexistent_user(client):
     assert response.status_code == 422
 
 
-def test_create_user_with_right_address(client):
+def test_create_user_with_right_address(client, stub_geocoder):
     """
     Checks (1) the user creation,
     (2) the calculation of the geographical location based on a well-formed address,
@@ -103,6 +107,7 @@ def test_create_user_with_right_address(client):
     assert response.status_code == 200
     user_id = response.json()["user_id"]
     assert user_id >= 0
+    geocoding_worker.process_pending()  # calculates the geographical location
 
     user = read_user(user_id)
     assert user.id == user_id
@@ -115,7 +120,7 @@ def test_create_user_with_right_address(client):
            and user.coordinates.longitude == 4.372272362912566
 
 
-def test_create_user_with_wrong_address(client):
+def test_create_user_with_wrong_address(client, stub_geocoder):
     """
     Checks (1) the user creation,
     (2) that a malformed address does not provoke errors,
@@ -132,6 +137,7 @@ def test_create_user_with_wrong_address(client):
     assert response.status_code == 200
     user_id = response.json()["user_id"]
     assert user_id >= 0
+    geocoding_worker.process_pending()  # tries to calculate the geographical location
 
     user = read_user(user_id)
     assert user.id == user_id
@@ -186,3 +192,111 @@ def test_update_nonexistent_user(client):
     assert response.status_code == 422
 
 
+def test_get_users_by_page(client):
+    """
+    Tests the keyset pagination of the users
+    """
+
+    user_ids = [create_user(BaseUser(firstname=f"f{i}", lastname=f"l{i}", address="wrong address"))
+                for i in range(5)]
+
+    response = client.get("/users", params={"limit": 2})
+    assert response.status_code == 200
+    assert [u["id"] for u in response.json()] == user_ids[:2]
+
+    response = client.get("/users", params={"limit": 2, "after": response.headers["X-Next-After"]})
+    assert [u["id"] for u in response.json()] == user_ids[2:4]
+
+    response = client.get("/users", params={"limit": 2, "after": response.headers["X-Next-After"]})
+    assert [u["id"] for u in response.json()] == user_ids[4:]
+    assert "X-Next-After" not in response.headers
+
+
+def test_get_users_with_invalid_limit(client):
+    """
+    Tests that the page size is bounded
+    """
+
+    response = client.get("/users", params={"limit": 0})
+    assert response.status_code == 422
+
+
+def test_stream_users(client):
+    """
+    Tests the streaming of the users as NDJSON
+    """
+
+    user_ids = [create_user(BaseUser(firstname=f"f{i}", lastname=f"l{i}", address="wrong address"))
+                for i in range(3)]
+
+    response = client.get("/users", headers={"accept": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    users = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(u["id"] for u in users) == user_ids
+
+    response = client.get("/users", params={"after": user_ids[0], "limit": 1},
+                          headers={"accept": "application/x-ndjson"})
+    assert [json.loads(line)["id"] for line in response.text.splitlines()] == user_ids[1:2]
+
+
+def test_get_nearby_users(client, located_users):
+    """
+    Tests the proximity search endpoint
+    """
+
+    response = client.get("/users/nearby", params={"lat": 50.8467, "lon": 4.3525, "radius_km": 50})
+    assert response.status_code == 200
+    assert [u["id"] for u in response.json()] == [located_users["Brussels"], located_users["Antwerp"]]
+
+    response = client.get("/users/nearby", params={"lat": 95, "lon": 4.3525, "radius_km": 50})
+    assert response.status_code == 422
+
+
+def test_import_users(client, monkeypatch):
+    """
+    Tests the bulk import of users from CSV and NDJSON uploads, with the report of the rejected lines
+    """
+
+    monkeypatch.setattr(util, "geocoder", StubGeocoder({"rue de la Loi 16, 1000 Bruxelles": (50.84, 4.36)}))
+    monkeypatch.setattr(util.geocoder_rate_limiter, "rate", None)
+    geocoding_worker.process_pending()
+
+    body = "firstname,lastname,address\n" \
+           "Loup,Meurice,\"rue de la Loi 16, 1000 Bruxelles\"\n" \
+           "Jane,Doe\n" \
+           "John,Doe,\"rue de la Loi 16, 1000 Bruxelles\"\n"
+    response = client.post("/users/bulk", content=body.encode(), headers={"content-type": "text/csv"})
+    assert response.status_code == 202
+    assert response.json()["status"] == "running"
+    report = wait_for_import(client, response.json()["job_id"])
+    assert (report["status"], report["rows"], report["imported"], report["error_count"]) == ("done", 3, 2, 1)
+    assert report["errors"] == [{"line": 3, "error": "3 columns expected, 2 found"}]
+    assert report["geocoding_pending"] == 2
+
+    geocoding_worker.process_pending()
+    assert client.get("/users/bulk/" + report["job_id"]).json()["geocoding_pending"] == 0
+    assert [u["lastname"] for u in client.get("/users").json()] == ["Meurice", "Doe"]
+
+    body = b'{"firstname": "A", "lastname": "B", "address": "C"}\n[1, 2]\n{"firstname": "A"}\n'
+    response = client.post("/users/bulk", content=body, headers={"content-type": "application/x-ndjson"})
+    report = wait_for_import(client, response.json()["job_id"])
+    assert (report["imported"], report["error_count"]) == (1, 2)
+    assert report["errors"][0] == {"line": 2, "error": "A JSON object is expected"}
+
+    assert client.post("/users/bulk", content=b"{}", headers={"content-type": "application/json"}).status_code == 415
+    assert client.get("/users/bulk/unknown").status_code == 422
+
+
+def wait_for_import(client, job_id: str) -> dict:
+    """
+    Waits for the end of a bulk import running in the background
+    :return: the final report of the job
+    """
+
+    for _ in range(500):
+        report = client.get("/users/bulk/" + job_id).json()
+        if report["status"] != "running":
+            return report
+        time.sleep(0.01)
+    raise AssertionError("The import %s is still running" % job_id)
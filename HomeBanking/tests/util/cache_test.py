@@ -0,0 +1,54 @@
+import time
+
+from util.cache import TTLCache
+from util.geocoder import RateLimiter
+
+
+def test_lookup():
+    """
+    Tests that stored values are found and missing ones counted as misses
+    """
+
+    cache = TTLCache(max_size=2, ttl=60)
+    cache.put("a", None)
+    assert cache.lookup("a") == (True, None)
+    assert cache.lookup("b") == (False, None)
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_lru_eviction():
+    """
+    Tests that the least recently used entry is evicted when the cache is full
+    """
+
+    cache = TTLCache(max_size=2, ttl=60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_expiry():
+    """
+    Tests that expired entries are not returned
+    """
+
+    cache = TTLCache(max_size=2, ttl=60)
+    cache.put("a", 1, ttl=0)
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_rate_limiter():
+    """
+    Tests that the rate limiter spaces the calls
+    """
+
+    limiter = RateLimiter(rate=50)
+    start = time.monotonic()
+    for i in range(3):
+        limiter.wait()
+    assert time.monotonic() - start >= 2 / 50
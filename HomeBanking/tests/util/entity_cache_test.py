@@ -0,0 +1,128 @@
+import pytest
+
+from tests.conftest import client, app, db_session
+from dao.account_dao import get_account
+from dao.user_dao import get_user, modify_user
+from dao.transaction_dao import transfer
+from pojo.transaction import Transaction
+from pojo.user import BaseUser
+from util import metrics
+from util.entity_cache import EntityCache, MemoryBackend, account_cache, user_cache
+from util.query_counter import count_queries
+
+
+@pytest.fixture(autouse=True)
+def init(app, client, db_session):
+    """
+    Required to initialize the SQLite test database
+    """
+    pass
+
+
+def test_versioning():
+    """
+    Tests that a value loaded before an invalidation is not served after it
+    """
+
+    cache = EntityCache("test", 60, MemoryBackend(10, 60))
+    found, value, version = cache.lookup(1)
+    assert not found
+    cache.invalidate(1)  # concurrent write committed while the value was loaded
+    cache.store(1, version, "stale")
+    assert cache.lookup(1)[0] is False
+
+    found, value, version = cache.lookup(1)
+    cache.store(1, version, "fresh")
+    assert cache.lookup(1)[:2] == (True, "fresh")
+    assert cache.stats() == {"hits": 1, "misses": 3, "hit_ratio": 0.25}
+
+
+def test_eviction():
+    """
+    Tests that the store is bounded
+    """
+
+    backend = MemoryBackend(2, 60)
+    cache = EntityCache("test", 60, backend)
+    for key in range(3):
+        cache.store(key, 0, key)
+    assert backend.stats()["evictions"] == 1
+    assert cache.lookup(0)[0] is False
+
+    cache.invalidate(1)
+    for key in range(3, 6):
+        cache.store(key, 0, key)
+    assert cache.lookup(1)[2] == 1  # storing values does not evict the versions
+
+
+def test_version_eviction():
+    """
+    Tests that the versions are bounded and that an evicted version never goes back to a stale value
+    """
+
+    backend = MemoryBackend(2, 60)
+    cache = EntityCache("test", 60, backend)
+    found, value, version = cache.lookup(1)
+    cache.invalidate(1)  # concurrent write committed while the value was loaded
+    cache.store(1, version, "stale")
+    for key in range(2, 10):
+        cache.invalidate(key)
+    assert backend.stats()["versions"] == 2
+    assert cache.lookup(1)[0] is False
+    assert cache.lookup(1)[2] >= 1
+
+    found, value, version = cache.lookup(1)
+    cache.store(1, version, "fresh")
+    assert cache.lookup(1)[:2] == (True, "fresh")
+
+
+def test_missing_entities():
+    """
+    Tests that the absence of an entity is only cached by a store shared by the workers
+    """
+
+    cache = EntityCache("test", 60, MemoryBackend(10, 60))
+    cache.store(1, 0, None)
+    assert cache.lookup(1)[0] is False
+
+    cache = EntityCache("test", 60, MemoryBackend(10, 60, shared=True))
+    cache.store(1, 0, None)
+    assert cache.lookup(1)[:2] == (True, None)
+
+
+def test_read_through(user_with_accounts):
+    """
+    Tests that the users and accounts are read once, and read again after their modification
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    get_user(user_id)
+    get_account(account1.number)
+    with count_queries() as queries:
+        assert get_user(user_id).id == user_id
+        assert get_account(account1.number).balance == account1.balance
+        assert get_account("unknown") is None
+        assert get_account("unknown") is None
+    assert queries.count == 2  # the unknown account is read each time
+
+    modify_user(user_id, BaseUser(firstname="Jane", lastname="", address=""))
+    transfer(Transaction(from_acc=account1.number, to_acc=account2.number, amount=10.0))
+    assert get_user(user_id).firstname == "Jane"
+    assert get_account(account1.number).balance == account1.balance - 10.0
+    assert get_account(account2.number).balance == account2.balance + 10.0
+
+
+def test_metrics(user_with_accounts):
+    """
+    Tests the hit and miss counters exposed to Prometheus
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    hits = user_cache.hits
+    get_user(user_id)  # cached by the account creations
+    assert user_cache.hits == hits + 1
+    text = metrics.render()
+    assert 'entity_cache_lookups_total{cache="users",result="hits"} %s' % float(user_cache.hits) in text
+    assert 'entity_cache_hit_ratio{cache="accounts"}' in text
+    assert "entity_cache_evictions_total" in text
+    assert account_cache.stats()["misses"] > 0
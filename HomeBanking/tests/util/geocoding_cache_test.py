@@ -0,0 +1,116 @@
+import pytest
+
+from tests.conftest import client, app, db_session
+from util import util, metrics
+from util.geocoder import StubGeocoder
+
+
+@pytest.fixture(autouse=True)
+def init(app, client, db_session):
+    """
+    Required to initialize the SQLite test database
+    """
+    util.geocoding_memory_cache.clear()
+    yield
+    util.geocoding_memory_cache.clear()
+
+
+@pytest.fixture
+def geocoder_calls(monkeypatch):
+    """
+    Replaces the geocoder by a local one recording the requested addresses
+    """
+
+    geocoder = StubGeocoder({"Rue Léopold 11, 5500 Dinant": (50.5, 4.5)})
+    monkeypatch.setattr(util, "geocoder", geocoder)
+    monkeypatch.setattr(util.geocoder_rate_limiter, "rate", None)
+    return geocoder.calls
+
+
+def test_normalize_address():
+    """
+    Tests that case, whitespace and punctuation are folded
+    """
+
+    assert util.normalize_address("  Rue Léopold 11,   5500 DINANT. ") == "rue léopold 11 5500 dinant"
+    assert util.normalize_address("rue léopold 11 5500 dinant") == "rue léopold 11 5500 dinant"
+
+
+def test_memory_cache(geocoder_calls):
+    """
+    Tests that equivalent addresses are geocoded once
+    """
+
+    assert util.get_coordinates("Rue Léopold 11, 5500 Dinant") == (50.5, 4.5)
+    assert util.get_coordinates("rue léopold 11 5500 dinant") == (50.5, 4.5)
+    assert len(geocoder_calls) == 1
+    assert util.geocoding_stats()["memory"]["hits"] >= 1
+
+
+def test_persistent_cache(geocoder_calls):
+    """
+    Tests that the geocoder is not called again once the in-process cache is lost
+    """
+
+    util.get_coordinates("Rue Léopold 11, 5500 Dinant")
+    util.geocoding_memory_cache.clear()
+    hits = util.geocoding_stats()["persistent"]["hits"]
+
+    assert util.get_coordinates("Rue Léopold 11, 5500 Dinant") == (50.5, 4.5)
+    assert len(geocoder_calls) == 1
+    assert util.geocoding_stats()["persistent"]["hits"] == hits + 1
+
+
+def test_long_address(geocoder_calls):
+    """
+    Tests that an address longer than 100 characters once normalized is cached under a fixed-size key
+    """
+
+    address = "Straße " * 20 + "11, 5500 Dinant"
+    util.get_coordinates(address)
+    util.geocoding_memory_cache.clear()
+    util.get_coordinates(address)
+    assert len(util.normalize_address(address)) > 100
+    assert len(geocoder_calls) == 1
+
+
+def test_negative_cache(geocoder_calls):
+    """
+    Tests that addresses that cannot be located are cached too
+    """
+
+    assert util.get_coordinates("malformed address") == (None, None)
+    util.geocoding_memory_cache.clear()
+    assert util.get_coordinates("malformed address") == (None, None)
+    assert len(geocoder_calls) == 1
+
+
+def test_expired_entry(geocoder_calls, monkeypatch):
+    """
+    Tests that expired entries are geocoded again
+    """
+
+    monkeypatch.setattr(util.settings, "geocoding_cache_ttl", 0)
+    util.get_coordinates("Rue Léopold 11, 5500 Dinant")
+    util.get_coordinates("Rue Léopold 11, 5500 Dinant")
+    assert len(geocoder_calls) == 2
+
+
+def test_geocoder_metrics(monkeypatch):
+    """
+    Tests that the geocoder calls and failures are measured
+    """
+
+    class FailingGeocoder(StubGeocoder):
+        def geocode(self, address: str):
+            raise TimeoutError(address)
+
+    monkeypatch.setattr(util, "geocoder", FailingGeocoder())
+    monkeypatch.setattr(util.geocoder_rate_limiter, "rate", None)
+    calls = metrics.geocoder_request_duration.count()
+    failures = metrics.geocoder_failures.value("TimeoutError")
+
+    with pytest.raises(TimeoutError):
+        util.get_coordinates("Unknown street 1, 5500 Dinant")
+    assert metrics.geocoder_request_duration.count() == calls + 1
+    assert metrics.geocoder_failures.value("TimeoutError") == failures + 1
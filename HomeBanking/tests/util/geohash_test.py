@@ -0,0 +1,45 @@
+import math
+import random
+
+from util import geohash
+
+
+def test_encode():
+    """
+    Tests the geohash of a known location and the longitude normalization
+    """
+
+    assert geohash.encode(57.64911, 10.40744, 11) == "u4pruydqqvj"
+    assert geohash.encode(0.0, 190.0, 5) == geohash.encode(0.0, -170.0, 5)
+
+
+def test_haversine():
+    """
+    Tests the great-circle distance between Brussels and Paris
+    """
+
+    assert 263 < geohash.haversine_km(50.8503, 4.3517, 48.8566, 2.3522) < 265
+
+
+def test_covering_cells():
+    """
+    Tests that the covering cells contain every location within the radius, including around the antimeridian
+    and the poles
+    """
+
+    rng = random.Random(7)
+    for i in range(500):
+        latitude, longitude = rng.uniform(-89.5, 89.5), rng.uniform(-180, 180)
+        radius_km = rng.choice([0.1, 2, 30, 400, 2500])
+        cells = geohash.covering_cells(latitude, longitude, radius_km)
+        assert len(cells) <= 16
+        for j in range(20):
+            bearing = rng.uniform(0, 2 * math.pi)
+            distance = rng.uniform(0, radius_km) / geohash.EARTH_RADIUS_KM
+            phi1, lambda1 = math.radians(latitude), math.radians(longitude)
+            phi2 = math.asin(math.sin(phi1) * math.cos(distance) +
+                             math.cos(phi1) * math.sin(distance) * math.cos(bearing))
+            lambda2 = lambda1 + math.atan2(math.sin(bearing) * math.sin(distance) * math.cos(phi1),
+                                           math.cos(distance) - math.sin(phi1) * math.sin(phi2))
+            location = geohash.encode(math.degrees(phi2), math.degrees(lambda2))
+            assert any(location.startswith(cell) for cell in cells)
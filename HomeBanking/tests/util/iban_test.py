@@ -0,0 +1,57 @@
+import pytest
+from schwifty import IBAN
+
+from util import iban
+from util.iban import validate_iban, validate_ibans, _checksum
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    iban.iban_cache.clear()
+    yield
+    iban.iban_cache.clear()
+
+
+def schwifty_validation(number: str) -> bool:
+    try:
+        IBAN(number)
+        return True
+    except Exception:
+        return False
+
+
+NUMBERS = ["FR7630006000011234567890189", "DE91100000000123456789", "BE71096123456769", "GB82WEST12345698765432",
+           "fr76 3000 6000 0112 3456 7890 189", "FR7630006000011234567890188", "DE9110000000012345678",
+           "BE71A96123456769", "XX91100000000123456789", "NL91ABNA0417164300", "NL91ABNA041716430A",
+           "JO94CBJO0010000000000131000302", "JO94CBJO0010000000000131000303", "", "FR", "123456"]
+
+
+def test_validate_iban_matches_schwifty():
+    """
+    Tests that the fast validation gives the same results as schwifty, including the countries
+    missing from the format tables (JO)
+    """
+
+    for number in NUMBERS:
+        assert validate_iban(number) == schwifty_validation(number), number
+
+
+def test_checksum():
+    """
+    Tests the streaming mod 97 checksum against the big integer computation
+    """
+
+    number = "GB82WEST12345698765432"
+    rearranged = number[4:] + number[:4]
+    assert _checksum(number) == int("".join(str(int(c, 36)) for c in rearranged)) % 97 == 1
+
+
+def test_validate_ibans_uses_cache():
+    """
+    Tests the bulk validation and the memoization of the results
+    """
+
+    hits = iban.iban_cache.hits
+    assert validate_ibans(["BE71096123456769", "BE71096123456768", "BE71096123456769"]) == [True, False, True]
+    assert iban.iban_cache.hits == hits + 1
+    assert len(iban.iban_cache) == 2
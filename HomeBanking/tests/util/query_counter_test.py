@@ -0,0 +1,88 @@
+import logging
+
+import pytest
+
+from tests.conftest import client, app, db_session
+from dao.account_dao import get_account, get_accounts, create_account
+from dao.shard_dao import hot_accounts
+from dao.transaction_dao import transfer
+from db.variables import settings
+from pojo.account import Account
+from pojo.transaction import Transaction
+from util.query_counter import count_queries, QueryBudgetExceeded, QUERIES_HEADER, QUERY_TIME_HEADER
+
+
+@pytest.fixture(autouse=True)
+def init(app, client, db_session):
+    """
+    Required to initialize the SQLite test database
+    """
+    pass
+
+
+def test_dao_query_budgets(user_with_accounts):
+    """
+    Tests the number of SQL statements of the main DAO functions
+    """
+
+    user_id, account1, account2 = user_with_accounts
+
+    with count_queries() as queries:
+        get_account(account1.number)
+    assert queries.count == 1
+
+    with count_queries() as queries:
+        create_account(Account(number="BE71096123456769", user_id=user_id))
+    assert queries.count == 3  # account lookup (the user is cached), account and opening checkpoint inserts
+
+    hot_accounts()  # read once per refresh period
+    with count_queries() as queries:
+        transfer(Transaction(from_acc=account1.number, to_acc=account2.number, amount=1.0))
+    assert queries.count == 4  # lock, balances update, transfer and ledger inserts
+    assert queries.duration > 0
+
+
+def test_query_budget_exceeded(user_with_accounts):
+    """
+    Tests that the statement exceeding the budget fails
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    with pytest.raises(QueryBudgetExceeded):
+        with count_queries(budget=2):
+            for i in range(3):
+                get_accounts(user_id)
+
+
+def test_repeated_statements(user_with_accounts):
+    """
+    Tests the detection of the statements repeated in a scope (N+1 pattern)
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    with count_queries() as queries:
+        for i in range(3):
+            get_accounts(user_id)
+    [(shape, count)] = queries.repeated(3)
+    assert count == 3 and shape.startswith("SELECT")
+
+
+def test_request_debug_headers(client, monkeypatch, caplog, user_with_accounts):
+    """
+    Tests the debug headers, the N+1 log and the strict mode of the requests
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    response = client.get(f"/accounts/{user_id}")
+    assert response.headers[QUERIES_HEADER] == "1"
+    assert float(response.headers[QUERY_TIME_HEADER]) >= 0
+
+    monkeypatch.setattr(settings, "n_plus_one_threshold", 1)
+    with caplog.at_level(logging.WARNING, logger="homebanking.sql"):
+        client.get(f"/accounts/{user_id}")
+    assert "Possible N+1 query on GET /accounts/" in caplog.text
+
+    monkeypatch.setattr(settings, "sql_query_budget", 1)
+    response = client.post("/create_account/", params={"number": "BE71096123456769", "user_id": user_id})
+    assert response.status_code == 500
+    assert get_account("BE71096123456769") is None
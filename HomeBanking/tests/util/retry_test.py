@@ -0,0 +1,193 @@
+import asyncio
+import datetime
+import sqlite3
+
+import pytest
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+import dao.async_transaction_dao
+import dao.transaction_dao
+from tests.conftest import client, app, db_session
+from dao.account_dao import get_account
+from dao.transaction_dao import transfer
+from db.database import get_db
+from db.tables.idempotency import IdempotencyKey as IdempotencyKeyTable
+from db.variables import settings
+from pojo.transaction import Transaction
+from util import metrics
+from util.messages import CONCURRENT_UPDATE
+from util.retry import is_transient, retry_transaction, TransactionConflict, MYSQL_DEADLOCK, MYSQL_LOCK_WAIT_TIMEOUT
+
+
+@pytest.fixture(autouse=True)
+def init(app, client, db_session, monkeypatch):
+    """
+    Initializes the SQLite test database and retries without waiting
+    """
+
+    monkeypatch.setattr(settings, "retry_base_delay", 0.0)
+
+
+def deadlock() -> OperationalError:
+    return OperationalError("UPDATE account ...", {}, Exception(MYSQL_DEADLOCK, "Deadlock found"))
+
+
+def test_is_transient():
+    """
+    Tests the recognition of the errors caused by concurrent transactions
+    """
+
+    assert is_transient(deadlock())
+    assert is_transient(OperationalError("SELECT ...", {}, Exception(MYSQL_LOCK_WAIT_TIMEOUT, "Lock wait timeout")))
+    assert is_transient(OperationalError("UPDATE ...", {}, sqlite3.OperationalError("database is locked")))
+    assert not is_transient(IntegrityError("INSERT ...", {}, Exception(1062, "Duplicate entry")))
+    assert not is_transient(ValueError("not a database error"))
+
+
+def test_retry_transaction():
+    """
+    Tests that a transient error is retried and that the retries are counted
+    """
+
+    calls = []
+
+    @retry_transaction
+    def operation(session=None):
+        calls.append(session)
+        if len(calls) < 3:
+            raise deadlock()
+        return "done"
+
+    retries = metrics.transaction_retries.value("operation")
+    assert operation() == "done"
+    assert len(calls) == 3
+    assert metrics.transaction_retries.value("operation") == retries + 2
+
+
+def test_retry_budget_exhausted():
+    """
+    Tests that a transaction failing at every attempt ends with a TransactionConflict, and that a nested retried
+    function is only retried by the outermost one
+    """
+
+    calls = []
+
+    @retry_transaction
+    def inner():
+        calls.append(1)
+        raise deadlock()
+
+    @retry_transaction
+    def outer():
+        return inner()
+
+    failures = metrics.transaction_failures.value("outer")
+    with pytest.raises(TransactionConflict):
+        outer()
+    assert len(calls) == settings.retry_attempts
+    assert metrics.transaction_failures.value("outer") == failures + 1
+
+    @retry_transaction
+    def duplicate():
+        calls.append(1)
+        raise IntegrityError("INSERT ...", {}, Exception(1062, "Duplicate entry"))
+
+    calls.clear()
+    with pytest.raises(IntegrityError):  # not retried
+        duplicate()
+    assert len(calls) == 1
+
+
+def test_async_retry_transaction():
+    """
+    Tests the retry of an asyncio DAO function
+    """
+
+    calls = []
+
+    @retry_transaction
+    async def operation():
+        calls.append(1)
+        if len(calls) < 2:
+            raise deadlock()
+        return "done"
+
+    assert asyncio.run(operation()) == "done"
+    assert len(calls) == 2
+
+
+def test_transfer_retried(monkeypatch, user_with_accounts):
+    """
+    Tests that a transfer whose transaction fails once is executed again, and executed once
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    record_transfers = dao.transaction_dao.record_transfers
+    failures = [deadlock()]
+
+    def failing_record_transfers(session, transactions):
+        if failures:
+            raise failures.pop()
+        record_transfers(session, transactions)
+
+    monkeypatch.setattr(dao.transaction_dao, "record_transfers", failing_record_transfers)
+    transfer(Transaction(from_acc=account1.number, to_acc=account2.number, amount=10.0))
+    assert get_account(account1.number).balance == 90.0
+    assert get_account(account2.number).balance == 10.0
+
+
+def test_transfer_conflict_response(client, monkeypatch, user_with_accounts):
+    """
+    Tests that a transfer failing at every attempt is reported instead of being silently dropped
+    """
+
+    user_id, account1, account2 = user_with_accounts
+
+    async def failing_record_transfers(session, transactions):
+        raise deadlock()
+
+    monkeypatch.setattr(settings, "retry_attempts", 3)  # within the query budget of the tests
+
+    monkeypatch.setattr(dao.async_transaction_dao, "_record_transfers", failing_record_transfers)
+    response = client.post("/transfer/", params={"from_acc": account1.number, "to_acc": account2.number,
+                                                 "amount": 10.0})
+    assert response.status_code == 503
+    assert response.json()["detail"] == CONCURRENT_UPDATE
+    assert response.headers["Retry-After"] == "1"
+    assert get_account(account1.number).balance == 100.0
+
+
+def test_expired_idempotency_key_retried(client, monkeypatch, user_with_accounts):
+    """
+    Tests that a transfer reusing an expired idempotency key records it again when its transaction is retried
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    params = {"from_acc": account1.number, "to_acc": account2.number, "amount": 10.0}
+    headers = {"Idempotency-Key": "expired"}
+    assert client.post("/transfer/", params=params, headers=headers).json() == {"ok": True}
+    session = get_db()
+    try:
+        session.execute(update(IdempotencyKeyTable).where(IdempotencyKeyTable.key == "expired")
+                        .values(expires_at=datetime.datetime.utcnow() - datetime.timedelta(seconds=1)))
+        session.commit()
+    finally:
+        session.close()
+
+    record_transfers = dao.async_transaction_dao._record_transfers
+    attempts = []
+
+    async def record_transfers_once_failing(session, transactions):
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise deadlock()
+        await record_transfers(session, transactions)
+
+    monkeypatch.setattr(dao.async_transaction_dao, "_record_transfers", record_transfers_once_failing)
+    response = client.post("/transfer/", params=dict(params, amount=20.0), headers=headers)
+    assert response.status_code == 200
+    assert len(attempts) == 2
+    assert get_account(account1.number).balance == 70.0
+    assert client.post("/transfer/", params=dict(params, amount=20.0), headers=headers).json() == {"ok": True}
+    assert get_account(account1.number).balance == 70.0
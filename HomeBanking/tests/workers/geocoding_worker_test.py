@@ -0,0 +1,143 @@
+import time
+
+import pytest
+
+from tests.conftest import client, app, db_session
+from dao.user_dao import create_user, get_user, modify_user
+from pojo.user import BaseUser, GEOCODING_PENDING, GEOCODING_DONE, GEOCODING_NOT_FOUND, GEOCODING_FAILED
+from util import util
+from util.geocoder import StubGeocoder
+from workers.geocoding_worker import GeocodingWorker, geocoding_worker
+
+DINANT = "rue Léopold 11, 5500 Dinant, Belgique"
+LILLOIS = "rue Comte Jacques de Meeus, 13, 1428 Lillois, Belgique"
+
+
+@pytest.fixture(autouse=True)
+def init(app, client, db_session, monkeypatch):
+    """
+    Initializes the SQLite test database and replaces the geocoder by a local one
+    """
+
+    geocoding_worker.process_pending()  # forgets the users queued by previous tests
+    geocoder = StubGeocoder({DINANT: (50.26, 4.91), LILLOIS: (50.64, 4.37)})
+    monkeypatch.setattr(util, "geocoder", geocoder)
+    monkeypatch.setattr(util.geocoder_rate_limiter, "rate", None)
+    util.geocoding_memory_cache.clear()
+    yield geocoder
+    util.geocoding_memory_cache.clear()
+
+
+def test_create_user_is_pending():
+    """
+    Tests that a new user is committed before being located, then located by the worker
+    """
+
+    user_id = create_user(BaseUser(firstname="Loup", lastname="Meurice", address=DINANT))
+    user = get_user(user_id)
+    assert user.coordinates is None
+    assert user.geocoding_status == GEOCODING_PENDING
+
+    assert geocoding_worker.process_pending() == 1
+    user = get_user(user_id)
+    assert user.coordinates.latitude == 50.26 and user.coordinates.longitude == 4.91
+    assert user.geocoding_status == GEOCODING_DONE
+
+
+def test_unknown_address():
+    """
+    Tests that an address that cannot be located is marked as not found
+    """
+
+    user_id = create_user(BaseUser(firstname="Loup", lastname="Meurice", address="malformed address"))
+    geocoding_worker.process_pending()
+
+    user = get_user(user_id)
+    assert user.coordinates is None
+    assert user.geocoding_status == GEOCODING_NOT_FOUND
+
+
+def test_geocoder_failure(init, monkeypatch):
+    """
+    Tests that a geocoder failure only affects the users of its address, which are marked as failed after
+    the maximum number of attempts
+    """
+
+    class FailingGeocoder(StubGeocoder):
+        def geocode(self, address: str):
+            if address == "failing address":
+                raise TimeoutError(address)
+            return super().geocode(address)
+
+    monkeypatch.setattr(util, "geocoder", FailingGeocoder(init.locations))
+    monkeypatch.setattr(util.settings, "geocoding_max_attempts", 2)
+    failing_id = create_user(BaseUser(firstname="Loup", lastname="Meurice", address="failing address"))
+    user_id = create_user(BaseUser(firstname="Loup", lastname="Meurice", address=DINANT))
+
+    assert geocoding_worker.process_pending() == 3  # the failing user is tried twice
+    assert get_user(user_id).geocoding_status == GEOCODING_DONE
+    assert get_user(failing_id).geocoding_status == GEOCODING_FAILED
+
+
+def test_modify_address():
+    """
+    Tests that an address change is located again
+    """
+
+    user_id = create_user(BaseUser(firstname="Loup", lastname="Meurice", address=DINANT))
+    geocoding_worker.process_pending()
+    modify_user(user_id, BaseUser(firstname="Loup", lastname="Meurice", address=LILLOIS))
+    assert get_user(user_id).geocoding_status == GEOCODING_PENDING
+
+    geocoding_worker.process_pending()
+    user = get_user(user_id)
+    assert user.coordinates.latitude == 50.64
+    assert user.geocoding_status == GEOCODING_DONE
+
+
+def test_pending_users_survive_restart():
+    """
+    Tests that a new worker resumes the users left pending in the database
+    """
+
+    user_ids = [create_user(BaseUser(firstname="Loup", lastname="Meurice", address=DINANT)) for i in range(3)]
+    while not geocoding_worker.queue.empty():  # the queued work is lost, as after a restart
+        geocoding_worker.queue.get_nowait()
+
+    assert GeocodingWorker(batch_size=2).process_pending() == 3
+    assert all(get_user(user_id).geocoding_status == GEOCODING_DONE for user_id in user_ids)
+
+
+def test_distinct_addresses_located_once(init):
+    """
+    Tests that the users of a batch sharing an address (up to case and punctuation) cost one geocoder call
+    """
+
+    for address in (DINANT, DINANT.upper(), LILLOIS, DINANT.replace(",", " ,")):
+        create_user(BaseUser(firstname="Loup", lastname="Meurice", address=address))
+
+    assert GeocodingWorker(threads=2).process_pending() == 4
+    assert sorted(init.calls) == sorted([DINANT, LILLOIS])
+
+
+def test_background_thread(init):
+    """
+    Tests that the worker thread locates the queued users and calls the geocoder once per distinct address
+    """
+
+    worker = GeocodingWorker(poll_interval=0.05)
+    user_ids = [create_user(BaseUser(firstname="Loup", lastname="Meurice", address=DINANT)) for i in range(3)]
+    for user_id in user_ids:
+        worker.submit(user_id)
+
+    worker.start()
+    try:
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline and \
+                any(get_user(user_id).geocoding_status == GEOCODING_PENDING for user_id in user_ids):
+            time.sleep(0.02)
+    finally:
+        worker.stop()
+
+    assert all(get_user(user_id).geocoding_status == GEOCODING_DONE for user_id in user_ids)
+    assert init.calls == [DINANT]
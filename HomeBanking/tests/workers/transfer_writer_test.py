@@ -0,0 +1,227 @@
+import os
+import time
+
+import orjson
+import pytest
+from sqlalchemy.exc import OperationalError
+
+import routers.transaction
+from tests.conftest import client, app, db_session
+from dao.account_dao import get_account
+from dao import transaction_dao
+from dao.transaction_dao import transfer_queued
+from pojo.transaction import Transaction, TRANSFER_PENDING, TRANSFER_DONE, TRANSFER_FAILED
+from util import metrics
+from db.variables import settings
+from util.messages import NOT_ENOUGH_MONEY, UNKNOWN_TO_ACCOUNT, QUEUED_IDEMPOTENCY_KEY, TRANSFER_NOT_EXECUTED
+from workers.transfer_writer import TransferWriter
+
+
+@pytest.fixture
+def writer(app, client, db_session, tmp_path, monkeypatch):
+    """
+    Initializes the SQLite test database and queues the transfers of the API in a temporary directory
+    """
+
+    writer = TransferWriter(directory=str(tmp_path), group_delay=0, fsync=False)
+    monkeypatch.setattr(routers.transaction, "transfer_writer", writer)
+    yield writer
+    writer.stop()
+
+
+def test_queued_transfer(client, writer, user_with_accounts):
+    """
+    Tests that a queued transfer is acknowledged before being executed, then executed by the writer
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    data = {"from_acc": account1.number, "to_acc": account2.number, "amount": 20.0, "queued": True}
+    response = client.post("/transfer/", params=data)
+    assert response.status_code == 202
+    transfer_id = response.json()["id"]
+    assert response.json() == {"id": transfer_id, "status": TRANSFER_PENDING}
+    assert client.get(f"/transfer/{transfer_id}").json()["status"] == TRANSFER_PENDING
+    assert get_account(account1.number).balance == 100.0
+
+    assert writer.process_pending() == 1
+    assert client.get(f"/transfer/{transfer_id}").json() == {"id": transfer_id, "status": TRANSFER_DONE}
+    assert get_account(account1.number).balance == 80.0
+    assert get_account(account2.number).balance == 20.0
+
+
+def test_queued_transfer_checks(client, writer, user_with_accounts):
+    """
+    Tests the checks done before queuing a transfer and the ones done when executing it
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    data = {"from_acc": account1.number, "to_acc": "unknown", "amount": 20.0, "queued": True}
+    response = client.post("/transfer/", params=data)
+    assert response.status_code == 422
+    assert response.json()["detail"] == UNKNOWN_TO_ACCOUNT
+
+    data["to_acc"] = account2.number
+    response = client.post("/transfer/", params=data, headers={"Idempotency-Key": "key"})
+    assert response.json()["detail"] == QUEUED_IDEMPOTENCY_KEY
+
+    data["amount"] = 1000.0
+    transfer_id = client.post("/transfer/", params=data).json()["id"]
+    writer.process_pending()
+    assert client.get(f"/transfer/{transfer_id}").json() == {"id": transfer_id, "status": TRANSFER_FAILED,
+                                                            "detail": NOT_ENOUGH_MONEY}
+    assert client.get("/transfer/unknown").status_code == 422
+
+
+def test_group_commit(writer, user_with_accounts):
+    """
+    Tests that the queued transfers are checked in order and committed together
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    commits = metrics.transfer_group_commit_size.count()
+    transfer_ids = [writer.submit(Transaction(from_acc=account1.number, to_acc=account2.number, amount=40.0))
+                    for i in range(3)]
+
+    assert writer.process_pending() == 3
+    assert metrics.transfer_group_commit_size.count() == commits + 1
+    assert [writer.status(transfer_id)["status"] for transfer_id in transfer_ids] == \
+        [TRANSFER_DONE, TRANSFER_DONE, TRANSFER_FAILED]
+    assert get_account(account1.number).balance == 20.0
+    assert os.path.getsize(writer._journal.name) == 0  # every queued transfer is committed
+
+
+def test_recover(client, writer, tmp_path, user_with_accounts):
+    """
+    Tests that the journal of a stopped process is replayed, the transfers committed before the stop being skipped
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    transfers = [Transaction(from_acc=account1.number, to_acc=account2.number, amount=amount)
+                 for amount in (10.0, 20.0)]
+    transfer_ids = [writer.submit(transaction) for transaction in transfers]
+    transfer_queued([(transfer_ids[0], transfers[0])])  # committed just before the stop
+    with open(writer._journal.name, "ab") as journal:
+        journal.write(b'{"id": "torn')  # write interrupted by a crash
+    writer.stop()
+
+    restarted = TransferWriter(directory=str(tmp_path), fsync=False)
+    assert restarted.recover() == 2
+    assert os.listdir(str(tmp_path)) == []
+    assert get_account(account1.number).balance == 70.0
+    for transfer_id in transfer_ids:  # read from the database
+        assert client.get(f"/transfer/{transfer_id}").json()["status"] == TRANSFER_DONE
+
+
+def test_journal_segments(tmp_path, writer, user_with_accounts):
+    """
+    Tests that the journal segments are deleted once their transfers are committed, even under steady load
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    writer = TransferWriter(directory=str(tmp_path / "segments"), group_size=2, group_delay=0, fsync=False)
+    transaction = Transaction(from_acc=account1.number, to_acc=account2.number, amount=1.0)
+    for i in range(3):
+        writer.submit(transaction)
+    assert len(os.listdir(writer.directory)) == 2
+
+    writer._commit(writer._take_queued(2))
+    assert os.listdir(writer.directory) == [os.path.basename(writer._journal.name)]
+    writer.submit(transaction)  # still queued while the previous transfer is committed
+    writer.process_pending()
+    assert os.path.getsize(writer._journal.name) == 0
+    writer.stop()
+    assert os.listdir(writer.directory) == []
+
+
+def test_dead_letter(client, writer, monkeypatch, user_with_accounts):
+    """
+    Tests that a group failing repeatedly is committed transfer by transfer, the failing transfer being
+    recorded as failed
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    transfer_ids = [writer.submit(Transaction(from_acc=account1.number, to_acc=account2.number, amount=10.0))
+                    for i in range(2)]
+    transfer_queued = transaction_dao.transfer_queued
+
+    def failing_transfer_queued(group):
+        if transfer_ids[0] in [transfer_id for transfer_id, transaction in group]:
+            raise RuntimeError("poison transfer")
+        return transfer_queued(group)
+
+    monkeypatch.setattr(transaction_dao, "transfer_queued", failing_transfer_queued)
+    writer.poll_interval = 0
+    writer._commit_with_retries(writer._take_queued(2))
+
+    assert client.get(f"/transfer/{transfer_ids[0]}").json() == {"id": transfer_ids[0], "status": TRANSFER_FAILED,
+                                                                 "detail": TRANSFER_NOT_EXECUTED}
+    assert writer.status(transfer_ids[1])["status"] == TRANSFER_DONE
+    assert get_account(account1.number).balance == 90.0
+    assert transaction_dao.fail_queued(transfer_ids[1], TRANSFER_NOT_EXECUTED)["status"] == TRANSFER_DONE
+    assert os.path.getsize(writer._journal.name) == 0
+
+
+def test_database_unavailable(writer, monkeypatch, user_with_accounts):
+    """
+    Tests that the transfers are kept in the journal and committed again while the database is unavailable,
+    whatever the number of failures
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    transfer_id = writer.submit(Transaction(from_acc=account1.number, to_acc=account2.number, amount=10.0))
+    transfer_queued = transaction_dao.transfer_queued
+    failures = []
+
+    def unavailable_transfer_queued(group):
+        if len(failures) < writer.commit_attempts * 2:
+            failures.append(group)
+            raise OperationalError("UPDATE account", {}, Exception("connection lost"))
+        return transfer_queued(group)
+
+    monkeypatch.setattr(transaction_dao, "transfer_queued", unavailable_transfer_queued)
+    writer.poll_interval = 0
+    writer._commit_with_retries(writer._take_queued(1))
+
+    assert writer.status(transfer_id)["status"] == TRANSFER_DONE
+    assert get_account(account1.number).balance == 90.0
+
+
+def test_dead_letter_not_recorded(writer, monkeypatch, user_with_accounts):
+    """
+    Tests that a dead-lettered transfer whose failed status cannot be recorded stays in the journal
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    transfer_id = writer.submit(Transaction(from_acc=account1.number, to_acc=account2.number, amount=10.0))
+
+    def failing_transfer_queued(group):
+        raise RuntimeError("poison transfer")
+
+    def failing_fail_queued(transfer_id, detail):
+        writer._stop.set()  # ends the attempts of the writer
+        raise OperationalError("INSERT INTO idempotency_key", {}, Exception("connection lost"))
+
+    monkeypatch.setattr(transaction_dao, "transfer_queued", failing_transfer_queued)
+    monkeypatch.setattr(transaction_dao, "fail_queued", failing_fail_queued)
+    writer.poll_interval = 0
+    writer._commit_with_retries(writer._take_queued(1))
+
+    assert writer.status(transfer_id)["status"] == TRANSFER_PENDING
+    assert os.path.getsize(writer._journal.name) > 0
+    writer.stop()
+    assert len(os.listdir(writer.directory)) == 1  # replayed at the next start
+
+
+def test_recover_expired(tmp_path, writer, user_with_accounts):
+    """
+    Tests that the transfers queued before the idempotency keys TTL are not replayed
+    """
+
+    user_id, account1, account2 = user_with_accounts
+    entry = {"id": "expired", "from_acc": account1.number, "to_acc": account2.number, "amount": 10.0,
+             "queued_at": time.time() - settings.idempotency_key_ttl - 1}
+    (tmp_path / "transfers-1-expired.log").write_bytes(orjson.dumps(entry) + b"\n")
+
+    assert TransferWriter(directory=str(tmp_path), fsync=False).recover() == 0
+    assert os.listdir(str(tmp_path)) == []
+    assert get_account(account1.number).balance == 100.0
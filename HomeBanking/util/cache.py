@@ -0,0 +1,90 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Bounded in-process cache with a least-recently-used eviction policy and a time-to-live per entry.
+    It is thread-safe and counts its hits, misses and evictions.
+
+    Attributes:
+        max_size: maximum number of entries
+        ttl: default time-to-live of an entry in seconds
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expiry time, value)
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        """
+        Looks a key up
+        :param key: the key to look up
+        :return: a (found, value) tuple, found being False if the key is missing or expired
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def get(self, key, default=None):
+        """
+        Returns the value of a key or default if the key is missing or expired
+        """
+
+        found, value = self.lookup(key)
+        return value if found else default
+
+    def put(self, key, value, ttl: float = None):
+        """
+        Stores a value, evicting the least recently used entries if the cache is full
+        :param key: the key
+        :param value: the value to store
+        :param ttl: time-to-live of this entry in seconds (default ttl if not specified)
+        """
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """
+        Removes a key from the cache
+        """
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Removes every entry (the counters are kept)
+        """
+
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        """
+        :return: the cache counters
+        """
+
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
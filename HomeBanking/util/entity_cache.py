@@ -0,0 +1,258 @@
+import pickle
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+from db.variables import settings
+from util.cache import TTLCache
+
+
+class CacheBackend(ABC):
+    """
+    Interface of the key-value stores holding the cached entities (in-process, or shared by the workers)
+
+    Attributes:
+        shared: True if the store is shared by every worker process, so that an invalidation reaches all of them
+    """
+
+    shared = False
+
+    @abstractmethod
+    def get(self, key: str):
+        """
+        :return: a (found, value) tuple
+        """
+
+    @abstractmethod
+    def set(self, key: str, value, ttl: float):
+        pass
+
+    @abstractmethod
+    def delete(self, key: str):
+        pass
+
+    @abstractmethod
+    def version(self, key: str) -> int:
+        """
+        :return: the value of a counter, 0 if it was never incremented
+        """
+
+    @abstractmethod
+    def incr(self, key: str) -> int:
+        """
+        Atomically increments a counter (created at 1)
+        :return: the new value
+        """
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+    def stats(self) -> dict:
+        """
+        :return: the counters of the store (e.g. evictions), if any
+        """
+        return {}
+
+
+class MemoryBackend(CacheBackend):
+    """
+    In-process store (bounded LRU with a time-to-live), also used as fake of the shared stores in the tests.
+    The counters are kept in a second LRU of the same size. A counter evicted from it restarts from the highest
+    evicted value rather than from 0, so that it never goes back to a version under which a stale value was stored
+
+    Attributes:
+        cache: the values
+        versions: the counters, least recently used first
+        evicted_version: highest value of the evicted counters, the value of the counters missing from versions
+    """
+
+    def __init__(self, max_size: int, ttl: float, shared: bool = False):
+        self.cache = TTLCache(max_size, ttl)
+        self.versions = OrderedDict()
+        self.evicted_version = 0
+        self.shared = shared
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        return self.cache.lookup(key)
+
+    def set(self, key: str, value, ttl: float):
+        self.cache.put(key, value, ttl)
+
+    def delete(self, key: str):
+        self.cache.invalidate(key)
+
+    def version(self, key: str) -> int:
+        with self._lock:
+            value = self.versions.get(key)
+            if value is None:
+                return self.evicted_version
+            self.versions.move_to_end(key)
+            return value
+
+    def incr(self, key: str) -> int:
+        with self._lock:
+            value = self.versions[key] = self.versions.get(key, self.evicted_version) + 1
+            self.versions.move_to_end(key)
+            while len(self.versions) > self.cache.max_size:
+                self.evicted_version = max(self.evicted_version, self.versions.popitem(last=False)[1])
+            return value
+
+    def clear(self):
+        with self._lock:
+            self.cache.clear()
+            self.versions.clear()
+            self.evicted_version = 0
+
+    def stats(self) -> dict:
+        return {"evictions": self.cache.evictions, "size": len(self.cache), "versions": len(self.versions)}
+
+
+class RedisBackend(CacheBackend):
+    """
+    Store shared by every worker process, based on Redis (the redis package is only required by this backend)
+    """
+
+    shared = True
+
+    def __init__(self, url: str, prefix: str = "homebanking:"):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key: str):
+        value = self.client.get(self.prefix + key)
+        return (False, None) if value is None else (True, pickle.loads(value))
+
+    def set(self, key: str, value, ttl: float):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=max(1, int(ttl)))
+
+    def delete(self, key: str):
+        self.client.delete(self.prefix + key)
+
+    def version(self, key: str) -> int:
+        return int(self.client.get(self.prefix + key) or 0)
+
+    def incr(self, key: str) -> int:
+        return self.client.incr(self.prefix + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+
+class EntityCache:
+    """
+    Read-through cache of one kind of entity (users, accounts...).
+    Every entity has a version, incremented by its invalidation: the values are stored under the version read
+    before loading them from the database, so that a value loaded concurrently with a write is never served
+    after the write. The cached values are shared and must not be modified
+
+    Attributes:
+        name: name of the entity kind, prefix of the keys
+        ttl: time-to-live of the cached values in seconds
+        backend: the store of the values and versions
+        hits: number of lookups served from the cache
+        misses: number of lookups requiring a database read
+    """
+
+    def __init__(self, name: str, ttl: float, backend: CacheBackend):
+        self.name = name
+        self.ttl = ttl
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        """
+        Looks an entity up
+        :param key: the entity ID
+        :return: a (found, value, version) tuple, the version being required to store the value loaded on a miss
+        """
+
+        version = self.backend.version(self._version_key(key))
+        found, value = self.backend.get(self._value_key(key, version))
+        with self._lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return found, value, version
+
+    def store(self, key, version: int, value):
+        """
+        Stores an entity loaded from the database. The absence of an entity (None) is only cached by a shared
+        store: the creation of the entity invalidates its ID in the process handling it, not in the other workers
+        :param key: the entity ID
+        :param version: the version returned by the lookup preceding the load
+        :param value: the entity, None if it does not exist
+        """
+
+        if value is None and not self.backend.shared:
+            return
+        self.backend.set(self._value_key(key, version), value, self.ttl)
+
+    def invalidate(self, *keys):
+        """
+        Discards entities, to be called once their modification is committed
+        :param keys: the entity IDs
+        """
+
+        for key in keys:
+            version = self.backend.version(self._version_key(key))
+            self.backend.delete(self._value_key(key, version))
+            self.backend.incr(self._version_key(key))
+
+    def stats(self) -> dict:
+        """
+        :return: the hit/miss counters and the hit ratio of the cache
+        """
+
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {"hits": hits, "misses": misses, "hit_ratio": hits / lookups if lookups else 0.0}
+
+    def _version_key(self, key) -> str:
+        return "%s:v:%s" % (self.name, key)
+
+    def _value_key(self, key, version: int) -> str:
+        return "%s:%s:%d" % (self.name, key, version)
+
+
+def backend_from_settings() -> CacheBackend:
+    """
+    :return: a RedisBackend if settings.entity_cache_redis_url is set, an in-process MemoryBackend otherwise
+    """
+
+    if settings.entity_cache_redis_url:
+        return RedisBackend(settings.entity_cache_redis_url)
+    return MemoryBackend(settings.entity_cache_size, settings.entity_cache_ttl)
+
+
+backend: CacheBackend = backend_from_settings()
+user_cache = EntityCache("users", settings.entity_cache_ttl, backend)
+account_cache = EntityCache("accounts", settings.entity_cache_ttl, backend)
+caches = (user_cache, account_cache)
+
+
+def set_backend(new_backend: CacheBackend):
+    """
+    Replaces the store of every entity cache (e.g. by a RedisBackend shared by the workers)
+    :param new_backend: the store to use
+    """
+
+    global backend
+    backend = new_backend
+    for cache in caches:
+        cache.backend = new_backend
+
+
+def clear():
+    """
+    Empties every entity cache
+    """
+
+    backend.clear()
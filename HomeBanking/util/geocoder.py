@@ -0,0 +1,79 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+
+
+class Geocoder(ABC):
+    """
+    Interface of the geocoding services used to calculate the users' geographical location
+    """
+
+    @abstractmethod
+    def geocode(self, address: str):
+        """
+        Locates an address
+        :param address: the address to locate
+        :return: a (latitude, longitude) tuple, (None, None) if the address cannot be located
+        """
+
+
+class NominatimGeocoder(Geocoder):
+    """
+    Geocoder based on the OpenStreetMap Nominatim service
+    """
+
+    def __init__(self, user_agent: str = "my_geocoder"):
+        from geopy.geocoders import Nominatim
+        self.geolocator = Nominatim(user_agent=user_agent)
+
+    def geocode(self, address: str):
+        location = self.geolocator.geocode(address)
+        if location is None:
+            return None, None
+        return location.latitude, location.longitude
+
+
+class StubGeocoder(Geocoder):
+    """
+    Local geocoder answering from a fixed dictionary, used to run the geocoding pipeline offline
+
+    Attributes:
+        locations: the (latitude, longitude) tuple of each known address
+        calls: the addresses requested so far
+    """
+
+    def __init__(self, locations: dict = None):
+        self.locations = locations or {}
+        self.calls = []
+
+    def geocode(self, address: str):
+        self.calls.append(address)
+        return self.locations.get(address, (None, None))
+
+
+class RateLimiter:
+    """
+    Thread-safe limiter spacing the calls to a service (e.g. Nominatim allows one request per second)
+
+    Attributes:
+        rate: maximum number of calls per second, no limit if None
+    """
+
+    def __init__(self, rate: float = None):
+        self.rate = rate
+        self._next_call = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """
+        Blocks until the next call is allowed
+        """
+
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if self._next_call > now:
+                time.sleep(self._next_call - now)
+                now = self._next_call
+            self._next_call = now + 1.0 / self.rate
@@ -0,0 +1,103 @@
+import math
+from typing import Set, Tuple
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+PRECISION = 9  # characters of the geohash stored with the users (cells of about 5 m)
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180.0
+
+
+def encode(latitude: float, longitude: float, precision: int = PRECISION) -> str:
+    """
+    Computes the geohash of a location: the cells are split alternately by longitude and latitude, so that
+    the locations sharing a prefix are in the same cell and a cell is an index range scan
+    :param latitude: latitude in degrees
+    :param longitude: longitude in degrees (normalized to [-180, 180))
+    :param precision: number of characters
+    :return: the geohash
+    """
+
+    longitude = (longitude + 180.0) % 360.0 - 180.0
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        interval, coordinate = (lon_range, longitude) if even else (lat_range, latitude)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits = 0
+            value = 0
+    return "".join(chars)
+
+
+def cell_size(precision: int) -> Tuple[float, float]:
+    """
+    :return: the (latitude, longitude) size in degrees of the cells of a precision
+    """
+
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+
+def covering_cells(latitude: float, longitude: float, radius_km: float) -> Set[str]:
+    """
+    Computes the geohash cells covering a circle. The precision is the finest one whose cells are at least as
+    large as the radius, so that a handful of cells (usually 4 to 9) cover the bounding box of the circle
+    :param latitude: latitude of the center in degrees
+    :param longitude: longitude of the center in degrees
+    :param radius_km: radius in kilometers
+    :return: the geohashes of the cells
+    """
+
+    d_lat = radius_km / KM_PER_DEGREE
+    cos_lat = math.cos(math.radians(min(89.9, abs(latitude) + d_lat)))
+    d_lon = min(180.0, radius_km / (KM_PER_DEGREE * cos_lat))
+
+    precision = 1
+    while precision < PRECISION:
+        lat_size, lon_size = cell_size(precision + 1)
+        if lat_size < d_lat or lon_size < d_lon:
+            break
+        precision += 1
+    lat_size, lon_size = cell_size(precision)
+
+    lat_min, lat_max = max(-90.0, latitude - d_lat), min(90.0, latitude + d_lat)
+    lon_min, lon_max = longitude - d_lon, longitude + d_lon
+    cells = set()
+    lat = lat_min
+    while True:
+        lon = lon_min
+        while True:
+            cells.add(encode(min(lat, 89.999999), lon, precision))
+            if lon >= lon_max:
+                break
+            lon = min(lon + lon_size, lon_max)
+        if lat >= lat_max:
+            break
+        lat = min(lat + lat_size, lat_max)
+    return cells
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """
+    :return: the great-circle distance in kilometers between two locations
+    """
+
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
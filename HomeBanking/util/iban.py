@@ -0,0 +1,120 @@
+import re
+from typing import Iterable, List
+
+from db.variables import settings
+from util.cache import TTLCache
+
+# BBAN format of the SEPA countries, in the notation of the SWIFT IBAN registry:
+# n digits, a upper case letters, c upper case letters and digits, ! fixed length
+BBAN_SPECS = {
+    "AD": "4!n4!n12!c", "AT": "5!n11!n", "BE": "3!n7!n2!n", "BG": "4!a4!n2!n8!c", "CH": "5!n12!c",
+    "CY": "3!n5!n16!c", "CZ": "4!n6!n10!n", "DE": "8!n10!n", "DK": "4!n9!n1!n", "EE": "2!n2!n11!n1!n",
+    "ES": "4!n4!n1!n1!n10!n", "FI": "3!n11!n", "FR": "5!n5!n11!c2!n", "GB": "4!a6!n8!n", "GI": "4!a15!c",
+    "GR": "3!n4!n16!c", "HR": "7!n10!n", "HU": "3!n4!n1!n15!n1!n", "IE": "4!a6!n8!n", "IS": "4!n2!n6!n10!n",
+    "IT": "1!a5!n5!n12!c", "LI": "5!n12!c", "LT": "5!n11!n", "LU": "3!n13!c", "LV": "4!a13!c",
+    "MC": "5!n5!n11!c2!n", "MT": "4!a5!n18!c", "NL": "4!a10!n", "NO": "4!n6!n1!n", "PL": "8!n16!n",
+    "PT": "4!n4!n11!n2!n", "RO": "4!a16!c", "SE": "3!n16!n1!n", "SI": "5!n8!n2!n", "SK": "4!n6!n10!n",
+    "SM": "1!a5!n5!n12!c", "VA": "3!n15!n",
+}
+
+_SPEC_TOKEN = re.compile(r"(\d+)(!?)([nac])")
+_SPEC_CLASSES = {"n": "[0-9]", "a": "[A-Z]", "c": "[A-Z0-9]"}
+_WHITESPACE = re.compile(r"\s+")
+_HEADER = re.compile(r"[A-Z]{2}[0-9]{2}")
+
+
+def _compile(spec: str):
+    """
+    Compiles a BBAN format
+    :param spec: the format in the registry notation
+    :return: the (IBAN length, compiled BBAN regular expression) tuple
+    """
+
+    length = 4
+    pattern = ""
+    for size, fixed, kind in _SPEC_TOKEN.findall(spec):
+        length += int(size)
+        pattern += _SPEC_CLASSES[kind] + ("{%s}" % size if fixed else "{1,%s}" % size)
+    return length, re.compile(pattern)
+
+
+# Country code -> (IBAN length, BBAN regular expression), compiled once at import
+IBAN_FORMATS = {country: _compile(spec) for country, spec in BBAN_SPECS.items()}
+
+# Results of the validations, an IBAN validity never changes
+iban_cache = TTLCache(settings.iban_cache_size, float("inf"))
+
+
+def validate_iban(number: str) -> bool:
+    """
+    Checks the format and the checksum of an IBAN (spaces and case are ignored).
+    The IBANs of the SEPA countries are checked against the precompiled format tables, the other countries
+    are delegated to schwifty. The results are memoized in a bounded LRU cache
+    :param number: the account number to check
+    :return: True if the number is a valid IBAN
+    """
+
+    found, valid = iban_cache.lookup(number)
+    if not found:
+        valid = _validate(number)
+        iban_cache.put(number, valid)
+    return valid
+
+
+def validate_ibans(numbers: Iterable[str]) -> List[bool]:
+    """
+    Checks a list of IBANs
+    :param numbers: the account numbers to check
+    :return: the validity of each account number, in order
+    """
+
+    return [validate_iban(number) for number in numbers]
+
+
+def _validate(number: str) -> bool:
+    """
+    Checks an IBAN without cache
+    """
+
+    if not isinstance(number, str):
+        return False
+    iban = _WHITESPACE.sub("", number).upper()
+    if not _HEADER.match(iban):
+        return False
+    iban_format = IBAN_FORMATS.get(iban[:2])
+    if iban_format is None:
+        return _validate_with_schwifty(iban)
+    length, bban = iban_format
+    return len(iban) == length and bban.fullmatch(iban, 4) is not None and _checksum(iban) == 1
+
+
+def _checksum(iban: str) -> int:
+    """
+    Computes the ISO 7064 mod 97-10 remainder of an IBAN without building the big integer: the BBAN followed by
+    the country code and check digits is read one character at a time, letters counting as two digits (A = 10)
+    :param iban: the IBAN, upper case letters and digits only
+    :return: the remainder, 1 for a valid IBAN
+    """
+
+    remainder = 0
+    for char in iban[4:] + iban[:4]:
+        if char <= "9":
+            remainder = (remainder * 10 + ord(char) - 48) % 97
+        else:
+            remainder = (remainder * 100 + ord(char) - 55) % 97
+    return remainder
+
+
+def _validate_with_schwifty(iban: str) -> bool:
+    """
+    Checks an IBAN of a country missing from the format tables with schwifty
+    """
+
+    from schwifty import IBAN
+    from schwifty.exceptions import SchwiftyException
+
+    try:
+        IBAN(iban)
+        return True
+    except SchwiftyException:
+        return False
@@ -3,10 +3,18 @@ ALREADY_USED_ACCOUNT_NUMBER = "This account number is already used"
 INVALID_ACCOUNT_NUMBER = "This account number is invalid"
 UNKNOWN_FROM_ACCOUNT = "The sender account is unknown"
 UNKNOWN_TO_ACCOUNT = "The recipient account is unknown"
+UNKNOWN_ACCOUNT = "The account is unknown"
 NOT_ENOUGH_MONEY = "The sender account balance is insufficient"
 NEGATIVE_AMOUNT = "The amount to transfer has to be a positive number"
+IDEMPOTENCY_KEY_REUSED = "This idempotency key was already used by a different request"
+UNKNOWN_IMPORT_JOB = "The import job is unknown"
+INVALID_SHARD_COUNT = "The number of shards has to be between 0 and %d"
+UNKNOWN_TRANSFER = "The transfer is unknown"
+QUEUED_IDEMPOTENCY_KEY = "Idempotency keys are not supported by queued transfers"
+TRANSFER_NOT_EXECUTED = "The transfer could not be executed, it can be sent again"
 
 UNEXPECTED_ERROR = "Error processing request"
+CONCURRENT_UPDATE = "The request conflicted with concurrent requests, please retry"
 
 
 class BankingException(Exception):
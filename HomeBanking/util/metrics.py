@@ -0,0 +1,326 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from util import entity_cache
+from util.query_counter import request_queries
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Metric(ABC):
+    """
+    Base class of the metrics exposed in the Prometheus text format. The samples are indexed by label values
+
+    Attributes:
+        name: metric name
+        help: description of the metric
+        labelnames: names of the labels
+    """
+
+    type = None
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def render(self) -> str:
+        """
+        :return: the HELP and TYPE lines followed by the samples of the metric
+        """
+
+        return "# HELP %s %s\n# TYPE %s %s\n%s" % (self.name, self.help, self.name, self.type,
+                                                  "".join(self._samples()))
+
+    @abstractmethod
+    def _samples(self):
+        """
+        :return: the sample lines of the metric
+        """
+
+    def _labels(self, values: tuple, extra: str = None) -> str:
+        pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(self.labelnames, values)]
+        if extra is not None:
+            pairs.append(extra)
+        return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+class Counter(Metric):
+    """
+    Monotonic counter
+    """
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0.0)
+
+    def _samples(self):
+        for labels, value in sorted(self._values.items()):
+            yield "%s%s %s\n" % (self.name, self._labels(labels), _format(value))
+
+
+class Gauge(Metric):
+    """
+    Value read at scrape time by a callback
+
+    Attributes:
+        function: returns the current value of each label values tuple
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), function: Callable[[], dict] = None):
+        super().__init__(name, help, labelnames)
+        self.function = function or dict
+
+    def _samples(self):
+        for labels, value in sorted(self.function().items()):
+            yield "%s%s %s\n" % (self.name, self._labels(labels), _format(value))
+
+
+class CallbackCounter(Gauge):
+    """
+    Counter maintained by another component, read at scrape time by a callback
+    """
+
+    type = "counter"
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values in cumulative buckets
+
+    Attributes:
+        buckets: upper bounds of the buckets
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        self._values: Dict[tuple, list] = {}  # labels -> [count per bucket..., +Inf count, sum]
+
+    def observe(self, value: float, *labels):
+        with self._lock:
+            values = self._values.get(labels)
+            if values is None:
+                values = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+                    break
+            else:
+                values[len(self.buckets)] += 1
+            values[-1] += value
+
+    def count(self, *labels) -> int:
+        values = self._values.get(labels)
+        return sum(values[:-1]) if values else 0
+
+    def sum(self, *labels) -> float:
+        values = self._values.get(labels)
+        return values[-1] if values else 0.0
+
+    def _samples(self):
+        for labels, values in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values):
+                cumulative += count
+                le = 'le="%s"' % ("+Inf" if bound == float("inf") else _format(bound))
+                yield "%s_bucket%s %d\n" % (self.name, self._labels(labels, le), cumulative)
+            yield "%s_sum%s %s\n" % (self.name, self._labels(labels), _format(values[-1]))
+            yield "%s_count%s %d\n" % (self.name, self._labels(labels), cumulative)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format(value: float) -> str:
+    return repr(float(value))
+
+
+registry = []  # every metric of the process, in declaration order
+
+
+def render() -> str:
+    """
+    :return: every metric of the process in the Prometheus text exposition format
+    """
+
+    return "".join(metric.render() for metric in registry)
+
+
+# Metrics of the process
+http_requests = Counter("http_requests_total", "HTTP requests by route and status code",
+                        ("method", "route", "status"))
+http_request_duration = Histogram("http_request_duration_seconds", "HTTP request latency by route",
+                                  ("method", "route"))
+http_unexpected_errors = Counter("http_unexpected_errors_total", "Unexpected errors (HTTP 500) by exception type",
+                                 ("exception",))
+sql_statements_per_request = Histogram("sql_statements_per_request", "SQL statements executed by a request",
+                                       ("method", "route"), COUNT_BUCKETS)
+sql_statement_duration = Histogram("sql_statement_duration_seconds", "SQL statement execution time", ("engine",))
+pool_checkout_wait = Histogram("db_pool_checkout_wait_seconds", "Time spent waiting for a connection of the pool",
+                                ("engine",))
+pool_connection_hold = Histogram("db_pool_connection_hold_seconds",
+                                 "Time a connection stays checked out of the pool", ("engine",))
+pool_connections_opened = Counter("db_pool_connections_opened_total", "Database connections opened by the pool",
+                                  ("engine",))
+pool_connections_in_use = Gauge("db_pool_connections_in_use", "Connections currently checked out of the pool",
+                                ("engine",))
+geocoder_request_duration = Histogram("geocoder_request_duration_seconds", "Geocoder call latency")
+geocoder_failures = Counter("geocoder_failures_total", "Geocoder calls ending with an exception", ("exception",))
+transaction_retries = Counter("transaction_retries_total",
+                              "Transactions executed again after a deadlock or a serialization failure", ("operation",))
+transaction_failures = Counter("transaction_conflict_failures_total",
+                               "Transactions still failing because of concurrent transactions after all their attempts",
+                               ("operation",))
+replica_healthy = Gauge("db_replica_healthy", "Result of the last health check of each read replica (1 healthy)",
+                        ("replica",))
+replica_lag = Gauge("db_replica_lag_seconds", "Replication lag of each MySQL read replica at its last health check",
+                    ("replica",))
+transfer_queue_pending = Gauge("transfer_queue_pending", "Queued transfers not committed yet")
+transfer_group_commit_size = Histogram("transfer_group_commit_size", "Queued transfers committed together", (),
+                                       COUNT_BUCKETS + (200, 500))
+entity_cache_lookups = CallbackCounter(
+    "entity_cache_lookups_total", "Entity cache lookups by cache and result", ("cache", "result"),
+    lambda: {(cache.name, result): cache.stats()[result] for cache in entity_cache.caches
+             for result in ("hits", "misses")})
+entity_cache_hit_ratio = Gauge("entity_cache_hit_ratio", "Share of the entity cache lookups served from memory",
+                               ("cache",),
+                               lambda: {(cache.name,): cache.stats()["hit_ratio"] for cache in entity_cache.caches})
+entity_cache_evictions = CallbackCounter("entity_cache_evictions_total",
+                                         "Entries evicted from the entity cache store to respect its size", (),
+                                         lambda: {(): entity_cache.backend.stats().get("evictions", 0)})
+
+_pools = {}  # engine label -> pool
+
+
+class TimedPool:
+    """
+    Connection pool measuring the time spent acquiring each connection: waiting for a free connection, opening a new
+    one or checking it with a ping
+
+    Attributes:
+        metrics_label: value of the engine label of the measures, set by instrument_engine (not measured while None)
+    """
+
+    metrics_label = None
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            if self.metrics_label is not None:
+                pool_checkout_wait.observe(time.perf_counter() - start, self.metrics_label)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics_label = self.metrics_label
+        return pool
+
+
+class TimedQueuePool(TimedPool, QueuePool):
+    """
+    Connection pool of the synchronous engines
+    """
+
+
+class TimedAsyncQueuePool(TimedPool, AsyncAdaptedQueuePool):
+    """
+    Connection pool of the asyncio engines
+    """
+
+
+def instrument_engine(engine, label: str):
+    """
+    Registers the SQLAlchemy event listeners measuring the statements and the connection pool of an engine
+    :param engine: the engine (the sync_engine of an asyncio engine)
+    :param label: value of the engine label of the metrics
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info["query_start"] = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info.pop("query_start", None)
+        if start is not None:
+            sql_statement_duration.observe(time.perf_counter() - start, label)
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        pool_connections_opened.inc(label)
+
+    @event.listens_for(engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        connection_record.info["checkout_start"] = time.perf_counter()
+
+    @event.listens_for(engine, "checkin")
+    def checkin(dbapi_connection, connection_record):
+        start = connection_record.info.pop("checkout_start", None) if connection_record is not None else None
+        if start is not None:
+            pool_connection_hold.observe(time.perf_counter() - start, label)
+
+    if isinstance(engine.pool, TimedPool):
+        engine.pool.metrics_label = label
+    _pools[label] = engine.pool
+
+
+pool_connections_in_use.function = lambda: {(label, ): pool.checkedout() for label, pool in _pools.items()
+                                            if hasattr(pool, "checkedout")}
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware measuring the latency, the status code and the number of SQL statements of every HTTP request.
+    Requests are labelled by route template (e.g. /user/{user_id}) to keep the number of series bounded
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        with request_queries() as queries:
+            try:
+                await self.app(scope, receive, send_with_status)
+            finally:
+                route = scope.get("route")
+                path = route.path if route is not None else "unmatched"
+                http_request_duration.observe(time.perf_counter() - start, scope["method"], path)
+                http_requests.inc(scope["method"], path, str(status[0]))
+                sql_statements_per_request.observe(queries.count, scope["method"], path)
@@ -0,0 +1,149 @@
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+from db.variables import settings
+
+QUERIES_HEADER = "X-SQL-Queries"  # debug header giving the number of statements executed by the request
+QUERY_TIME_HEADER = "X-SQL-Time-Ms"  # debug header giving the time spent executing them
+
+logger = logging.getLogger("homebanking.sql")
+
+_PLACEHOLDER_LIST = re.compile(r"\((?:\s*(?:\?|%s)\s*,)+\s*(?:\?|%s)\s*\)")
+
+
+class QueryBudgetExceeded(Exception):
+    """
+    Raised by the statement exceeding the query budget of a request (strict mode)
+    """
+
+
+class QueryCounter:
+    """
+    Statements executed in a scope (an HTTP request or a block of code)
+
+    Attributes:
+        budget: maximum number of statements, no limit if None
+        count: number of statements executed
+        duration: seconds spent executing them
+        shapes: number of executions of each statement shape (SQL text with the IN lists collapsed)
+    """
+
+    def __init__(self, budget: int = None):
+        self.budget = budget
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+
+    def repeated(self, threshold: int) -> list:
+        """
+        :return: the (shape, executions) of the statements executed at least threshold times (N+1 candidates)
+        """
+
+        return [(shape, count) for shape, count in self.shapes.most_common() if count >= threshold]
+
+
+_current: ContextVar = ContextVar("query_counter", default=None)
+
+
+def current() -> QueryCounter:
+    """
+    :return: the counter of the current scope, None outside of a counted scope
+    """
+
+    return _current.get()
+
+
+@contextmanager
+def count_queries(budget: int = None):
+    """
+    Counts the statements executed in a block of code (e.g. a DAO call in a test)
+    :param budget: maximum number of statements, a QueryBudgetExceeded is raised by the statement exceeding it
+    :return: the counter
+    """
+
+    counter = QueryCounter(budget)
+    token = _current.set(counter)
+    try:
+        yield counter
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def request_queries():
+    """
+    Provides the counter of the current request, created by the first middleware asking for it
+    """
+
+    counter = _current.get()
+    if counter is not None:
+        yield counter
+        return
+    with count_queries() as counter:
+        yield counter
+
+
+def instrument_engine(engine):
+    """
+    Registers the SQLAlchemy event listeners counting and timing the statements of the current scope
+    :param engine: the engine (the sync_engine of an asyncio engine)
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        counter = _current.get()
+        if counter is None:
+            return
+        counter.count += 1
+        counter.shapes[_PLACEHOLDER_LIST.sub("(?)", statement)] += 1
+        if counter.budget is not None and counter.count > counter.budget:
+            raise QueryBudgetExceeded("%d SQL statements executed, the budget is %d: %s"
+                                      % (counter.count, counter.budget, statement))
+        conn.info["counted_query_start"] = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        counter = _current.get()
+        start = conn.info.pop("counted_query_start", None)
+        if counter is not None and start is not None:
+            counter.duration += time.perf_counter() - start
+
+
+class QueryCounterMiddleware:
+    """
+    ASGI middleware counting the SQL statements of every HTTP request. Depending on the settings, it returns the
+    totals in debug headers, logs the statements repeated in a request (N+1 pattern) and fails the requests
+    exceeding the query budget (strict mode, used by the tests).
+    The headers are sent with the response start, so the statements of a streamed body are not included
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with request_queries() as counter:
+            counter.budget = settings.sql_query_budget
+
+            async def send_with_headers(message):
+                if message["type"] == "http.response.start" and settings.sql_debug_headers:
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (QUERIES_HEADER.lower().encode(), str(counter.count).encode()),
+                        (QUERY_TIME_HEADER.lower().encode(), ("%.3f" % (counter.duration * 1000)).encode())]
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_headers)
+            finally:
+                for shape, count in counter.repeated(settings.n_plus_one_threshold):
+                    logger.warning("Possible N+1 query on %s %s: %d executions of %s",
+                                   scope["method"], scope["path"], count, shape)
@@ -0,0 +1,134 @@
+import asyncio
+import functools
+import inspect
+import logging
+import random
+import time
+from contextvars import ContextVar
+
+from sqlalchemy.exc import DBAPIError
+
+from db.variables import settings
+from util.metrics import transaction_retries, transaction_failures
+
+logger = logging.getLogger("homebanking.retry")
+
+# MySQL error codes of the transactions rolled back because of concurrent transactions
+MYSQL_LOCK_WAIT_TIMEOUT = 1205
+MYSQL_DEADLOCK = 1213
+# SQLSTATE of the serialization failures and deadlocks (standard SQL and PostgreSQL)
+SERIALIZATION_FAILURE = "40001"
+DEADLOCK_DETECTED = "40P01"
+
+_retrying = ContextVar("retrying", default=False)  # true inside a function retried by retry_transaction
+
+
+class TransactionConflict(Exception):
+    """
+    Raised when a transaction still fails because of concurrent transactions after all its attempts
+    """
+
+
+def is_transient(error: Exception) -> bool:
+    """
+    Tells if a database error is caused by concurrent transactions (deadlock, lock wait timeout, serialization
+    failure, locked SQLite database), i.e. if the transaction can succeed when executed again
+    :param error: the exception raised by SQLAlchemy
+    """
+
+    if not isinstance(error, DBAPIError) or error.orig is None:
+        return False
+    orig = error.orig
+    code = orig.args[0] if orig.args and isinstance(orig.args[0], int) else None
+    sqlstate = getattr(orig, "sqlstate", None) or getattr(orig, "pgcode", None)
+    return code in (MYSQL_LOCK_WAIT_TIMEOUT, MYSQL_DEADLOCK) or sqlstate in (SERIALIZATION_FAILURE, DEADLOCK_DETECTED) \
+        or "database is locked" in str(orig)
+
+
+def backoff_delay(attempt: int) -> float:
+    """
+    :param attempt: the number of failed attempts
+    :return: the seconds to wait before the next attempt (exponential backoff with full jitter)
+    """
+
+    return random.uniform(0, min(settings.retry_max_delay, settings.retry_base_delay * 2 ** (attempt - 1)))
+
+
+def retry_transaction(function):
+    """
+    Decorator executing a DAO write function again when its transaction fails because of concurrent transactions,
+    up to settings.retry_attempts attempts. The session given by the caller (session argument) is rolled back
+    before every new attempt, so the decorated function must run the whole transaction (locks, checks and writes).
+    A retried function called by another one is not retried itself, the outermost function retries the transaction
+    :raises TransactionConflict: the last attempt failed because of concurrent transactions
+    """
+
+    name = function.__name__
+    signature = inspect.signature(function)
+
+    def session_of(args, kwargs):
+        return signature.bind_partial(*args, **kwargs).arguments.get("session")
+
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def async_wrapper(*args, **kwargs):
+            if _retrying.get():
+                return await function(*args, **kwargs)
+            token = _retrying.set(True)
+            try:
+                attempt = 1
+                while True:
+                    try:
+                        return await function(*args, **kwargs)
+                    except DBAPIError as e:
+                        if not _retry(name, e, attempt):
+                            raise
+                        session = session_of(args, kwargs)
+                        if session is not None:
+                            await session.rollback()
+                        await asyncio.sleep(backoff_delay(attempt))
+                        attempt += 1
+            finally:
+                _retrying.reset(token)
+
+        return async_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _retrying.get():
+            return function(*args, **kwargs)
+        token = _retrying.set(True)
+        try:
+            attempt = 1
+            while True:
+                try:
+                    return function(*args, **kwargs)
+                except DBAPIError as e:
+                    if not _retry(name, e, attempt):
+                        raise
+                    session = session_of(args, kwargs)
+                    if session is not None:
+                        session.rollback()
+                    time.sleep(backoff_delay(attempt))
+                    attempt += 1
+        finally:
+            _retrying.reset(token)
+
+    return wrapper
+
+
+def _retry(name: str, error: DBAPIError, attempt: int) -> bool:
+    """
+    Decides if a failed attempt is retried, and counts it
+    :return: true if the attempt is retried
+    :raises TransactionConflict: the error is transient but there is no attempt left
+    """
+
+    if not is_transient(error):
+        return False
+    if attempt >= settings.retry_attempts:
+        transaction_failures.inc(name)
+        logger.warning("%s failed after %d attempts: %s", name, attempt, error.orig)
+        raise TransactionConflict("%s failed after %d attempts" % (name, attempt)) from error
+    transaction_retries.inc(name)
+    return True
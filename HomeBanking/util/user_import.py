@@ -0,0 +1,236 @@
+import asyncio
+import csv
+import logging
+import tempfile
+import uuid
+from datetime import datetime
+from typing import AsyncIterator, BinaryIO, List, Optional
+
+import orjson
+from pydantic import ValidationError
+
+from db.variables import settings
+from pojo.user import BaseUser
+
+FORMAT_CSV = "csv"  # header line with the firstname, lastname and address columns, then one user per line
+FORMAT_NDJSON = "ndjson"  # one JSON object per line
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+READ_SIZE = 64 * 1024  # bytes read at once from a spooled upload
+
+logger = logging.getLogger("homebanking.jobs")
+
+
+class ImportJob:
+    """
+    Progress and error report of a bulk user import
+
+    Attributes:
+        id: job ID
+        status: running, done or failed (the rows of the chunks inserted before a failure are kept)
+        rows: number of rows read
+        imported: number of users created
+        error_count: number of rejected rows
+        errors: the first rejected rows (line number and error)
+        last_user_id: last ID of the created users (None before the first insert)
+    """
+
+    def __init__(self, job_id: str = None):
+        self.id = job_id or uuid.uuid4().hex
+        self.status = STATUS_RUNNING
+        self.started_at = datetime.utcnow()
+        self.finished_at = None
+        self.rows = 0
+        self.imported = 0
+        self.error_count = 0
+        self.errors = []
+        self.last_user_id = None
+
+    def reject(self, line: int, error: str):
+        """
+        Records a rejected row
+        :param line: the line number in the upload
+        :param error: the reason
+        """
+
+        self.error_count += 1
+        if len(self.errors) < settings.import_max_errors:
+            self.errors.append({"line": line, "error": error})
+
+    def inserted(self, user_ids: List[int]):
+        """
+        Records an inserted chunk
+        :param user_ids: the IDs generated for the users of the chunk
+        """
+
+        self.imported += len(user_ids)
+        if user_ids:
+            self.last_user_id = max(user_ids)
+
+    def report(self, geocoding_pending: int = None) -> dict:
+        """
+        :param geocoding_pending: number of created users not located yet
+        :return: the progress and errors of the job
+        """
+
+        return {"job_id": self.id, "status": self.status, "started_at": self.started_at.isoformat(),
+                "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+                "rows": self.rows, "imported": self.imported, "error_count": self.error_count,
+                "errors": self.errors, "geocoding_pending": geocoding_pending}
+
+
+_running = set()  # the import tasks of the process, referenced until they end
+
+
+async def spool(chunks: AsyncIterator[bytes]) -> BinaryIO:
+    """
+    Copies an upload to a temporary file, so that it is imported once the request is answered
+    :param chunks: the raw upload (e.g. the request stream)
+    :return: the temporary file, positioned at its start and deleted once closed
+    """
+
+    upload = tempfile.TemporaryFile()
+    try:
+        async for chunk in chunks:
+            upload.write(chunk)
+        upload.seek(0)
+    except BaseException:
+        upload.close()
+        raise
+    return upload
+
+
+def start_import(job: ImportJob, upload: BinaryIO, data_format: str, insert_users, save_job) -> asyncio.Task:
+    """
+    Imports a spooled upload in the background of the event loop, the upload being closed at the end of the import
+    :param job: the job, already saved
+    :param upload: the file returned by spool
+    :param data_format: FORMAT_CSV or FORMAT_NDJSON
+    :param insert_users: coroutine inserting a list of users for a job, see import_users
+    :param save_job: coroutine saving the progress of the job
+    :return: the import task
+    """
+
+    async def run():
+        with upload:
+            try:
+                await import_users(job, _read(upload), data_format, insert_users, save_job)
+            except Exception:
+                logger.exception("Bulk import %s failed", job.id)
+
+    task = asyncio.get_running_loop().create_task(run())
+    _running.add(task)
+    task.add_done_callback(_running.discard)
+    return task
+
+
+async def cancel_imports():
+    """
+    Stops the imports of the process (at shutdown), their jobs being saved as failed
+    """
+
+    tasks = list(_running)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def import_users(job: ImportJob, chunks: AsyncIterator[bytes], data_format: str, insert_users,
+                       save_job) -> ImportJob:
+    """
+    Imports the users of a streamed upload: the lines are parsed and validated as they arrive, and every chunk
+    of settings.import_chunk_size valid users is inserted with one executemany INSERT. The progress is saved after
+    every chunk, and the geographical locations are calculated afterwards by the geocoding worker
+    :param job: the job reporting the progress
+    :param chunks: the raw upload
+    :param data_format: FORMAT_CSV or FORMAT_NDJSON
+    :param insert_users: coroutine inserting a list of users tagged with the job ID, after the last user of the job,
+    and returning their IDs
+    :param save_job: coroutine saving the progress of the job
+    :return: the job, done (or failed) with its report
+    """
+
+    users = []
+    header = None
+    try:
+        line_number = 0
+        async for line in _lines(chunks):
+            line_number += 1
+            if not line.strip():
+                continue
+            if data_format == FORMAT_CSV and header is None:
+                header = [column.strip() for column in _parse_csv(line)]
+                continue
+            job.rows += 1
+            user, error = _parse_user(line, data_format, header)
+            if error is not None:
+                job.reject(line_number, error)
+                continue
+            users.append(user)
+            if len(users) >= settings.import_chunk_size:
+                job.inserted(await insert_users(users, job.id, job.last_user_id))
+                await save_job(job)
+                users = []
+        if users:
+            job.inserted(await insert_users(users, job.id, job.last_user_id))
+        job.status = STATUS_DONE
+    except (Exception, asyncio.CancelledError):
+        job.status = STATUS_FAILED
+        raise
+    finally:
+        job.finished_at = datetime.utcnow()
+        await save_job(job)
+    return job
+
+
+async def _read(upload: BinaryIO) -> AsyncIterator[bytes]:
+    while True:
+        chunk = upload.read(READ_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def _lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """
+    Splits a byte stream into UTF-8 lines, whatever the chunk boundaries
+    """
+
+    pending = b""
+    async for chunk in chunks:
+        pending += chunk
+        lines = pending.split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line.decode("utf-8-sig").rstrip("\r")
+    if pending:
+        yield pending.decode("utf-8-sig").rstrip("\r")
+
+
+def _parse_csv(line: str) -> List[str]:
+    return next(csv.reader([line]))
+
+
+def _parse_user(line: str, data_format: str, header: Optional[List[str]]):
+    """
+    Parses and validates a line of the upload
+    :return: a (user, error) tuple, user being None if the line is rejected
+    """
+
+    try:
+        if data_format == FORMAT_CSV:
+            values = _parse_csv(line)
+            if len(values) != len(header):
+                return None, "%d columns expected, %d found" % (len(header), len(values))
+            fields = dict(zip(header, values))
+        else:
+            fields = orjson.loads(line)
+            if not isinstance(fields, dict):
+                return None, "A JSON object is expected"
+        user = BaseUser(**fields)
+    except (ValueError, ValidationError) as e:
+        return None, str(e).replace("\n", " ")
+    if not (user.firstname.strip() and user.lastname.strip() and user.address.strip()):
+        return None, "The firstname, lastname and address are required"
+    return user, None
@@ -1,21 +1,159 @@
-from geopy.geocoders import Nominatim
-from schwifty import IBAN
+import hashlib
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from db.database import get_db
+from db.tables.geocoding import GeocodingCache
+from db.variables import settings
+from util.cache import TTLCache
+from util.geocoder import Geocoder, NominatimGeocoder, RateLimiter
+from util.iban import validate_iban
+from util.metrics import geocoder_request_duration, geocoder_failures
 
-geolocator = Nominatim(user_agent="my_geocoder")
+geocoder: Geocoder = None  # created on first use (see get_geocoder), geopy is only loaded by the geocoding worker
+# Global limiter shared by every geocoder call of the process
+geocoder_rate_limiter = RateLimiter(settings.geocoder_rate_limit)
+
+# First cache tier: in-process LRU of the normalized addresses
+geocoding_memory_cache = TTLCache(settings.geocoding_cache_size, settings.geocoding_cache_ttl)
+# Counters of the second cache tier (geocoding_cache table)
+geocoding_persistent_stats = {"hits": 0, "misses": 0}
+_stats_lock = threading.Lock()  # the geocoding worker threads update the counters concurrently
+_geocoder_lock = threading.Lock()
 
 
 def get_coordinates(address: str):
-    location = geolocator.geocode(address)
-    if location is None:
-        return None, None
+    """
+    Calculates the geographical location of an address.
+    The results, including the addresses that cannot be located, are cached in memory and in the database
+    so that the geocoder is only called once per distinct (normalized) address
+    :param address: the address to locate
+    :return: a (latitude, longitude) tuple, (None, None) if the address cannot be located
+    """
 
-    coordinates = f"POINT({location.latitude} {location.longitude})"
-    return location.latitude, location.longitude
+    key = normalize_address(address)
+    found, coordinates = geocoding_memory_cache.lookup(key)
+    if found:
+        return coordinates
 
+    found, coordinates = _read_persistent_coordinates(key)
+    with _stats_lock:
+        geocoding_persistent_stats["hits" if found else "misses"] += 1
+    if not found:
+        coordinates = _geocode(address)
+        _write_persistent_coordinates(key, coordinates)
 
-def validate_account_number(account_number):
+    geocoding_memory_cache.put(key, coordinates, _ttl(coordinates))
+    return coordinates
+
+
+def normalize_address(address: str) -> str:
+    """
+    Normalizes an address to build a cache key: case, whitespace and punctuation are folded
+    :param address: the address to normalize
+    :return: the normalized address
+    """
+
+    return " ".join(re.sub(r"[\W_]+", " ", address.casefold()).split())
+
+
+def geocoding_stats() -> dict:
+    """
+    :return: the hit/miss counters of both geocoding cache tiers
+    """
+
+    with _stats_lock:
+        persistent = dict(geocoding_persistent_stats)
+    return {"memory": geocoding_memory_cache.stats(), "persistent": persistent}
+
+
+def get_geocoder() -> Geocoder:
+    """
+    :return: the geocoding service, a NominatimGeocoder unless replaced by set_geocoder
+    """
+
+    global geocoder
+    if geocoder is None:
+        with _geocoder_lock:
+            if geocoder is None:
+                geocoder = NominatimGeocoder()
+    return geocoder
+
+
+def set_geocoder(new_geocoder: Geocoder):
+    """
+    Replaces the geocoding service (e.g. by a StubGeocoder to work offline) and empties the in-process cache
+    :param new_geocoder: the geocoder to use
+    """
+
+    global geocoder
+    geocoder = new_geocoder
+    geocoding_memory_cache.clear()
+
+
+def _geocode(address: str):
+    geocoder_rate_limiter.wait()
+    start = time.perf_counter()
     try:
-        IBAN(account_number)
-        return True
+        return get_geocoder().geocode(address)
     except Exception as e:
-        return False
+        geocoder_failures.inc(type(e).__name__)
+        raise
+    finally:
+        geocoder_request_duration.observe(time.perf_counter() - start)
+
+
+def _ttl(coordinates) -> int:
+    """
+    :return: the time-to-live in seconds of a geocoder result (not found results expire sooner)
+    """
+
+    return settings.geocoding_negative_ttl if coordinates[0] is None else settings.geocoding_cache_ttl
+
+
+def _persistent_key(key: str) -> str:
+    """
+    :return: the key of a normalized address in the geocoding_cache table, its SHA-256 (the addresses have no
+    length limit once normalized, e.g. casefold() turns "ß" into "ss")
+    """
+
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def _read_persistent_coordinates(key: str):
+    """
+    Reads the coordinates of a normalized address from the geocoding_cache table
+    :param key: the normalized address
+    :return: a (found, coordinates) tuple, found being False if the address is missing or expired
+    """
+
+    session = get_db()
+    try:
+        entry = session.get(GeocodingCache, _persistent_key(key))
+        if entry is None or entry.expires_at <= datetime.utcnow():
+            return False, None
+        return True, (entry.latitude, entry.longitude)
+    finally:
+        session.close()
+
+
+def _write_persistent_coordinates(key: str, coordinates):
+    """
+    Stores the coordinates of a normalized address in the geocoding_cache table
+    :param key: the normalized address
+    :param coordinates: a (latitude, longitude) tuple, (None, None) if the address cannot be located
+    """
+
+    session = get_db()
+    try:
+        latitude, longitude = coordinates
+        session.merge(GeocodingCache(address_key=_persistent_key(key), latitude=latitude, longitude=longitude,
+                                     expires_at=datetime.utcnow() + timedelta(seconds=_ttl(coordinates))))
+        session.commit()
+    finally:
+        session.close()
+
+
+def validate_account_number(account_number):
+    return validate_iban(account_number)
@@ -0,0 +1,242 @@
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from sqlalchemy import bindparam, case, select, update
+
+from db.database import get_db
+from db.tables.user import User as UserTable
+from db.variables import settings
+from pojo.user import GEOCODING_PENDING, GEOCODING_DONE, GEOCODING_NOT_FOUND, GEOCODING_FAILED
+from util import util, geohash
+from util.entity_cache import user_cache
+
+logger = logging.getLogger("homebanking.geocoding")
+
+
+class GeocodingWorker:
+    """
+    Background worker calculating the geographical location of the users created or modified with a pending
+    geocoding status. The user IDs are pushed to an in-process queue, and the users table itself serves as
+    durable pending list so that the work left at shutdown is resumed at the next start.
+    Every geocoder call goes through util.get_coordinates (cache and global rate limiter). The distinct addresses
+    of a batch are located once each, in parallel by a bounded thread pool. A geocoder failure only affects the users
+    of its address: they are tried again later, and marked as failed after settings.geocoding_max_attempts failures
+
+    Attributes:
+        batch_size: maximum number of users located before writing their coordinates back in one transaction
+        poll_interval: seconds to wait for queued users before looking for pending users in the database
+        threads: maximum number of concurrent geocoder calls
+    """
+
+    def __init__(self, batch_size: int = None, poll_interval: float = 5.0, threads: int = None):
+        self.batch_size = batch_size or settings.geocoding_batch_size
+        self.poll_interval = poll_interval
+        self.threads = threads or settings.geocoding_threads
+        self.queue = queue.Queue()
+        self._executor = None  # created by the first batch, shut down by stop
+        self._stop = threading.Event()
+        self._thread = None
+
+    def submit(self, user_id: int):
+        """
+        Schedules the geographical location calculation of a user
+        :param user_id: the ID of a user whose geocoding status is pending
+        """
+
+        self.queue.put(user_id)
+
+    def start(self):
+        """
+        Starts the worker thread (does nothing if it is already running)
+        """
+
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="geocoding-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        """
+        Stops the worker thread once the current batch is written back
+        """
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def process_pending(self) -> int:
+        """
+        Synchronously locates every queued user and every pending user of the database
+        :return: the number of users written back
+        """
+
+        processed = 0
+        while True:
+            user_ids = self._take_queued()
+            if not user_ids:
+                user_ids = _pending_user_ids(self.batch_size)
+                if not user_ids:
+                    return processed
+            processed += self._process(user_ids)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                user_ids = [self.queue.get(timeout=self.poll_interval)] + self._take_queued(self.batch_size - 1)
+            except queue.Empty:
+                user_ids = _pending_user_ids(self.batch_size)
+                if not user_ids:
+                    continue
+            try:
+                self._process(user_ids)
+            except Exception:
+                logger.exception("Unexpected geocoding error")
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """
+        :return: the thread pool of the geocoder calls, created on first use
+        """
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="geocoder")
+        return self._executor
+
+    def _take_queued(self, limit: int = None) -> List[int]:
+        """
+        :return: up to limit (batch size by default) queued user IDs, without blocking
+        """
+
+        user_ids = []
+        limit = self.batch_size if limit is None else limit
+        while len(user_ids) < limit:
+            try:
+                user_ids.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return user_ids
+
+    def _process(self, user_ids: List[int]) -> int:
+        """
+        Locates a batch of users and writes their coordinates back
+        :param user_ids: the IDs of the users to locate (users that are no longer pending are ignored)
+        :return: the number of users written back (located, not found or failed)
+        """
+
+        session = get_db()
+        try:
+            users = session.execute(select(UserTable.id, UserTable.address)
+                                    .where(UserTable.id.in_(set(user_ids)),
+                                           UserTable.geocoding_status == GEOCODING_PENDING)).all()
+        finally:
+            session.close()
+
+        addresses = {}  # normalized address -> address, one geocoder lookup per distinct address
+        for user_id, address in users:
+            addresses.setdefault(util.normalize_address(address), address)
+        locations = dict(zip(addresses, self._get_executor().map(_locate, addresses.values())))
+
+        results = []
+        failures = []
+        for user_id, address in users:
+            location = locations[util.normalize_address(address)]
+            if location is None:
+                failures.append({"b_id": user_id, "b_address": address})
+                continue
+            latitude, longitude = location
+            located = latitude is not None and longitude is not None
+            results.append({"b_id": user_id, "b_address": address,
+                            "b_coordinates": f"{latitude} {longitude}" if located else None,
+                            "b_geohash": geohash.encode(latitude, longitude) if located else None,
+                            "b_status": GEOCODING_DONE if located else GEOCODING_NOT_FOUND})
+
+        if results:
+            _write_back(results)
+        if failures:
+            _record_failures(failures)
+        return len(results) + len(failures)
+
+
+def _locate(address: str):
+    """
+    :return: the coordinates of an address (see util.get_coordinates), None if the geocoder failed
+    """
+
+    try:
+        return util.get_coordinates(address)
+    except Exception:
+        logger.exception("Geocoding of %r failed", address)
+        return None
+
+
+def _pending_user_ids(limit: int) -> List[int]:
+    """
+    :return: up to limit IDs of users whose geocoding status is pending, the ones that failed the least first
+    """
+
+    session = get_db()
+    try:
+        return session.scalars(select(UserTable.id)
+                               .where(UserTable.geocoding_status == GEOCODING_PENDING)
+                               .order_by(UserTable.geocoding_attempts, UserTable.id)
+                               .limit(limit)).all()
+    finally:
+        session.close()
+
+
+def _write_back(results: List[dict]):
+    """
+    Writes the coordinates of a batch of users with one executemany UPDATE.
+    A user whose address changed in the meantime is left pending
+    :param results: the bound values of each user (b_id, b_address, b_coordinates, b_geohash and b_status)
+    """
+
+    table = UserTable.__table__
+    statement = update(table) \
+        .where(table.c.id == bindparam("b_id"), table.c.address == bindparam("b_address"),
+               table.c.geocoding_status == GEOCODING_PENDING) \
+        .values(coordinates=bindparam("b_coordinates", type_=table.c.coordinates.type),
+                geohash=bindparam("b_geohash"), geocoding_status=bindparam("b_status"))
+
+    session = get_db()
+    try:
+        session.execute(statement, results)
+        session.commit()
+    finally:
+        session.close()
+    user_cache.invalidate(*[result["b_id"] for result in results])
+
+
+def _record_failures(failures: List[dict]):
+    """
+    Counts a geocoder failure for a batch of users with one executemany UPDATE. The users are left pending until
+    their settings.geocoding_max_attempts-th failure, then marked as failed
+    :param failures: the bound values of each user (b_id and b_address)
+    """
+
+    table = UserTable.__table__
+    attempts = table.c.geocoding_attempts + 1
+    statement = update(table) \
+        .where(table.c.id == bindparam("b_id"), table.c.address == bindparam("b_address"),
+               table.c.geocoding_status == GEOCODING_PENDING) \
+        .values(geocoding_attempts=attempts,
+                geocoding_status=case((attempts >= settings.geocoding_max_attempts, GEOCODING_FAILED),
+                                      else_=GEOCODING_PENDING))
+
+    session = get_db()
+    try:
+        session.execute(statement, failures)
+        session.commit()
+    finally:
+        session.close()
+    user_cache.invalidate(*[failure["b_id"] for failure in failures])
+
+
+geocoding_worker = GeocodingWorker()
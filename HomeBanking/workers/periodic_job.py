@@ -0,0 +1,69 @@
+import logging
+import threading
+from typing import Callable
+
+from dao import ledger_dao, idempotency_dao, shard_dao
+from db.database import check_replicas
+from db.variables import settings
+
+logger = logging.getLogger("homebanking.jobs")
+
+
+class PeriodicJob:
+    """
+    Background thread calling a maintenance function at a fixed interval
+
+    Attributes:
+        name: name of the thread
+        interval: seconds between two calls
+        function: the function to call, without argument
+    """
+
+    def __init__(self, name: str, interval: float, function: Callable[[], object]):
+        self.name = name
+        self.interval = interval
+        self.function = function
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Starts the job thread (does nothing if it is already running)
+        """
+
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        """
+        Stops the job thread once the current call is over
+        """
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.function()
+            except Exception:
+                logger.exception("Unexpected error in %s", self.name)
+
+
+# Writes the balance checkpoints of the accounts used since the previous run
+checkpoint_job = PeriodicJob("balance-checkpoint", settings.checkpoint_interval, ledger_dao.checkpoint_balances)
+
+# Deletes the expired idempotency keys
+idempotency_purge_job = PeriodicJob("idempotency-purge", settings.idempotency_purge_interval,
+                                    idempotency_dao.purge_expired)
+
+# Spreads the balance of the hot accounts evenly over their shards again
+rebalance_job = PeriodicJob("shard-rebalance", settings.shard_rebalance_interval, shard_dao.rebalance_shards)
+
+# Sends the reads to the primary while the read replicas are unavailable
+replica_health_job = PeriodicJob("replica-health", settings.replica_health_interval, check_replicas)
@@ -0,0 +1,361 @@
+import glob
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from typing import List, Optional, Tuple
+
+import orjson
+from sqlalchemy import exc
+
+from dao import transaction_dao
+from db.variables import settings
+from pojo.transaction import Transaction as TransactionPOJO, TRANSFER_PENDING
+from util import metrics
+from util.cache import TTLCache
+from util.messages import TRANSFER_NOT_EXECUTED
+from util.retry import TransactionConflict, is_transient
+
+logger = logging.getLogger("homebanking.transfers")
+
+
+class TransferWriter:
+    """
+    Background worker executing the queued transfers with group commits: the transfers queued during a few
+    milliseconds are executed and committed by a single database transaction.
+    A queued transfer is appended to a journal file (flushed to disk) before being acknowledged. The journal of
+    a process is split into segments of group_size transfers: a segment is deleted once all its transfers are
+    committed, and the segments left by a stopped or crashed process are replayed at the next start (the transfers
+    already committed are recognized and skipped, the ones older than settings.idempotency_key_ttl are not replayed).
+    A group failing settings.transfer_commit_attempts times while the database is available is executed again
+    transfer by transfer, and the transfers failing again are recorded as failed (dead letters)
+
+    Attributes:
+        directory: directory of the journals, each process writing its own segments
+        group_size: maximum number of transfers committed at once, and number of transfers of a journal segment
+        group_delay: seconds waited for more transfers before a commit
+        fsync: flushes every queued transfer to disk before acknowledging it
+        poll_interval: seconds between two checks of the stop request, and before retrying a failed commit
+        commit_attempts: failed commits of a group (database available) before its transfers are executed one by one
+    """
+
+    def __init__(self, directory: str = None, group_size: int = None, group_delay: float = None,
+                 fsync: bool = None, poll_interval: float = 1.0, commit_attempts: int = None):
+        self.directory = directory or settings.transfer_queue_dir
+        self.group_size = group_size or settings.transfer_group_size
+        self.group_delay = settings.transfer_group_delay / 1000.0 if group_delay is None else group_delay
+        self.fsync = settings.transfer_queue_fsync if fsync is None else fsync
+        self.poll_interval = poll_interval
+        self.commit_attempts = commit_attempts or settings.transfer_commit_attempts
+        self.queue = queue.Queue()
+        self.statuses = TTLCache(100000, settings.idempotency_key_ttl)  # status of the committed transfers, by ID
+        self._pending = {}  # ID of a transfer not committed yet -> path of its journal segment
+        self._segments = {}  # path -> [open and locked segment, number of transfers not committed yet]
+        self._journal = None  # segment receiving the queued transfers
+        self._journal_size = 0  # number of transfers written to the current segment
+        self._lock = threading.Lock()  # serializes the journal writes, rotations and deletions
+        self._stop = threading.Event()
+        self._thread = None
+
+    def submit(self, transaction: TransactionPOJO) -> str:
+        """
+        Queues a transfer, once it is written to the journal. Blocking (disk write), to be called from a thread
+        :param transaction: the transfer, checked by the writer like the transfers of transaction_dao.transfer
+        :return: the transfer ID
+        """
+
+        transfer_id = uuid.uuid4().hex
+        entry = orjson.dumps({"id": transfer_id, "from_acc": transaction.from_acc, "to_acc": transaction.to_acc,
+                              "amount": transaction.amount, "queued_at": time.time()})
+        with self._lock:
+            journal = self._open_journal()
+            journal.write(entry + b"\n")
+            journal.flush()
+            if self.fsync:
+                os.fsync(journal.fileno())
+            self._journal_size += 1
+            self._segments[journal.name][1] += 1
+            self._pending[transfer_id] = journal.name
+        self.queue.put((transfer_id, transaction))
+        return transfer_id
+
+    def status(self, transfer_id: str) -> Optional[dict]:
+        """
+        :return: the status of a transfer queued by this process, None if it is unknown
+        """
+
+        if transfer_id in self._pending:
+            return {"id": transfer_id, "status": TRANSFER_PENDING}
+        return self.statuses.get(transfer_id)
+
+    def start(self):
+        """
+        Replays the journals left by the stopped processes, then starts the writer thread
+        (does nothing if it is already running)
+        """
+
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self.recover()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="transfer-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        """
+        Stops the writer thread once the current group is committed. The transfers still queued are left in the
+        journal, to be replayed at the next start
+        """
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        with self._lock:
+            for path, (segment, pending) in self._segments.items():
+                segment.close()  # also releases the segment lock
+                if not pending:
+                    os.remove(path)
+            self._segments.clear()
+            self._journal = None
+            self._pending.clear()
+            self.queue = queue.Queue()
+
+    def process_pending(self) -> int:
+        """
+        Synchronously commits every queued transfer
+        :return: the number of committed transfers
+        """
+
+        committed = 0
+        while True:
+            group = self._take_queued(self.group_size)
+            if not group:
+                return committed
+            self._commit(group)
+            committed += len(group)
+
+    def recover(self) -> int:
+        """
+        Executes the transfers of the journals of the directory that no running process holds. The transfers
+        queued more than settings.idempotency_key_ttl seconds ago are not replayed: their status records may
+        already be purged, so they could be executed twice
+        :return: the number of replayed transfers
+        """
+
+        replayed = 0
+        expired_before = time.time() - settings.idempotency_key_ttl
+        for path in sorted(glob.glob(os.path.join(self.directory, "transfers-*.log"))):
+            with open(path, "rb") as journal:
+                try:
+                    _lock(journal)
+                except OSError:
+                    continue  # journal of a running process
+                entries = _read_journal(journal, os.path.getmtime(path))
+                recent = [(transfer_id, transaction) for transfer_id, transaction, queued_at in entries
+                          if queued_at >= expired_before]
+                if len(recent) < len(entries):
+                    logger.warning("%d transfers of %s are older than the idempotency keys and are not replayed: %s",
+                                   len(entries) - len(recent), path,
+                                   ", ".join(transfer_id for transfer_id, transaction, queued_at in entries
+                                             if queued_at < expired_before))
+                for i in range(0, len(recent), self.group_size):
+                    self._commit(recent[i:i + self.group_size])
+            os.remove(path)
+            replayed += len(recent)
+        return replayed
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                group = [self.queue.get(timeout=self.poll_interval)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.group_delay
+            while len(group) < self.group_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    group.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            group += self._take_queued(self.group_size - len(group))
+            self._commit_with_retries(group)
+
+    def _commit_with_retries(self, group: List[Tuple[str, TransactionPOJO]]):
+        """
+        Commits a group. While the database is unavailable, the commit is tried again and the transfers stay in the
+        journal (replayed at the next start if the writer stops). A group failing commit_attempts times with another
+        error is committed transfer by transfer, so that a single bad transfer does not block the queue
+        """
+
+        failures = 0
+        while failures < self.commit_attempts:
+            try:
+                self._commit(group)
+                return
+            except Exception as e:
+                if _unavailable(e):
+                    logger.exception("Commit of %d queued transfers failed, the database is unavailable", len(group))
+                else:
+                    failures += 1
+                    logger.exception("Commit of %d queued transfers failed (attempt %d of %d)",
+                                     len(group), failures, self.commit_attempts)
+            if self._stop.wait(self.poll_interval):
+                return
+        for transfer in group:
+            self._commit_alone(*transfer)
+
+    def _commit_alone(self, transfer_id: str, transaction: TransactionPOJO):
+        """
+        Commits a transfer of a failing group, and dead-letters it if its own execution fails for another reason
+        than the unavailability of the database
+        """
+
+        while True:
+            try:
+                self._commit([(transfer_id, transaction)])
+                return
+            except Exception as e:
+                if _unavailable(e):
+                    logger.exception("Queued transfer %s not committed, the database is unavailable", transfer_id)
+                else:
+                    logger.exception("Queued transfer %s cannot be executed", transfer_id)
+                    if self._dead_letter(transfer_id):
+                        return
+            if self._stop.wait(self.poll_interval):
+                return
+
+    def _dead_letter(self, transfer_id: str) -> bool:
+        """
+        Records a transfer that cannot be executed as failed, then removes it from the journal
+        :return: False if the status could not be recorded, the transfer being kept in the journal
+        """
+
+        try:
+            status = transaction_dao.fail_queued(transfer_id, TRANSFER_NOT_EXECUTED)
+        except Exception:
+            logger.exception("Status of the dead-lettered transfer %s not recorded, it stays in the journal",
+                             transfer_id)
+            return False
+        self._committed([status])
+        return True
+
+    def _take_queued(self, limit: int) -> List[Tuple[str, TransactionPOJO]]:
+        """
+        :return: up to limit queued transfers, without blocking
+        """
+
+        group = []
+        while len(group) < limit:
+            try:
+                group.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return group
+
+    def _commit(self, group: List[Tuple[str, TransactionPOJO]]):
+        """
+        Executes a group of transfers in one database transaction
+        """
+
+        self._committed(transaction_dao.transfer_queued(group))
+        metrics.transfer_group_commit_size.observe(len(group))
+
+    def _committed(self, statuses: List[dict]):
+        """
+        Records the status of executed transfers, and deletes the journal segments whose transfers are all
+        executed (the current segment is emptied instead)
+        """
+
+        for status in statuses:
+            self.statuses.put(status["id"], status)
+        with self._lock:
+            for status in statuses:
+                path = self._pending.pop(status["id"], None)
+                if path is None:
+                    continue  # replayed transfer
+                segment = self._segments[path]
+                segment[1] -= 1
+                if segment[1]:
+                    continue
+                if segment[0] is self._journal:
+                    self._journal.truncate(0)
+                    self._journal_size = 0
+                else:
+                    segment[0].close()
+                    os.remove(path)
+                    del self._segments[path]
+
+    def _open_journal(self):
+        """
+        Opens the current journal segment of the process (a new file, locked as long as the process runs), and
+        starts a new segment once the current one holds group_size transfers
+        """
+
+        if self._journal is not None and self._journal_size >= self.group_size:
+            self._journal = None
+        if self._journal is None:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, "transfers-%d-%s.log" % (os.getpid(), uuid.uuid4().hex[:8]))
+            self._journal = open(path, "ab")
+            _lock(self._journal)
+            self._journal_size = 0
+            self._segments[path] = [self._journal, 0]
+        return self._journal
+
+
+def _unavailable(error: Exception) -> bool:
+    """
+    Tells if a commit failed because the database is unavailable or busy (lost connection, pool timeout,
+    concurrent transactions), i.e. if the same transfers can be committed later
+    """
+
+    if isinstance(error, (TransactionConflict, exc.OperationalError, exc.InterfaceError, exc.TimeoutError, OSError)):
+        return True
+    return isinstance(error, exc.DBAPIError) and (error.connection_invalidated or is_transient(error))
+
+
+def _lock(journal):
+    """
+    Locks a journal for the lifetime of the open file: with flock on POSIX, with msvcrt on Windows
+    :raises OSError: the journal is locked by another process
+    """
+
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt
+        position = journal.tell()
+        journal.seek(0)
+        msvcrt.locking(journal.fileno(), msvcrt.LK_NBLCK, 1)
+        journal.seek(position)
+        return
+    fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def _read_journal(journal, modified_at: float) -> List[Tuple[str, TransactionPOJO, float]]:
+    """
+    Reads the transfers of a journal. A truncated last line (crash during the write) was never acknowledged
+    and is ignored
+    :param modified_at: time of the last write of the journal, queue time of the entries written without theirs
+    :return: the (transfer ID, transfer, queue time) tuples, in queue order
+    """
+
+    entries = []
+    for line in journal:
+        try:
+            entry = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            continue
+        transfer_id = entry.pop("id")
+        queued_at = entry.pop("queued_at", modified_at)
+        entries.append((transfer_id, TransactionPOJO(**entry), queued_at))
+    return entries
+
+
+transfer_writer = TransferWriter()
+metrics.transfer_queue_pending.function = lambda: {(): len(transfer_writer._pending)}
@@ -8,6 +8,10 @@ create table users (
      lastname varchar(50) not null,
      address varchar(100) not null,
      coordinates POINT,
+     geocoding_status varchar(10),
+     geocoding_attempts int not null default 0,
+     geohash varchar(12),
+     import_job char(32),
      constraint ID_User_ID primary key (id));
 
 create table account (
@@ -15,6 +19,12 @@ create table account (
      balance float(15,2) not null,
      user_id int not null,
      constraint ID_Account_ID primary key (number));
+
+create table account_shard (
+     account_number varchar(50) not null,
+     shard int not null,
+     balance float(15,2) not null,
+     constraint ID_Account_Shard_ID primary key (account_number, shard));
 	 
 create table transfer (
      id int not null auto_increment,
@@ -24,6 +34,45 @@ create table transfer (
      to_acc varchar(50) not null,
      constraint ID_Transfer_ID primary key (id));
 
+create table ledger_entry (
+     id int not null auto_increment,
+     account_number varchar(50) not null,
+     amount float(15,2) not null,
+     counterparty varchar(50) not null,
+     date datetime(6) not null,
+     constraint ID_Ledger_Entry_ID primary key (id));
+
+create table balance_checkpoint (
+     account_number varchar(50) not null,
+     date datetime(6) not null,
+     balance float(15,2) not null,
+     constraint ID_Balance_Checkpoint_ID primary key (account_number, date));
+
+create table geocoding_cache (
+     address_key char(64) not null,
+     latitude double,
+     longitude double,
+     expires_at datetime not null,
+     constraint ID_Geocoding_Cache_ID primary key (address_key));
+
+create table idempotency_key (
+     `key` varchar(255) not null,
+     request_hash char(64) not null,
+     response text not null,
+     expires_at datetime not null,
+     constraint ID_Idempotency_Key_ID primary key (`key`));
+
+create table import_job (
+     id char(32) not null,
+     status varchar(10) not null,
+     started_at datetime not null,
+     finished_at datetime,
+     rows_read int not null,
+     imported int not null,
+     error_count int not null,
+     errors mediumtext not null,
+     constraint ID_Import_Job_ID primary key (id));
+
 
 -- Constraints Section
 -- ___________________ 
@@ -40,6 +89,18 @@ alter table transfer add constraint FKfrom_FK
      foreign key (to_acc)
      references account (number);
 
+alter table ledger_entry add constraint FKledger_FK
+     foreign key (account_number)
+     references account (number);
+
+alter table balance_checkpoint add constraint FKcheckpoint_FK
+     foreign key (account_number)
+     references account (number);
+
+alter table account_shard add constraint FKshard_FK
+     foreign key (account_number)
+     references account (number);
+
 -- Index Section
 -- _____________ 
 
@@ -51,13 +112,28 @@ create unique index ID_Account_IND
 
 create index FKowns_IND
      on account (user_id);
+
+create index Geocoding_Status_IND
+     on users (geocoding_status);
+
+create index Users_Geohash_IND
+     on users (geohash);
+
+create index Users_Import_Job_IND
+     on users (import_job);
 	 
 create unique index ID_Transfer_IND
      on transfer (id);
 
 create index FKto_IND
-     on transfer (from_acc);
+     on transfer (from_acc, date);
 
 create index FKfrom_IND
-     on transfer (to_acc);
+     on transfer (to_acc, date);
+
+create index Ledger_Account_Date_IND
+     on ledger_entry (account_number, date);
+
+create index Idempotency_Expires_IND
+     on idempotency_key (expires_at);
 
@@ -0,0 +1,11 @@
+-- Upgrades a database created from the dump.sql of the first release. The migrations are applied in order and
+-- bring it to the current dump.sql, which creates new databases directly.
+--
+-- Persistent cache of the geocoder results, keyed by the SHA-256 of the normalized address.
+
+create table geocoding_cache (
+     address_key char(64) not null,
+     latitude double,
+     longitude double,
+     expires_at datetime not null,
+     constraint ID_Geocoding_Cache_ID primary key (address_key));
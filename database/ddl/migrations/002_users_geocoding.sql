@@ -0,0 +1,9 @@
+-- Geocoding status of the users, located by the background geocoding worker. A user is marked as failed after
+-- settings.geocoding_max_attempts geocoder failures. The users created before this migration were located on
+-- creation and keep a null status.
+
+alter table users add geocoding_status varchar(10) after coordinates,
+     add geocoding_attempts int not null default 0 after geocoding_status;
+
+create index Geocoding_Status_IND
+     on users (geocoding_status);
@@ -0,0 +1,6 @@
+-- Indexes the transfers by account and date, serving the pages of the account history. Each index is replaced in
+-- a single statement, so that the foreign keys keep an index.
+
+alter table transfer drop index FKto_IND, add index FKto_IND (from_acc, date);
+
+alter table transfer drop index FKfrom_IND, add index FKfrom_IND (to_acc, date);
@@ -0,0 +1,27 @@
+-- Ledger of the balance changes with balance checkpoints, serving the balance as of a date. The accounts created
+-- before this migration are opened from their balance by the first checkpoint (ledger_dao.open_pre_ledger_balances).
+
+create table ledger_entry (
+     id int not null auto_increment,
+     account_number varchar(50) not null,
+     amount float(15,2) not null,
+     counterparty varchar(50) not null,
+     date datetime(6) not null,
+     constraint ID_Ledger_Entry_ID primary key (id));
+
+create table balance_checkpoint (
+     account_number varchar(50) not null,
+     date datetime(6) not null,
+     balance float(15,2) not null,
+     constraint ID_Balance_Checkpoint_ID primary key (account_number, date));
+
+alter table ledger_entry add constraint FKledger_FK
+     foreign key (account_number)
+     references account (number);
+
+alter table balance_checkpoint add constraint FKcheckpoint_FK
+     foreign key (account_number)
+     references account (number);
+
+create index Ledger_Account_Date_IND
+     on ledger_entry (account_number, date);
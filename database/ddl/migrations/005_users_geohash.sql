@@ -0,0 +1,11 @@
+-- Geohash of the user coordinates, serving the proximity searches (GET /users/nearby).
+-- The users located before this migration are backfilled from their coordinates: the POINT holds
+-- (latitude longitude) while ST_GeoHash expects (longitude, latitude). The precision is util.geohash.PRECISION.
+
+alter table users add geohash varchar(12) after geocoding_attempts;
+
+create index Users_Geohash_IND
+     on users (geohash);
+
+update users set geohash = ST_GeoHash(ST_Y(coordinates), ST_X(coordinates), 9)
+where coordinates is not null and geohash is null;
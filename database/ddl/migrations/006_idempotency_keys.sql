@@ -0,0 +1,11 @@
+-- Responses of the requests sent with an Idempotency-Key header, and statuses of the queued transfers.
+
+create table idempotency_key (
+     `key` varchar(255) not null,
+     request_hash char(64) not null,
+     response text not null,
+     expires_at datetime not null,
+     constraint ID_Idempotency_Key_ID primary key (`key`));
+
+create index Idempotency_Expires_IND
+     on idempotency_key (expires_at);
@@ -0,0 +1,11 @@
+-- Sub-balances of the hot accounts, whose balance is the sum of the account row and its shards.
+
+create table account_shard (
+     account_number varchar(50) not null,
+     shard int not null,
+     balance float(15,2) not null,
+     constraint ID_Account_Shard_ID primary key (account_number, shard));
+
+alter table account_shard add constraint FKshard_FK
+     foreign key (account_number)
+     references account (number);
@@ -0,0 +1,18 @@
+-- Runs the bulk user imports in the background: the users are tagged with the ID of the import which created them,
+-- and the progress reports are stored in the database so that any worker answers GET /users/bulk/{job_id}.
+
+alter table users add import_job char(32) after geohash;
+
+create index Users_Import_Job_IND
+     on users (import_job);
+
+create table import_job (
+     id char(32) not null,
+     status varchar(10) not null,
+     started_at datetime not null,
+     finished_at datetime,
+     rows_read int not null,
+     imported int not null,
+     error_count int not null,
+     errors mediumtext not null,
+     constraint ID_Import_Job_ID primary key (id));